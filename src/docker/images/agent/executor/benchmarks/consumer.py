@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""Measure the jobs launched per second by the consumer of an agent, against a stand-in broker and kubernetes API.
+
+Usage: python benchmarks/consumer.py [--jobs 400] [--workers 1,4,8] [--kube-latency 0.05] [--failure-rate 0,0.1]
+
+Messages are delivered to JobConsumer by an in-process stand-in of the parts of pika's BlockingConnection
+that it uses, which honors the prefetch, puts nacked messages back at the head of the queue and published
+ones at its tail, as RabbitMQ does. Each is handled by the agent's handle_job_message and JobLauncher, which create jobs on a
+stand-in of the jobs endpoint of the kubernetes API, that answers after `--kube-latency` seconds and
+refuses `--failure-rate` of the creations with a 503. One message in `--invalid-every` cannot be decoded.
+With `--prefetch` messages per launcher, as with the defaults of CONSUMER_PREFETCH and LAUNCHER_WORKERS.
+
+Job configs and history are written to the database of the POSTGRES_HOST, POSTGRES_DB, POSTGRES_USER and
+POSTGRES_PASSWORD environment variables, which must have the schema of the database init job. The
+JobRequest rows of the jobs are created before each run, and all rows of the jobs are deleted after it.
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import types
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+AGENT_SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+NAMESPACE = 'benchmark'
+IMAGE = 'busybox'
+
+def load_modules(requeue_delay: float):
+    # The agent reads these at import, but the stand-ins do not use them.
+    for key, value in [('APP_ROLE', 'agent.executor.benchmark'), ('REGION', 'benchmark'), ('BROKER_URL', 'amqp://localhost'),
+                       ('QUEUE_PERFIX', 'benchmark')]:
+        os.environ.setdefault(key, value)
+    os.environ['CONSUMER_REQUEUE_DELAY'] = str(requeue_delay)
+    sys.path.insert(0, AGENT_SRC_DIR)
+    import consumer, kube, worker
+    return consumer, kube, worker
+
+
+class BrokerStandIn:
+    """A queue behind the connection and channel interface of pika's BlockingConnection, as used by JobConsumer.
+
+    `start_consuming()` returns once every message was acked or rejected.
+    """
+
+    def __init__(self, messages: list[str]):
+        # (body, headers) of the queued messages.
+        self.queue = deque((message.encode(), None) for message in messages)
+        self.unacked: dict[int, tuple[bytes, dict | None]] = {}
+        self.delivery_tags = itertools.count(1)
+        self.prefetch = 1
+        self.on_message = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.callbacks: deque = deque()
+        # (due time, sequence number, callback)
+        self.timers: list[tuple[float, int, object]] = []
+        self.timer_sequence = itertools.count()
+        self.is_open = True
+        self.acked = self.requeued = self.rejected = 0
+
+    def channel(self):
+        return self
+
+    def basic_qos(self, prefetch_count: int):
+        self.prefetch = prefetch_count
+
+    def basic_consume(self, queue: str, on_message_callback):
+        self.on_message = on_message_callback
+
+    def basic_ack(self, delivery_tag: int):
+        self.unacked.pop(delivery_tag)
+        self.acked += 1
+
+    def basic_nack(self, delivery_tag: int, requeue: bool = True):
+        message = self.unacked.pop(delivery_tag)
+        if requeue:
+            self.queue.appendleft(message)
+            self.requeued += 1
+        else:
+            self.rejected += 1
+
+    def basic_publish(self, exchange: str, routing_key: str, body: bytes, properties=None):
+        self.queue.append((body, properties.headers if properties else None))
+        self.requeued += 1
+
+    def add_callback_threadsafe(self, callback):
+        with self.lock:
+            self.callbacks.append(callback)
+        self.wakeup.set()
+
+    def call_later(self, delay: float, callback):
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timer_sequence), callback))
+
+    def start_consuming(self):
+        while self.queue or self.unacked:
+            while len(self.unacked) < self.prefetch and self.queue:
+                delivery_tag = next(self.delivery_tags)
+                body, headers = self.unacked[delivery_tag] = self.queue.popleft()
+                self.on_message(self, types.SimpleNamespace(delivery_tag=delivery_tag), types.SimpleNamespace(headers=headers),
+                                body)
+            timeout = max(0., self.timers[0][0] - time.monotonic()) if self.timers else None
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+            with self.lock:
+                callbacks, self.callbacks = self.callbacks, deque()
+            for callback in callbacks:
+                callback()
+            while self.timers and self.timers[0][0] <= time.monotonic():
+                heapq.heappop(self.timers)[2]()
+
+    def close(self):
+        self.is_open = False
+
+
+class KubeApiStandIn:
+    """Create jobs after `latency` seconds, except for `failure_rate` of them, refused as unavailable."""
+
+    def __init__(self, latency: float, failure_rate: float):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.created_job_names: set[str] = set()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._create_handler())
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _create_handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, as the API server, so that the connection pool of the job client is used.
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                time.sleep(stand_in.latency)
+                if random.random() < stand_in.failure_rate:
+                    return self._send_json(503, { 'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure', 'code': 503,
+                                                  'reason': 'ServiceUnavailable', 'message': 'stand-in failure' })
+                with stand_in.lock:
+                    stand_in.created_job_names.add(body['metadata']['name'])
+                self._send_json(201, body)
+
+            def _send_json(self, code: int, body: dict):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class JobTrackerStandIn:
+    def track_job(self, job_id, image: str = None):
+        pass
+
+
+def create_job_messages(job_ids: list[str], invalid_every: int) -> list[str]:
+    messages = []
+    for i, job_id in enumerate(job_ids):
+        if invalid_every and i % invalid_every == invalid_every - 1:
+            messages.append('{"version": 1, "encoding": "unknown", "payload": ""}')
+            continue
+        job_message = {
+            'job_id': job_id,
+            'name': f'benchmark-{job_id}',
+            'image': IMAGE,
+            'command': ['true'],
+            'inputs': {},
+            'outputs': {},
+        }
+        messages.append(json.dumps({ 'version': 1, 'encoding': 'json', 'payload': job_message }))
+    return messages
+
+def run(modules, args, workers: int, failure_rate: float) -> dict:
+    consumer, kube, worker = modules
+    kube_api = KubeApiStandIn(args.kube_latency, failure_rate)
+    configuration = kube.client.Configuration()
+    configuration.host = kube_api.url
+    kube.client.Configuration.set_default(configuration)
+    # Instead of the kubeconfig or in-cluster configuration, which would replace the default above.
+    kube.load_kube_config = lambda: NAMESPACE
+
+    job_ids = [str(uuid.uuid4()) for _ in range(args.jobs)]
+    dbconn = worker.get_db_connection(autocommit=True)
+    worker.psql_execute_values(dbconn.cursor(), 'INSERT INTO JobRequest (job_id, name, image, command) VALUES %s;',
+                               [(job_id, f'benchmark-{job_id}', IMAGE, 'true') for job_id in job_ids])
+    history_writer = worker.JobHistoryWriter()
+    try:
+        job_launcher = worker.JobLauncher(history_writer)
+        # One connection per launcher, as KUBE_CONNECTION_POOL_SIZE follows LAUNCHER_WORKERS.
+        job_launcher.job_client = kube.JobClient(pool_size=workers)
+        broker = BrokerStandIn(create_job_messages(job_ids, args.invalid_every))
+        job_tracker = JobTrackerStandIn()
+        job_consumer = consumer.JobConsumer(lambda message: worker.handle_job_message(job_launcher, job_tracker, message),
+                                            lambda message: worker.give_up_job_message(history_writer, message),
+                                            prefetch=args.prefetch * workers, workers=workers)
+        consumer.pika.BlockingConnection = lambda parameters: broker
+        start = time.monotonic()
+        job_consumer._consume()
+        elapsed = time.monotonic() - start
+        job_consumer.executor.shutdown()
+    finally:
+        history_writer.close()
+        kube_api.stop()
+        for table in ['JobCurrentState', 'JobHistory', 'JobConfig', 'JobRequest']:
+            worker.psql_execute_list(dbconn.cursor(), f'DELETE FROM {table} WHERE job_id = ANY(%s::uuid[]);', [job_ids])
+        dbconn.close()
+    return {
+        'launched': len(kube_api.created_job_names),
+        'jobs_per_second': len(kube_api.created_job_names) / elapsed,
+        'requeued': broker.requeued,
+        'rejected': broker.rejected,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=400)
+    parser.add_argument('--workers', type=lambda s: [int(w) for w in s.split(',')], default=[1, 4, 8])
+    parser.add_argument('--prefetch', type=int, default=2, help='messages delivered ahead per launcher')
+    parser.add_argument('--kube-latency', type=float, default=0.05, help='latency of job creations, in seconds')
+    parser.add_argument('--failure-rate', type=lambda s: [float(r) for r in s.split(',')], default=[0., 0.1],
+                        help='fractions of job creations refused with a 503')
+    parser.add_argument('--invalid-every', type=int, default=50, help='one message in this many cannot be decoded')
+    parser.add_argument('--requeue-delay', type=float, default=0.5, help='CONSUMER_REQUEUE_DELAY, in seconds')
+    args = parser.parse_args()
+    modules = load_modules(args.requeue_delay)
+    # Failed messages are logged as errors, and counted below instead.
+    logging.disable(logging.ERROR)
+
+    expected = args.jobs - (args.jobs // args.invalid_every if args.invalid_every else 0)
+    print(f'{args.jobs} messages, {expected} valid, kube API latency {args.kube_latency * 1000:.0f}ms, '
+          f'requeue delay {args.requeue_delay}s, prefetch {args.prefetch} per launcher\n')
+    print(f'{"launchers":>9} {"failures":>9} {"launched":>9} {"jobs/s":>8} {"requeued":>9} {"rejected":>9}')
+    for failure_rate in args.failure_rate:
+        for workers in args.workers:
+            result = run(modules, args, workers, failure_rate)
+            print(f'{workers:>9} {failure_rate:>9.0%} {result["launched"]:>9} {result["jobs_per_second"]:>8.1f} '
+                  f'{result["requeued"]:>9} {result["rejected"]:>9}')
+
+if __name__ == '__main__':
+    main()
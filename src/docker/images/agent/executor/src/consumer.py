@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import functools
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+import pika
+
+from util import get_env_var, get_env_var_or_default
+
+# Number of messages delivered ahead of being acked, and number of jobs launched concurrently.
+CONSUMER_PREFETCH = int(get_env_var_or_default('CONSUMER_PREFETCH', 8))
+LAUNCHER_WORKERS = int(get_env_var_or_default('LAUNCHER_WORKERS', 4))
+CONSUMER_RECONNECT_DELAY = float(get_env_var_or_default('CONSUMER_RECONNECT_DELAY', 5))
+# Delay before requeuing a message that failed for a transient reason, so that an outage is not retried in a loop.
+CONSUMER_REQUEUE_DELAY = float(get_env_var_or_default('CONSUMER_REQUEUE_DELAY', 5))
+# Number of times a message is handled before it is rejected, if it keeps failing for transient reasons.
+CONSUMER_MAX_ATTEMPTS = int(get_env_var_or_default('CONSUMER_MAX_ATTEMPTS', 5))
+# Header of requeued messages with the number of times they failed. Classic queues do not count deliveries.
+ATTEMPTS_HEADER = 'x-attempts'
+
+class MessageRejected(ValueError):
+    """Raised while handling a message that would fail again if redelivered, e.g. one that cannot be decoded."""
+
+def is_rejected(ex: BaseException) -> bool:
+    """Whether a MessageRejected is the exception or any of its causes."""
+    while ex is not None:
+        if isinstance(ex, MessageRejected):
+            return True
+        ex = ex.__cause__
+    return False
+
+class JobConsumer:
+    """Consume the job messages of the region's queue over a long-lived connection, and handle them concurrently.
+
+    Up to `prefetch` messages are delivered ahead of time and handled by a pool of `workers` threads.
+    A message is acked once `handle_message()` returns. If it raises a `MessageRejected`, directly or as
+    a cause, the message is rejected without requeue; any other failure is taken as transient, such as
+    the database or the kubernetes API being unavailable, and the message is published again at the end of
+    the queue after a delay, with its count of failed attempts. After `max_attempts`, the message is
+    rejected once `give_up_message()` returned, e.g. after marking its job as failed, or requeued if that
+    raises. Messages still being handled when the connection drops are redelivered after reconnecting.
+    """
+
+    def __init__(self, handle_message: Callable[[str], None], give_up_message: Callable[[str], None] | None = None,
+                 prefetch: int = CONSUMER_PREFETCH, workers: int = LAUNCHER_WORKERS, max_attempts: int = CONSUMER_MAX_ATTEMPTS):
+        self.broker_url = get_env_var('BROKER_URL')
+        self.queue_name = f"{get_env_var('QUEUE_PERFIX')}.{get_env_var('REGION')}"
+        self.handle_message = handle_message
+        self.give_up_message = give_up_message
+        self.max_attempts = max_attempts
+        self.prefetch = prefetch
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='launcher')
+        self.lock = threading.Lock()
+        # Messages received and not yet handled.
+        self.in_flight = 0
+
+    def run(self):
+        while True:
+            try:
+                self._consume()
+            except pika.exceptions.AMQPError as ex:
+                logging.error(f'JobConsumer: connection to broker lost, reconnecting in {CONSUMER_RECONNECT_DELAY}s: {ex!r}')
+                time.sleep(CONSUMER_RECONNECT_DELAY)
+
+    def _consume(self):
+        connection = pika.BlockingConnection(pika.URLParameters(self.broker_url))
+        try:
+            channel = connection.channel()
+            channel.basic_qos(prefetch_count=self.prefetch)
+            channel.basic_consume(self.queue_name, functools.partial(self._on_message, connection))
+            logging.info(f'JobConsumer: consuming from {self.queue_name} with prefetch {self.prefetch} ...')
+            channel.start_consuming()
+        finally:
+            if connection.is_open:
+                connection.close()
+
+    def _on_message(self, connection, channel, method, properties, body):
+        with self.lock:
+            self.in_flight += 1
+        attempts = ((properties.headers if properties else None) or {}).get(ATTEMPTS_HEADER, 0)
+        self.executor.submit(self._handle, connection, channel, method.delivery_tag, body, attempts)
+
+    def _handle(self, connection, channel, delivery_tag, body: bytes, attempts: int = 0):
+        """Handle a message that already failed `attempts` times, and settle it on the thread of the connection."""
+        requeue_delay = 0.
+        try:
+            self.handle_message(body.decode())
+            settle = functools.partial(channel.basic_ack, delivery_tag)
+        except Exception as ex:
+            attempts += 1
+            if is_rejected(ex):
+                action = 'rejecting it'
+                settle = functools.partial(channel.basic_nack, delivery_tag, requeue=False)
+            elif attempts >= self.max_attempts and self._give_up(body):
+                action = f'rejecting it after {attempts} attempts'
+                settle = functools.partial(channel.basic_nack, delivery_tag, requeue=False)
+            elif attempts >= self.max_attempts:
+                # Redelivered with its previous count of attempts, so that giving up is tried again after one more.
+                action = f'requeuing it in {CONSUMER_REQUEUE_DELAY}s to give it up later'
+                settle = functools.partial(channel.basic_nack, delivery_tag, requeue=True)
+                requeue_delay = CONSUMER_REQUEUE_DELAY
+            else:
+                action = f'requeuing it in {CONSUMER_REQUEUE_DELAY}s (attempt {attempts}/{self.max_attempts})'
+                settle = functools.partial(self._requeue, channel, delivery_tag, body, attempts)
+                requeue_delay = CONSUMER_REQUEUE_DELAY
+            logging.error(f'JobConsumer: failed to handle message, {action}: {ex}')
+            logging.error(traceback.format_exc())
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        if requeue_delay > 0:
+            # Delayed on the connection rather than in this thread, so that launchers are not held meanwhile.
+            settle = functools.partial(connection.call_later, requeue_delay, settle)
+        # Channels may only be used from the thread of their connection.
+        try:
+            connection.add_callback_threadsafe(settle)
+        except pika.exceptions.AMQPError:
+            logging.warning(f'JobConsumer: connection closed before message {delivery_tag} was settled, '
+                            'it will be redelivered')
+
+    def _give_up(self, body: bytes) -> bool:
+        """Call `give_up_message()`, and return whether it succeeded."""
+        if self.give_up_message is None:
+            return True
+        try:
+            self.give_up_message(body.decode())
+            return True
+        except Exception:
+            logging.error('JobConsumer: failed to give up message', exc_info=True)
+            return False
+
+    def _requeue(self, channel, delivery_tag, body: bytes, attempts: int):
+        # Published before the ack, so that the message is never lost, at worst delivered twice.
+        channel.basic_publish(exchange='', routing_key=self.queue_name, body=body,
+                              properties=pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent,
+                                                              headers={ ATTEMPTS_HEADER: attempts }))
+        channel.basic_ack(delivery_tag)
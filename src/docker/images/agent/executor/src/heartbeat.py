@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import logging
+import traceback
+from datetime import datetime, timezone
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from kubernetes.utils import parse_quantity
+
+from util import RepeatTimer, get_env_var, get_env_var_or_default
+from postgres import get_db_connection, psql_execute_list
+from kube import REGION_NODE_LABEL, load_kube_config
+
+APP_ROLE = get_env_var('APP_ROLE')
+REGION = get_env_var('REGION')
+HEARTBEAT_INTERVAL = float(get_env_var_or_default('HEARTBEAT_INTERVAL', 30))
+
+class RegionHeartbeat:
+    """Periodically report the capacity and load of the agent's region into the RegionCapacity table.
+
+    Allocatable resources are summed over the schedulable nodes of the region, those labeled with
+    REGION_NODE_LABEL=REGION, and requested resources over the pods scheduled on those nodes. If pods of
+    other namespaces cannot be listed, only the pods of the agent's namespace are counted. No heartbeat
+    is sent while no node has the label, rather than reporting a region without capacity.
+    """
+
+    def __init__(self, job_tracker, consumer, interval: float = HEARTBEAT_INTERVAL):
+        self.job_tracker = job_tracker
+        self.consumer = consumer
+        self.namespace = load_kube_config()
+        self.core_api = client.CoreV1Api()
+        self.dbconn = get_db_connection(autocommit=True)
+        self.can_list_all_pods = True
+        # Free CPU cores and memory bytes of the region as of the last heartbeat, or None before the first one.
+        self.free_resources: tuple[float, int] | None = None
+        self.timer = RepeatTimer(interval, self._send_heartbeat)
+        self.timer.daemon = True
+
+    def start(self):
+        self._send_heartbeat()
+        self.timer.start()
+
+    def _send_heartbeat(self):
+        try:
+            allocatable_resources = self._get_allocatable_resources()
+            if allocatable_resources is None:
+                logging.error(f'No node has label {REGION_NODE_LABEL}={REGION}, skipping heartbeat. '
+                              'REGION_NODE_LABEL must be the label holding the region of nodes.')
+                self.free_resources = None
+                return
+            allocatable_cpu, allocatable_memory, node_names = allocatable_resources
+            requested_cpu, requested_memory = self._get_requested_resources(node_names)
+            self.free_resources = (allocatable_cpu - requested_cpu, allocatable_memory - requested_memory)
+            running_jobs, pending_jobs = self.job_tracker.get_job_counts()
+            backlog = self.consumer.in_flight + pending_jobs
+            logging.info(f'Heartbeat of {REGION}: {requested_cpu}/{allocatable_cpu} CPU, '
+                         f'{requested_memory}/{allocatable_memory} bytes of memory requested, '
+                         f'{running_jobs} jobs running, {backlog} waiting')
+            if self.dbconn.closed:
+                self.dbconn = get_db_connection(autocommit=True)
+            cursor = self.dbconn.cursor()
+            psql_execute_list(cursor, '''INSERT INTO RegionCapacity (region, allocatable_cpu, allocatable_memory,
+                                                requested_cpu, requested_memory, running_jobs, backlog, origin, updated_at)
+                                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                                            ON CONFLICT (region) DO UPDATE
+                                                SET allocatable_cpu = EXCLUDED.allocatable_cpu,
+                                                    allocatable_memory = EXCLUDED.allocatable_memory,
+                                                    requested_cpu = EXCLUDED.requested_cpu,
+                                                    requested_memory = EXCLUDED.requested_memory,
+                                                    running_jobs = EXCLUDED.running_jobs,
+                                                    backlog = EXCLUDED.backlog,
+                                                    origin = EXCLUDED.origin,
+                                                    updated_at = EXCLUDED.updated_at;''', [
+                REGION, allocatable_cpu, allocatable_memory, requested_cpu, requested_memory,
+                running_jobs, backlog, APP_ROLE, datetime.now(timezone.utc)
+            ])
+        except Exception as ex:
+            logging.error(f'Failed to send heartbeat: {ex}')
+            logging.error(traceback.format_exc())
+
+    def _get_allocatable_resources(self) -> tuple[float, int, set[str]] | None:
+        """Get the allocatable CPU and memory of the region, and its node names, or None if it has no node."""
+        nodes = self.core_api.list_node(label_selector=f'{REGION_NODE_LABEL}={REGION}').items
+        if not nodes:
+            return None
+        nodes = [node for node in nodes if not node.spec.unschedulable and self._is_node_ready(node)]
+        cpu = sum(float(parse_quantity(node.status.allocatable.get('cpu', 0))) for node in nodes)
+        memory = sum(int(parse_quantity(node.status.allocatable.get('memory', 0))) for node in nodes)
+        return cpu, memory, { node.metadata.name for node in nodes }
+
+    def _get_requested_resources(self, node_names: set[str]) -> tuple[float, int]:
+        field_selector = 'status.phase!=Succeeded,status.phase!=Failed'
+        pods = None
+        if self.can_list_all_pods:
+            try:
+                pods = self.core_api.list_pod_for_all_namespaces(field_selector=field_selector).items
+            except ApiException as ex:
+                if ex.status != 403:
+                    raise
+                logging.warning('Not allowed to list pods of all namespaces, counting those of '
+                                f'namespace {self.namespace} only.')
+                self.can_list_all_pods = False
+        if pods is None:
+            pods = self.core_api.list_namespaced_pod(self.namespace, field_selector=field_selector).items
+        cpu, memory = 0., 0
+        for pod in pods:
+            if pod.spec.node_name not in node_names:
+                continue
+            for container in pod.spec.containers:
+                requests = (container.resources and container.resources.requests) or {}
+                cpu += float(parse_quantity(requests.get('cpu', 0)))
+                memory += int(parse_quantity(requests.get('memory', 0)))
+        return cpu, memory
+
+    @staticmethod
+    def _is_node_ready(node: client.V1Node) -> bool:
+        return any(condition.type == 'Ready' and condition.status == 'True'
+                   for condition in node.status.conditions or [])
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import atexit
+import logging
+import threading
+import time
+import traceback
+from datetime import datetime
+import psycopg2
+
+from util import get_env_var, get_env_var_or_default
+from postgres import get_db_connection, psql_execute_values
+from metrics import HISTORY_FLUSH_SIZE, HISTORY_FLUSH_LAG, HISTORY_DROPPED
+
+APP_ROLE = get_env_var('APP_ROLE')
+# Buffered events are written once this many are pending, or once the oldest is this many seconds old.
+HISTORY_FLUSH_MAX_SIZE = int(get_env_var_or_default('HISTORY_FLUSH_MAX_SIZE', 100))
+HISTORY_FLUSH_INTERVAL = float(get_env_var_or_default('HISTORY_FLUSH_INTERVAL', 1))
+# Events kept while the database is unreachable, beyond which the oldest are dropped.
+HISTORY_BUFFER_MAX_SIZE = int(get_env_var_or_default('HISTORY_BUFFER_MAX_SIZE', 10000))
+
+def is_rejected_write(ex: Exception) -> bool:
+    """Whether a write failed because of the rows themselves, e.g. a foreign key violation, rather than the database."""
+    return isinstance(ex.__cause__, (psycopg2.IntegrityError, psycopg2.DataError))
+
+class JobHistoryWriter:
+    """Write JobHistory events in batches, with one multi-row INSERT per flush.
+
+    Events saved with `sync=True` are written before `save()` returns, together with all events buffered
+    before them; use it for events that others wait for, or that must not be lost if the executor dies.
+    When the database rejects a batch, its events are written one at a time, and those it rejects are
+    logged and dropped, so that one bad event does not hold back the others. When the database cannot be
+    reached, the events are kept and retried with the next flush, up to `buffer_max_size` events.
+    """
+
+    def __init__(self, max_size: int = HISTORY_FLUSH_MAX_SIZE, interval: float = HISTORY_FLUSH_INTERVAL,
+                 buffer_max_size: int = HISTORY_BUFFER_MAX_SIZE):
+        assert buffer_max_size >= max_size
+        self.max_size = max_size
+        self.interval = interval
+        self.buffer_max_size = buffer_max_size
+        self.dbconn = get_db_connection(autocommit=True)
+        self.condition = threading.Condition()
+        # Serializes flushes, so that events are written in the order they were saved.
+        self.flush_lock = threading.Lock()
+        # (job id, event, timestamp, origin), time.monotonic() at which it was saved.
+        self.buffer: list[tuple[tuple, float]] = []
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name='job-history-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def save(self, job_id: str, event: str, timestamp: datetime, sync: bool = False):
+        logging.info(f'Saving job history with job_id={job_id}, event={event}, timestamp={timestamp}, sync={sync}')
+        row = (job_id, event, timestamp, APP_ROLE)
+        with self.condition:
+            self.buffer.append((row, time.monotonic()))
+            self._trim_buffer()
+            # Wake the flush up to start the interval of a first event, or to flush a full buffer.
+            if len(self.buffer) == 1 or len(self.buffer) >= self.max_size:
+                self.condition.notify()
+        if sync:
+            try:
+                rejected_rows = self.flush()
+            except Exception as ex:
+                raise ValueError(f'Failed to save job history (job_id={job_id}).') from ex
+            if row in rejected_rows:
+                raise ValueError(f'Failed to save job history (job_id={job_id}): rejected by the database.')
+
+    def flush(self) -> list[tuple]:
+        """Write the buffered events, and return the rows that the database rejected, which are dropped.
+
+        Raises if the database cannot be reached, in which case the events that were not written are kept.
+        """
+        with self.flush_lock:
+            with self.condition:
+                events, self.buffer = self.buffer, []
+            if not events:
+                return []
+            try:
+                self._write(events)
+                return []
+            except Exception as ex:
+                if not is_rejected_write(ex):
+                    self._restore(events)
+                    raise
+                logging.warning(f'JobHistoryWriter: batch of {len(events)} events rejected, writing them one at a time: {ex}')
+            rejected_rows = []
+            for i, (row, saved_time) in enumerate(events):
+                try:
+                    self._write([(row, saved_time)])
+                except Exception as ex:
+                    if not is_rejected_write(ex):
+                        self._restore(events[i:])
+                        raise
+                    logging.error(f'JobHistoryWriter: dropping event {row} rejected by the database: {ex}')
+                    HISTORY_DROPPED.labels('rejected').inc()
+                    rejected_rows.append(row)
+            return rejected_rows
+
+    def close(self):
+        """Stop the background flush, and write the remaining events."""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        try:
+            self.flush()
+        except Exception as ex:
+            logging.error(f'JobHistoryWriter: failed to write {len(self.buffer)} events at shutdown: {ex}')
+        self.dbconn.close()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.closed and not self._is_flush_due():
+                    timeout = self.interval - (time.monotonic() - self.buffer[0][1]) if self.buffer else None
+                    self.condition.wait(timeout)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+            except Exception as ex:
+                logging.error(f'JobHistoryWriter: flush failed, retrying in {self.interval}s: {ex}')
+                logging.error(traceback.format_exc())
+                with self.condition:
+                    self.condition.wait_for(lambda: self.closed, self.interval)
+
+    def _restore(self, events: list[tuple[tuple, float]]):
+        """Put events that were not written back in front of the buffer, to be retried with the next flush."""
+        with self.condition:
+            self.buffer = events + self.buffer
+            self._trim_buffer()
+
+    def _trim_buffer(self):
+        """Drop the oldest events beyond the buffer size. Must be called with the condition."""
+        excess = len(self.buffer) - self.buffer_max_size
+        if excess > 0:
+            logging.error(f'JobHistoryWriter: buffer full, dropping the {excess} oldest events: '
+                          f'{[row for row, _ in self.buffer[:excess]]}')
+            HISTORY_DROPPED.labels('buffer_full').inc(excess)
+            del self.buffer[:excess]
+
+    def _is_flush_due(self) -> bool:
+        return len(self.buffer) >= self.max_size or \
+            (bool(self.buffer) and time.monotonic() - self.buffer[0][1] >= self.interval)
+
+    def _write(self, events: list[tuple[tuple, float]]):
+        if self.dbconn.closed:
+            self.dbconn = get_db_connection(autocommit=True)
+        cursor = self.dbconn.cursor()
+        result = psql_execute_values(cursor, '''INSERT INTO JobHistory (job_id, event, time, origin) VALUES %s
+                                                    ON CONFLICT (job_id, event) DO NOTHING;''',
+                                     [row for row, _ in events])
+        logging.debug(f'JobHistoryWriter: wrote {len(events)} events, {result} new')
+        now = time.monotonic()
+        HISTORY_FLUSH_SIZE.observe(len(events))
+        for _, saved_time in events:
+            HISTORY_FLUSH_LAG.observe(now - saved_time)
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+import base64
+import json
+import zlib
+import yaml
+
+# Wire format of the job messages sent by the job scheduler, kept in sync with
+# master/job-scheduler/api/helpers/job_message.py.
+#
+# A message is a JSON envelope: {"version": 1, "encoding": <encoding>, "payload": <payload>}, where
+# the payload is the job message itself for the "json" encoding, or the base64 of its zlib-compressed
+# JSON for the "zlib+json" encoding. Messages without an envelope are legacy YAML.
+JOB_MESSAGE_VERSION = 1
+
+def decode_job_message(message: str) -> dict:
+    try:
+        if not message.lstrip().startswith('{'):
+            # Sent by schedulers older than the envelope, and still found on queues filled by them. Support can be
+            # removed once every scheduler is upgraded and the queues hold no message older than the upgrade.
+            return yaml.safe_load(message)
+        envelope = json.loads(message)
+        version = envelope['version']
+        if version != JOB_MESSAGE_VERSION:
+            raise ValueError(f'Unsupported job message version {version}')
+        match envelope['encoding']:
+            case 'json':
+                return envelope['payload']
+            case 'zlib+json':
+                return json.loads(zlib.decompress(base64.b64decode(envelope['payload'])))
+            case encoding:
+                raise ValueError(f'Unsupported job message encoding {encoding}')
+    except Exception as ex:
+        raise ValueError('Failed to decode job message.') from ex
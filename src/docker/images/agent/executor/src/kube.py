@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import threading
+import time
+import traceback
+from typing import Callable
+
+from kubernetes import client, config, watch
+from kubernetes.client.rest import ApiException
+
+from util import get_env_var_or_default
+
+# Server-side timeout of each watch request, after which the watch is resumed from the last resource version.
+WATCH_TIMEOUT = int(get_env_var_or_default('KUBE_WATCH_TIMEOUT', 300))
+WATCH_MAX_BACKOFF = float(get_env_var_or_default('KUBE_WATCH_MAX_BACKOFF', 60))
+# Number of keep-alive connections used to create jobs; one per concurrent launcher is enough.
+KUBE_CONNECTION_POOL_SIZE = int(get_env_var_or_default('KUBE_CONNECTION_POOL_SIZE',
+                                                       get_env_var_or_default('LAUNCHER_WORKERS', 4)))
+# Label of the nodes whose value is their region, used to place jobs and to measure the capacity of the region.
+REGION_NODE_LABEL = get_env_var_or_default('REGION_NODE_LABEL', 'topology.kubernetes.io/region')
+
+def load_kube_config() -> str:
+    """Load the kubernetes client configuration, and return the namespace to use.
+
+    The kubeconfig file is used if present, as for kubectl, otherwise the in-cluster service account.
+    The namespace can be overridden with KUBE_NAMESPACE.
+    """
+    try:
+        config.load_kube_config()
+        _, context = config.list_kube_config_contexts()
+        namespace = context['context'].get('namespace', 'default')
+    except config.ConfigException:
+        config.load_incluster_config()
+        with open('/var/run/secrets/kubernetes.io/serviceaccount/namespace') as f:
+            namespace = f.read().strip()
+    return get_env_var_or_default('KUBE_NAMESPACE', namespace)
+
+
+class JobCreationError(ValueError):
+    """A job was refused by the kubernetes API, as described by the returned Status object."""
+
+    def __init__(self, job_name: str, status: int, reason: str, message: str):
+        super().__init__(f'Failed to create job {job_name}: {status} {reason}: {message}')
+        self.job_name = job_name
+        self.status = status
+        self.reason = reason
+        self.message = message
+
+    @property
+    def is_permanent(self) -> bool:
+        """Whether the job was refused for itself, e.g. as invalid, rather than for the state of the cluster."""
+        return self.status is not None and 400 <= self.status < 500 and self.status not in (408, 429)
+
+    @staticmethod
+    def from_api_exception(job_name: str, ex: ApiException) -> 'JobCreationError':
+        try:
+            body = json.loads(ex.body)
+            return JobCreationError(job_name, ex.status, body.get('reason', ex.reason), body.get('message', ''))
+        except (TypeError, ValueError):
+            return JobCreationError(job_name, ex.status, ex.reason, ex.body or '')
+
+
+class JobClient:
+    """Create kubernetes jobs over a pool of keep-alive connections."""
+
+    def __init__(self, pool_size: int = KUBE_CONNECTION_POOL_SIZE):
+        self.namespace = load_kube_config()
+        configuration = client.Configuration.get_default_copy()
+        configuration.connection_pool_maxsize = pool_size
+        self.batch_api = client.BatchV1Api(client.ApiClient(configuration))
+
+    def create_job(self, job_config: dict) -> bool:
+        """Create a job, and return False if a job with the same name already exists."""
+        job_name = job_config['metadata']['name']
+        try:
+            self.batch_api.create_namespaced_job(self.namespace, job_config)
+            return True
+        except ApiException as ex:
+            if ex.status == 409:
+                return False
+            raise JobCreationError.from_api_exception(job_name, ex) from ex
+
+
+class JobInformer:
+    """List and then watch the kubernetes jobs that have a given label, and keep the last status of each.
+
+    Statuses are dicts in the same format as `kubectl get job -o json`. `on_status(label_value, status)` is
+    called on every change, with None once a job is deleted, and `on_list(statuses, list_time)` after each
+    full listing, where `list_time` is the `time.monotonic()` at which the listing was requested.
+    The watch resumes from the last seen resource version after disconnects, and lists again only when that
+    version has expired.
+    """
+
+    def __init__(self, label_key: str, on_status: Callable[[str, dict | None], None],
+                 on_list: Callable[[dict[str, dict], float], None]):
+        self.namespace = load_kube_config()
+        self.api_client = client.ApiClient()
+        self.batch_api = client.BatchV1Api(self.api_client)
+        self.label_key = label_key
+        self.on_status = on_status
+        self.on_list = on_list
+        self.lock = threading.Lock()
+        self.statuses: dict[str, dict] = {}
+        self.resource_version: str | None = None
+        self.thread = threading.Thread(target=self._run, name='job-informer', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def get_status(self, label_value: str) -> dict | None:
+        with self.lock:
+            return self.statuses.get(label_value)
+
+    def fetch_status(self, label_value: str) -> dict | None:
+        """Read the status of a job from the API server rather than the watch, or None if it does not exist."""
+        jobs = self.batch_api.list_namespaced_job(self.namespace, label_selector=f'{self.label_key}={label_value}')
+        return self._get_status_json(jobs.items[0]) if jobs.items else None
+
+    def _run(self):
+        backoff = 1.
+        while True:
+            try:
+                if self.resource_version is None:
+                    self._list()
+                self._watch()
+                backoff = 1.
+            except ApiException as ex:
+                if ex.status == 410:
+                    logging.info('JobInformer: resource version expired, listing jobs again ...')
+                    self.resource_version = None
+                    continue
+                logging.error(f'JobInformer: kubernetes API error, retrying in {backoff}s: {ex}')
+                time.sleep(backoff)
+                backoff = min(backoff * 2, WATCH_MAX_BACKOFF)
+            except Exception as ex:
+                logging.error(f'JobInformer: watch failed, retrying in {backoff}s: {ex}')
+                logging.error(traceback.format_exc())
+                time.sleep(backoff)
+                backoff = min(backoff * 2, WATCH_MAX_BACKOFF)
+
+    def _list(self):
+        logging.info(f'JobInformer: listing jobs with label {self.label_key} in namespace {self.namespace} ...')
+        list_time = time.monotonic()
+        jobs = self.batch_api.list_namespaced_job(self.namespace, label_selector=self.label_key)
+        statuses = { job.metadata.labels[self.label_key]: self._get_status_json(job) for job in jobs.items }
+        with self.lock:
+            self.statuses = statuses
+        self.resource_version = jobs.metadata.resource_version
+        logging.info(f'JobInformer: listed {len(statuses)} jobs at resource version {self.resource_version}')
+        self.on_list(statuses, list_time)
+
+    def _watch(self):
+        stream = watch.Watch().stream(self.batch_api.list_namespaced_job, self.namespace,
+                                      label_selector=self.label_key,
+                                      resource_version=self.resource_version,
+                                      allow_watch_bookmarks=True,
+                                      timeout_seconds=WATCH_TIMEOUT)
+        for event in stream:
+            event_type, job = event['type'], event['object']
+            if event_type == 'ERROR':
+                # Older clients pass expired resource versions on as an error event.
+                code = job.get('code') if isinstance(job, dict) else None
+                raise ApiException(status=code, reason=str(job))
+            if event_type == 'BOOKMARK':
+                # Bookmarks only carry a resource version, and recent clients pass them on as raw dicts.
+                self.resource_version = (job['metadata']['resourceVersion'] if isinstance(job, dict)
+                                         else job.metadata.resource_version)
+                continue
+            self.resource_version = job.metadata.resource_version
+            label_value = job.metadata.labels[self.label_key]
+            status = None if event_type == 'DELETED' else self._get_status_json(job)
+            with self.lock:
+                if status is None:
+                    self.statuses.pop(label_value, None)
+                else:
+                    self.statuses[label_value] = status
+            self.on_status(label_value, status)
+
+    def _get_status_json(self, job: client.V1Job) -> dict:
+        return self.api_client.sanitize_for_serialization(job.status) or {}
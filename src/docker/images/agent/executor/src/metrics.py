@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+
+from prometheus_client import Counter, Histogram, start_http_server
+
+from util import get_env_var_or_default
+
+METRICS_PORT = int(get_env_var_or_default('METRICS_PORT', 9100))
+
+HISTORY_FLUSH_SIZE = Histogram('executor_history_flush_size', 'Number of JobHistory events written per flush.',
+                               buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, float('inf')))
+HISTORY_FLUSH_LAG = Histogram('executor_history_flush_lag_seconds', 'Time JobHistory events spent buffered before being written.',
+                              buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., float('inf')))
+HISTORY_DROPPED = Counter('executor_history_dropped', 'JobHistory events dropped, as rejected by the database or beyond the buffer size.',
+                          ['reason'])
+
+def start_metrics_server():
+    """Serve metrics in the Prometheus text format on METRICS_PORT."""
+    start_http_server(METRICS_PORT)
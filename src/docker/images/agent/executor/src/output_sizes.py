@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import logging
+import shlex
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from kubernetes import client
+
+from postgres import get_db_connection, psql_execute_values
+from kube import load_kube_config
+from util import get_env_var_or_default
+
+# Where a job's container writes the sizes of its outputs, reported by kubernetes as its termination message.
+TERMINATION_MESSAGE_PATH = '/dev/termination-log'
+# Time in seconds that a job's container may spend measuring its outputs, after which it reports no sizes.
+OUTPUT_SIZES_TIMEOUT = int(get_env_var_or_default('OUTPUT_SIZES_TIMEOUT', 30))
+
+def wrap_command_with_output_sizes(script: str, output_paths: list[str]) -> str:
+    """Wrap a job's shell script, so that the sizes of its outputs are measured once it exits.
+
+    The script runs in a subshell, so that its exit status is kept even if it calls `exit`. Outputs are
+    only measured if the script succeeded, as only the sizes of completed jobs are recorded, and for at
+    most OUTPUT_SIZES_TIMEOUT seconds. Images without `du` or `timeout` report no sizes.
+    """
+    if not output_paths:
+        return script
+    return '\n'.join([
+        '(',
+        script,
+        ')',
+        'status=$?',
+        'if [ $status -eq 0 ]; then',
+        f'  timeout {OUTPUT_SIZES_TIMEOUT} du -sk {" ".join(shlex.quote(path) for path in output_paths)} > {TERMINATION_MESSAGE_PATH} 2>/dev/null',
+        'fi',
+        'exit $status',
+    ])
+
+def parse_output_sizes(message: str) -> dict[str, int]:
+    """Parse the `du -sk` output of a termination message into sizes in bytes by mount path."""
+    sizes = {}
+    for line in (message or '').splitlines():
+        size_kb, _, path = line.partition('\t')
+        if size_kb.isdigit() and path:
+            sizes[path] = int(size_kb) * 1024
+    return sizes
+
+
+class OutputSizeRecorder:
+    """Record the sizes of the PVCs a completed job wrote to in the DatasetSize table.
+
+    Sizes are read from the termination message of the job's pod, see `wrap_command_with_output_sizes()`,
+    in a background thread, and the scheduler uses them as the data size of the PVCs.
+    """
+
+    def __init__(self, label_key: str):
+        self.label_key = label_key
+        self.namespace = load_kube_config()
+        self.core_api = client.CoreV1Api()
+        self.dbconn = get_db_connection(autocommit=True)
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='output-sizes')
+
+    def record(self, job_id: str):
+        self.executor.submit(self._record, job_id)
+
+    def _record(self, job_id: str):
+        try:
+            sizes = self._get_output_sizes(job_id)
+            if not sizes:
+                return
+            logging.info(f'Output sizes of job {job_id}: {sizes}')
+            if self.dbconn.closed:
+                self.dbconn = get_db_connection(autocommit=True)
+            psql_execute_values(self.dbconn.cursor(), '''INSERT INTO DatasetSize (url, size_bytes, source) VALUES %s
+                                                            ON CONFLICT (url) DO UPDATE
+                                                                SET size_bytes = EXCLUDED.size_bytes,
+                                                                    updated_at = EXCLUDED.updated_at,
+                                                                    source = EXCLUDED.source;''', [
+                (url, size, 'job') for url, size in sizes.items()
+            ])
+        except Exception as ex:
+            logging.error(f'Failed to record output sizes of job {job_id}: {ex}')
+            logging.error(traceback.format_exc())
+
+    def _get_output_sizes(self, job_id: str) -> dict[str, int]:
+        """Get the sizes in bytes of the outputs of a job's pod, by storage URL."""
+        pods = self.core_api.list_namespaced_pod(self.namespace, label_selector=f'{self.label_key}={job_id}').items
+        for pod in pods:
+            if pod.status.phase != 'Succeeded':
+                continue
+            container_status = (pod.status.container_statuses or [None])[0]
+            terminated = container_status.state.terminated if container_status else None
+            path_sizes = parse_output_sizes(terminated.message if terminated else None)
+            claim_names = { volume.name: volume.persistent_volume_claim.claim_name
+                            for volume in pod.spec.volumes or [] if volume.persistent_volume_claim }
+            return { f'pvc://{claim_names[mount.name]}': path_sizes[mount.mount_path]
+                     for mount in pod.spec.containers[0].volume_mounts or []
+                     if mount.name in claim_names and mount.mount_path in path_sizes }
+        return {}
@@ -42,3 +42,12 @@ def psql_execute_list(cursor: psycopg2.extensions.cursor, query: str,
     except psycopg2.Error as ex:
         raise ValueError(f"Failed to execute SQL query: {ex}") from ex
 
+
+def psql_execute_values(cursor: psycopg2.extensions.cursor, query: str, args: Sequence[Any]) -> int:
+    """Execute the psql query with a multi-row VALUES %s list, and return the number of affected rows."""
+    logging.debug('psql_execute_values(): %s (%d rows)', query, len(args))
+    try:
+        psycopg2.extras.execute_values(cursor, query, args)
+        return cursor.rowcount
+    except psycopg2.Error as ex:
+        raise ValueError(f"Failed to execute SQL query: {ex}") from ex
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from postgres import get_db_connection, psql_execute_list, psql_execute_values
+
+@dataclass
+class TrackedJob:
+    job_id: str
+    last_status: str | None
+    # time.monotonic() of the last status change and of the next check.
+    changed_time: float
+    next_check_time: float
+    expected_runtime: float | None
+
+
+def to_datetime(monotonic_time: float) -> datetime:
+    return datetime.fromtimestamp(time.time() + monotonic_time - time.monotonic(), tz=timezone.utc)
+
+def to_monotonic(timestamp: datetime) -> float:
+    return time.monotonic() + timestamp.timestamp() - time.time()
+
+
+class TrackerSnapshot:
+    """The jobs tracked by an agent, persisted in the JobTrackerSnapshot table so that a restart resumes
+    tracking right away. Times are stored as timestamps, and converted from and to the monotonic clock."""
+
+    def __init__(self, origin: str):
+        self.origin = origin
+        self.dbconn = get_db_connection(autocommit=True)
+
+    def load(self) -> list[TrackedJob]:
+        cursor = self._get_cursor()
+        rows = psql_execute_list(cursor, '''SELECT job_id, last_status, changed_time, next_check_time, expected_runtime
+                                                FROM JobTrackerSnapshot
+                                                WHERE origin = %s;''', [self.origin], fetch_result=True)
+        return [TrackedJob(str(job_id), last_status, to_monotonic(changed_time), to_monotonic(next_check_time), expected_runtime)
+                for job_id, last_status, changed_time, next_check_time, expected_runtime in rows]
+
+    def save(self, jobs: list[TrackedJob]):
+        if not jobs:
+            return
+        cursor = self._get_cursor()
+        result = psql_execute_values(cursor, '''INSERT INTO JobTrackerSnapshot (origin, job_id, last_status, changed_time,
+                                                        next_check_time, expected_runtime)
+                                                    VALUES %s
+                                                    ON CONFLICT (origin, job_id) DO UPDATE
+                                                        SET last_status = EXCLUDED.last_status,
+                                                            changed_time = EXCLUDED.changed_time,
+                                                            next_check_time = EXCLUDED.next_check_time,
+                                                            expected_runtime = EXCLUDED.expected_runtime;''', [
+            (self.origin, job.job_id, job.last_status, to_datetime(job.changed_time), to_datetime(job.next_check_time),
+             job.expected_runtime) for job in jobs
+        ])
+        logging.debug(f'TrackerSnapshot: saved {result} jobs')
+
+    def delete(self, job_ids: list[str]):
+        if not job_ids:
+            return
+        cursor = self._get_cursor()
+        result = psql_execute_list(cursor, 'DELETE FROM JobTrackerSnapshot WHERE origin = %s AND job_id IN %s;',
+                                   (self.origin, tuple(job_ids)))
+        logging.debug(f'TrackerSnapshot: deleted {result} jobs')
+
+    def _get_cursor(self):
+        if self.dbconn.closed:
+            self.dbconn = get_db_connection(autocommit=True)
+        return self.dbconn.cursor()
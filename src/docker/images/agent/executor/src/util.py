@@ -13,6 +13,9 @@ from threading import Timer
 def get_env_var(key):
     return os.environ[key]
 
+def get_env_var_or_default(key, default):
+    return os.environ.get(key, default)
+
 def load_yaml(path):
     """Load a YAML file."""
     with open(path, 'r') as f:
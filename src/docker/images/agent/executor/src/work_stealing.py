@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import logging
+import traceback
+from datetime import datetime, timezone
+from typing import Callable
+import pika
+from kubernetes import client
+from kubernetes.utils import parse_quantity
+
+from util import RepeatTimer, get_env_var, get_env_var_or_default, get_dict_value_or_default
+from postgres import get_db_connection, psql_execute_list
+from job_message import decode_job_message
+from kube import load_kube_config
+from consumer import is_rejected
+
+REGION = get_env_var('REGION')
+# Opt-in: let this agent take jobs from the queues of other regions while it is idle.
+WORK_STEALING = get_env_var_or_default('WORK_STEALING', 'false').lower() in ('1', 'true', 'yes')
+STEAL_FROM_REGIONS = [region for region in get_env_var_or_default('STEAL_FROM_REGIONS', get_env_var_or_default('REGIONS', '')).split(':')
+                      if region and region != REGION]
+STEAL_INTERVAL = float(get_env_var_or_default('STEAL_INTERVAL', 10))
+# Largest relative increase of a job's estimated emission, e.g. 0.1 for 10%, at which it may be stolen.
+STEAL_MAX_CARBON_PENALTY = float(get_env_var_or_default('STEAL_MAX_CARBON_PENALTY', 0.1))
+# Only volumes that can be mounted from nodes of any region can follow a stolen job.
+SHARED_ACCESS_MODES = {'ReadWriteMany', 'ReadOnlyMany'}
+
+class WorkStealer:
+    """Take a job from the queue of another region at every interval, while this region is idle.
+
+    The region is idle if no message of its own queue is being launched and all its tracked jobs are
+    running, and a job is only taken if the last heartbeat shows enough free resources for it.
+    Queues are tried by decreasing depth; the head message of a queue is put back unless its estimated
+    emission here is at most STEAL_MAX_CARBON_PENALTY worse than in its own region, and all its volumes
+    can be mounted from this region. Jobs without an estimate were not placed for their carbon, and can
+    be stolen. Stolen jobs are recorded as 'Stolen' in JobHistory and in the JobSteal table.
+    """
+
+    def __init__(self, handle_request: Callable[[dict], None], history_writer, job_tracker, consumer, heartbeat,
+                 regions: list[str] = STEAL_FROM_REGIONS, interval: float = STEAL_INTERVAL,
+                 max_carbon_penalty: float = STEAL_MAX_CARBON_PENALTY):
+        self.handle_request = handle_request
+        self.history_writer = history_writer
+        self.job_tracker = job_tracker
+        self.consumer = consumer
+        self.heartbeat = heartbeat
+        self.regions = regions
+        self.max_carbon_penalty = max_carbon_penalty
+        self.broker_url = get_env_var('BROKER_URL')
+        self.queue_prefix = get_env_var('QUEUE_PERFIX')
+        self.namespace = load_kube_config()
+        self.core_api = client.CoreV1Api()
+        self.dbconn = get_db_connection(autocommit=True)
+        self.connection: pika.BlockingConnection = None
+        self.channel = None
+        self.timer = RepeatTimer(interval, self._steal)
+        self.timer.daemon = True
+
+    def start(self):
+        logging.info(f'Work stealing from regions {self.regions} enabled')
+        self.timer.start()
+
+    def _steal(self):
+        try:
+            if not self._is_idle():
+                return
+            for region in self._get_regions_by_queue_depth():
+                if self._steal_from(region):
+                    return
+        except pika.exceptions.AMQPError as ex:
+            logging.error(f'WorkStealer: broker error, reconnecting at the next attempt: {ex!r}')
+            self._close()
+        except Exception as ex:
+            logging.error(f'WorkStealer: {ex}')
+            logging.error(traceback.format_exc())
+
+    def _is_idle(self) -> bool:
+        _, pending_jobs = self.job_tracker.get_job_counts()
+        return self.consumer.in_flight == 0 and pending_jobs == 0 and self.heartbeat.free_resources is not None
+
+    def _get_regions_by_queue_depth(self) -> list[str]:
+        channel = self._get_channel()
+        depths = { region: channel.queue_declare(queue=self._get_queue_name(region), passive=True).method.message_count
+                   for region in self.regions }
+        return sorted((region for region, depth in depths.items() if depth > 0), key=lambda region: -depths[region])
+
+    def _steal_from(self, region: str) -> bool:
+        """Take the head message of a region's queue if its job may run here, and return whether it was taken."""
+        channel = self._get_channel()
+        method, _, body = channel.basic_get(self._get_queue_name(region))
+        if method is None:
+            return False
+        try:
+            request = decode_job_message(body.decode())
+            job_id = request['job_id']
+        except Exception as ex:
+            logging.warning(f'WorkStealer: leaving undecodable message to {region}: {ex}')
+            channel.basic_nack(method.delivery_tag, requeue=True)
+            return False
+        carbon_penalty = self._get_carbon_penalty(request, region)
+        try:
+            refusal = self._get_refusal_reason(request, carbon_penalty)
+        except Exception:
+            channel.basic_nack(method.delivery_tag, requeue=True)
+            raise
+        if refusal is not None:
+            logging.info(f'WorkStealer: not stealing job {job_id} from {region}: {refusal}')
+            channel.basic_nack(method.delivery_tag, requeue=True)
+            return False
+
+        logging.info(f'WorkStealer: stealing job {job_id} from {region}, carbon penalty {carbon_penalty}')
+        try:
+            self._record_steal(job_id, region, carbon_penalty)
+        except Exception:
+            channel.basic_nack(method.delivery_tag, requeue=True)
+            raise
+        try:
+            self.handle_request(request)
+            channel.basic_ack(method.delivery_tag)
+        except Exception as ex:
+            # Left to the region it was stolen from, unless it would fail there too.
+            requeue = not is_rejected(ex)
+            logging.error(f'WorkStealer: failed to launch stolen job {job_id}, {"requeuing" if requeue else "rejecting"} it: {ex}')
+            logging.error(traceback.format_exc())
+            channel.basic_nack(method.delivery_tag, requeue=requeue)
+        return True
+
+    def _get_carbon_penalty(self, request: dict, region: str) -> float | None:
+        emissions = request.get('emissions')
+        if not emissions or region not in emissions or REGION not in emissions:
+            return None
+        if emissions[region] <= 0:
+            return 0. if emissions[REGION] <= 0 else float('inf')
+        return (emissions[REGION] - emissions[region]) / emissions[region]
+
+    def _get_refusal_reason(self, request: dict, carbon_penalty: float | None) -> str | None:
+        if carbon_penalty is not None and carbon_penalty > self.max_carbon_penalty:
+            return f'carbon penalty {carbon_penalty:.3f} exceeds {self.max_carbon_penalty}'
+        free_cpu, free_memory = self.heartbeat.free_resources
+        cpu = float(parse_quantity(get_dict_value_or_default(request, 'resources.requests.cpu', '1')))
+        memory = int(parse_quantity(get_dict_value_or_default(request, 'resources.requests.memory', '256Mi')))
+        if cpu > free_cpu or memory > free_memory:
+            return f'not enough free resources ({free_cpu} CPU, {free_memory} bytes of memory)'
+        for mount_path, storage in (request.get('inputs', {}) | request.get('outputs', {})).items():
+            if storage['storage_type'] != 'pvc':
+                return f'{storage["storage_type"]} volume at {mount_path} is not supported'
+            [pvc_name] = storage['paths']
+            pvc = self.core_api.read_namespaced_persistent_volume_claim(pvc_name, self.namespace)
+            if not SHARED_ACCESS_MODES.intersection(pvc.spec.access_modes or []):
+                return f'PVC {pvc_name} cannot be mounted from another region'
+        return None
+
+    def _record_steal(self, job_id: str, region: str, carbon_penalty: float | None):
+        now = datetime.now(timezone.utc)
+        if self.dbconn.closed:
+            self.dbconn = get_db_connection(autocommit=True)
+        cursor = self.dbconn.cursor()
+        psql_execute_list(cursor, '''INSERT INTO JobSteal (job_id, from_region, to_region, carbon_penalty, time)
+                                        VALUES (%s, %s, %s, %s, %s)
+                                        ON CONFLICT (job_id) DO NOTHING;''', [
+            job_id, region, REGION, carbon_penalty, now
+        ])
+        self.history_writer.save(job_id, 'Stolen', now)
+
+    def _get_queue_name(self, region: str) -> str:
+        return f'{self.queue_prefix}.{region}'
+
+    def _get_channel(self):
+        if self.connection is None or not self.connection.is_open or not self.channel.is_open:
+            self._close()
+            self.connection = pika.BlockingConnection(pika.URLParameters(self.broker_url))
+            self.channel = self.connection.channel()
+        return self.channel
+
+    def _close(self):
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except pika.exceptions.AMQPError:
+            pass
+        self.connection = None
+        self.channel = None
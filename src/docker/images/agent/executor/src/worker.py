@@ -1,58 +1,46 @@
 #!/usr/bin/env -S python3 -u
 
 import os
+import copy
 import yaml
 import logging
 import json
-from shlex import quote
 import traceback
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone
 import threading
+import time
+import heapq
 
 from util import *
 from postgres import *
+from job_message import decode_job_message
+from kube import JobInformer, JobClient, JobCreationError, REGION_NODE_LABEL
+from job_history import JobHistoryWriter
+from tracker_snapshot import TrackerSnapshot, TrackedJob
+from output_sizes import OutputSizeRecorder, wrap_command_with_output_sizes
+from metrics import start_metrics_server
+from consumer import JobConsumer, MessageRejected, is_rejected
+from heartbeat import RegionHeartbeat
+from work_stealing import WorkStealer, WORK_STEALING
 
 APP_ROLE = get_env_var('APP_ROLE')
 REGION = get_env_var('REGION')
-
-def save_job_history(conn, job_id: str, event: str, timestamp: datetime):
-    logging.info(f'Saving job history with job_id={job_id}, event={event}, timestamp={timestamp}')
-    try:
-        cursor = conn.cursor()
-        result = psql_execute_list(cursor,
-                                    '''INSERT INTO JobHistory (job_id, event, time, origin) VALUES (%s, %s, %s, %s)
-                                            ON CONFLICT(job_id, event) DO NOTHING;''',
-                                    [job_id, event, timestamp, APP_ROLE])
-        logging.debug(result)
-    except Exception as ex:
-        raise ValueError(f'Failed to save job history (job_id={job_id}).') from ex
+# Tracked jobs are also checked directly, in case the watch missed a change. A job is checked after a
+# quarter of the time since its last change, within bounds, and close to its expected end when the
+# runtime of its image is known. At most POLL_BUDGET_PER_TICK jobs are checked per tick.
+POLL_TICK_INTERVAL = float(get_env_var_or_default('POLL_TICK_INTERVAL', 5))
+POLL_BUDGET_PER_TICK = int(get_env_var_or_default('POLL_BUDGET_PER_TICK', 20))
+POLL_MIN_INTERVAL = float(get_env_var_or_default('POLL_MIN_INTERVAL', 30))
+POLL_MAX_INTERVAL = float(get_env_var_or_default('POLL_MAX_INTERVAL', 3600))
+POLL_AGE_FACTOR = float(get_env_var_or_default('POLL_AGE_FACTOR', 0.25))
+# Expected runtimes are the median of the last completed jobs of the same image, refreshed after the TTL.
+EXPECTED_RUNTIME_SAMPLES = int(get_env_var_or_default('EXPECTED_RUNTIME_SAMPLES', 50))
+EXPECTED_RUNTIME_TTL = float(get_env_var_or_default('EXPECTED_RUNTIME_TTL', 3600))
 
 
 class KubeHelper:
     """Helper tools with kubernetes."""
 
-    @staticmethod
-    def create_job(job_config):
-        logging.info('Creating job using kubectl ...')
-        try:
-            job_yaml = yaml.dump(job_config)
-            print(run_command('kubectl create -f -', job_yaml, print_command=True))
-        except Exception as ex:
-            raise ValueError(f'Failed to create job: {ex}') from ex
-
-
-    @staticmethod
-    def get_job_status_json(job_id):
-        try:
-            result = run_command(f'kubectl get job -o=jsonpath='
-                                    f'{{.items[?(@.metadata.labels.job-uuid=="{quote(job_id)}")].status}}',
-                                    print_command=False)
-            return json.loads(result) if result else None
-        except Exception as ex:
-            if 'Error from server (NotFound)' in str(ex):
-                return None
-            raise ValueError(f'Failed to get job status json: {ex}') from ex
-
     @staticmethod
     def get_last_event_time_from_status_json(status_json, event_predicate = lambda _: True):
         try:
@@ -66,42 +54,48 @@ class KubeHelper:
 class JobLauncher:
     """Launch a job in kubernetes and record metadata."""
 
-    def __init__(self):
+    def __init__(self, history_writer: JobHistoryWriter):
         self.dbconn = get_db_connection(autocommit=True)
+        self.history_writer = history_writer
+        self.job_client = JobClient()
+        # Parsed once, and copied for every job.
+        self.job_template = load_yaml(os.path.join(
+            os.path.dirname(os.path.realpath(__file__)),
+            'job.template.yaml'))
 
     def __del__(self):
         self.dbconn.close()
 
     def launch_job(self, request):
+        """Create the job of a request. Raises MessageRejected, and marks the job CreateFailed, if it can never be created."""
         job_id = request['job_id']
-        save_job_history(self.dbconn, job_id, 'Dequeued', datetime.now(timezone.utc))
+        self.history_writer.save(job_id, 'Dequeued', datetime.now(timezone.utc))
         try:
             job_config = self._create_job_config(request)
             self._save_job_config(job_id, job_config)
             self._create_job(job_id, job_config)
-        except Exception:
-            save_job_history(self.dbconn, job_id, 'CreateFailed', datetime.now(timezone.utc))
+        except Exception as ex:
+            # Other failures are retried with the redelivered message, so the job is not final yet.
+            if is_rejected(ex):
+                self.history_writer.save(job_id, 'CreateFailed', datetime.now(timezone.utc), sync=True)
             raise
-        save_job_history(self.dbconn, job_id, 'Created', datetime.now(timezone.utc))
-
-    def _get_job_template(self):
-        return load_yaml(os.path.join(
-            os.path.dirname(os.path.realpath(__file__)),
-            'job.template.yaml'))
+        self.history_writer.save(job_id, 'KubeCreated', datetime.now(timezone.utc))
 
     def _create_job_config(self, request):
         logging.info('Creating job config ...')
         try:
             job_id = request['job_id']
             job_name = request['name']
-            job_config = self._get_job_template()
+            job_config = copy.deepcopy(self.job_template)
             job_config['metadata']['name'] = job_name
             job_config['metadata']['labels']['job-uuid'] = job_id
+            # Pods are labeled too, so that the output sizes can be read from the pod of a job.
+            job_config['spec']['template']['metadata'] = { 'labels': { 'job-uuid': job_id } }
             container = job_config['spec']['template']['spec']['containers'][0]
             container['name'] = f'{job_name}-container1'
             container['image'] = request['image']
             container['command'] = [ 'sh', '-c' ]
-            container['args'] = [ '\n'.join(request['command']) ]
+            container['args'] = [ wrap_command_with_output_sizes('\n'.join(request['command']), list(request['outputs'].keys())) ]
             container['resources']['requests']['cpu'] = get_dict_value_or_default(request, 'resources.requests.cpu', '1')
             container['resources']['requests']['memory'] = get_dict_value_or_default(request, 'resources.requests.memory', '256Mi')
             container['resources']['limits']['cpu'] = get_dict_value_or_default(request, 'resources.limits.cpu', '1')
@@ -134,16 +128,20 @@ class JobLauncher:
             container['volumeMounts'] = container_volume_mounts
             job_config['spec']['template']['spec']['volumes'] = all_volumes
             job_config['spec']['template']['spec']['containers'][0] = container
-            job_config['spec']['template']['spec']['affinity']['nodeAffinity']['requiredDuringSchedulingIgnoredDuringExecution']['nodeSelectorTerms'][0]['matchExpressions'][0]['values'] = [ REGION ]
+            region_expression = job_config['spec']['template']['spec']['affinity']['nodeAffinity']['requiredDuringSchedulingIgnoredDuringExecution']['nodeSelectorTerms'][0]['matchExpressions'][0]
+            region_expression['key'] = REGION_NODE_LABEL
+            region_expression['values'] = [ REGION ]
             return job_config
         except Exception as ex:
-            raise ValueError(f'Failed to create job config: {ex}') from ex
+            raise MessageRejected(f'Failed to create job config: {ex}') from ex
 
     def _save_job_config(self, job_id, job_config):
         logging.info(f'Saving job config for {job_id}')
         try:
             cursor = self.dbconn.cursor()
-            result = psql_execute_list(cursor, 'INSERT INTO JobConfig (job_id, job_config) VALUES (%s, %s)', [
+            # A redelivered message may find the config already saved.
+            result = psql_execute_list(cursor, '''INSERT INTO JobConfig (job_id, job_config) VALUES (%s, %s)
+                                                    ON CONFLICT (job_id) DO NOTHING;''', [
                 job_id, Json(job_config)
             ])
             logging.debug(result)
@@ -151,13 +149,27 @@ class JobLauncher:
             raise ValueError(f'Failed to save job config (job_id={job_id}).') from ex
 
     def _create_job(self, job_id, job_config):
+        logging.info(f'Creating job {job_id} ...')
         try:
-            KubeHelper.create_job(job_config)
-        except Exception as ex:
-            raise ValueError(f'Failed to create job {job_id}: {ex}') from ex
+            created = self.job_client.create_job(job_config)
+        except JobCreationError as ex:
+            if ex.is_permanent:
+                raise MessageRejected(str(ex)) from ex
+            raise
+        # Job names are unique, so an existing job was created for a message that got redelivered.
+        if not created:
+            logging.warning(f'Job {job_config["metadata"]["name"]} already exists, skipping creation.')
 
 class JobTracker:
-    """Track jobs that are pending and periodically update their status in database."""
+    """Track jobs that are pending, and update their status in database as kubernetes reports changes.
+
+    Changes are received from a watch. As a safety net, every tracked job is also checked on its own
+    schedule, kept in a heap by next check time, see POLL_AGE_FACTOR.
+
+    The tracked jobs are kept in a snapshot in database, saved at every poll tick and when a job starts
+    to be tracked, from which the tracker resumes after a restart. The unfinished jobs of the agent that
+    are missing from it, e.g. launched right before the restart, are then tracked too.
+    """
 
     JOB_FINAL_STATES = [
         'Completed',
@@ -166,96 +178,248 @@ class JobTracker:
         'CreateFailed',
     ]
 
-    def __init__(self, update_frequency = timedelta(minutes=1)):
+    def __init__(self, history_writer: JobHistoryWriter, output_size_recorder: OutputSizeRecorder = None):
         self.dbconn = get_db_connection(autocommit=True)
-        self.tracked_job_ids: list[str] = set()
+        self.history_writer = history_writer
+        self.output_size_recorder = output_size_recorder
+        self.update_lock = threading.Lock()
         self.m_job_last_status: dict[str, str] = {}
+        # Tracked job id -> time.monotonic() at which it started to be tracked.
+        self.m_job_tracked_time: dict[str, float] = {}
+        # Tracked job id -> time.monotonic() of its last status change.
+        self.m_job_changed_time: dict[str, float] = {}
+        # Tracked job id -> expected runtime in seconds, if known.
+        self.m_job_expected_runtime: dict[str, float | None] = {}
+        # Heap of (next check time, job id). Entries that no longer match m_job_next_check are skipped.
+        self.check_heap: list[tuple[float, str]] = []
+        self.m_job_next_check: dict[str, float] = {}
+        # Image -> (median runtime in seconds or None, time.monotonic() at which it was computed)
+        self.expected_runtimes: dict[str, tuple[float | None, float]] = {}
+        self.snapshot = TrackerSnapshot(APP_ROLE)
+        # Jobs to save to, and to delete from the snapshot at the next tick.
+        self.snapshot_changed: set[str] = set()
+        self.snapshot_removed: set[str] = set()
+        self._load_snapshot()
         self._add_unfinished_jobs()
 
-        self.update_lock = threading.Lock()
-        self.update_daemon = RepeatTimer(update_frequency.total_seconds(), self._update_all_job_status)
-        self.update_in_progress = False
-        self.update_daemon.start()
+        self.informer = JobInformer('job-uuid', self._on_job_status, self._on_jobs_listed)
+        self.informer.start()
+        self.poll_daemon = RepeatTimer(POLL_TICK_INTERVAL, self._poll_due_jobs)
+        self.poll_daemon.daemon = True
+        self.poll_daemon.start()
 
     def __del__(self):
         self.dbconn.close()
 
-    def track_job(self, job_id):
+    def track_job(self, job_id, image: str = None):
         logging.info(f'Tracking job {job_id} ...')
-        status = self._update_job_status(job_id)
-        if status in JobTracker.JOB_FINAL_STATES:
+        expected_runtime = self._get_expected_runtime(image)
+        with self.update_lock:
+            self._add_job(job_id, expected_runtime)
+            # The watch may have seen the job before it was tracked.
+            status = self.informer.get_status(job_id)
+            if status is not None:
+                self._update_job_status(job_id, status)
+            # Saved right away, so that the job is still tracked if the agent restarts before the next tick.
+            if job_id in self.m_job_last_status:
+                try:
+                    self.snapshot.save([self._get_tracked_job(job_id)])
+                    self.snapshot_changed.discard(job_id)
+                except Exception as ex:
+                    logging.error(f'JobTracker: failed to save job {job_id} to snapshot: {ex}')
+
+    def get_job_counts(self) -> tuple[int, int]:
+        """Get the number of tracked jobs that are running, and that are not yet running."""
+        with self.update_lock:
+            running = sum(1 for status in self.m_job_last_status.values() if status == 'Started')
+            return running, len(self.m_job_last_status) - running
+
+    def _add_job(self, job_id, expected_runtime: float | None, last_status: str = None):
+        now = time.monotonic()
+        self.m_job_last_status[job_id] = last_status
+        self.m_job_tracked_time[job_id] = now
+        self.m_job_changed_time[job_id] = now
+        self.m_job_expected_runtime[job_id] = expected_runtime
+        self._schedule_check(job_id)
+
+    def _restore_job(self, job: TrackedJob):
+        self.m_job_last_status[job.job_id] = job.last_status
+        self.m_job_tracked_time[job.job_id] = time.monotonic()
+        self.m_job_changed_time[job.job_id] = job.changed_time
+        self.m_job_expected_runtime[job.job_id] = job.expected_runtime
+        self.m_job_next_check[job.job_id] = job.next_check_time
+        heapq.heappush(self.check_heap, (job.next_check_time, job.job_id))
+
+    def _remove_job(self, job_id):
+        logging.info(f'Removing job {job_id} from tracked list ...')
+        for m in (self.m_job_last_status, self.m_job_tracked_time, self.m_job_changed_time,
+                  self.m_job_expected_runtime, self.m_job_next_check):
+            m.pop(job_id, None)
+        self.snapshot_changed.discard(job_id)
+        self.snapshot_removed.add(job_id)
+
+    def _get_tracked_job(self, job_id) -> TrackedJob:
+        return TrackedJob(job_id, self.m_job_last_status[job_id], self.m_job_changed_time[job_id],
+                          self.m_job_next_check[job_id], self.m_job_expected_runtime[job_id])
+
+    def _load_snapshot(self):
+        """Resume tracking the jobs of the snapshot, with their last status and schedule."""
+        logging.info('Loading tracked jobs from snapshot ...')
+        try:
+            tracked_jobs = self.snapshot.load()
+        except Exception as ex:
+            logging.error(f'Failed to load tracked jobs from snapshot, ignoring ...: {ex}')
             return
+        for job in tracked_jobs:
+            self._restore_job(job)
+        logging.info(f'Loaded {len(tracked_jobs)} tracked jobs.')
+
+    def _save_snapshot(self):
         with self.update_lock:
-            self.tracked_job_ids.add(job_id)
-            self.m_job_last_status[job_id] = status
+            changed_jobs = [self._get_tracked_job(job_id) for job_id in self.snapshot_changed]
+            removed_job_ids = list(self.snapshot_removed)
+            self.snapshot_changed.clear()
+            self.snapshot_removed.clear()
+        try:
+            self.snapshot.save(changed_jobs)
+            self.snapshot.delete(removed_job_ids)
+        except Exception as ex:
+            logging.error(f'JobTracker: failed to save snapshot, retrying at the next tick: {ex}')
+            with self.update_lock:
+                self.snapshot_changed.update(job.job_id for job in changed_jobs if job.job_id in self.m_job_last_status)
+                self.snapshot_removed.update(job_id for job_id in removed_job_ids if job_id not in self.m_job_last_status)
 
     def _add_unfinished_jobs(self):
+        """Track the unfinished jobs of this agent that are not tracked yet, as those missing from the snapshot."""
         logging.info('Adding unfinished jobs from database ...')
-        unfinished_job_ids = self._get_unfinished_job_ids()
-        for job_id in unfinished_job_ids:
-            self.tracked_job_ids.add(job_id)
-            self.m_job_last_status[job_id] = None
-        logging.info(f'Added {len(unfinished_job_ids)} unfinished jobs.')
+        unfinished_jobs = [job for job in self._get_unfinished_jobs() if job[0] not in self.m_job_last_status]
+        for job_id, image, event in unfinished_jobs:
+            self._add_job(job_id, self._get_expected_runtime(image), event)
+        logging.info(f'Added {len(unfinished_jobs)} unfinished jobs that were not tracked.')
 
-    def _get_unfinished_job_ids(self) -> list[str]:
+    def _get_unfinished_jobs(self) -> list[tuple[str, str, str]]:
+        """Get the (job id, image, last event) of the unfinished jobs of this agent."""
         try:
             cursor = self.dbconn.cursor()
             # NOTE: IN-list must be a tuple of tuples for parameters due to psycopg2 conversion.
             #   Use cursor.mogrify(query, args) to verify generated SQL query.
             # Source: https://stackoverflow.com/questions/28117576/python-psycopg2-where-in-statement
-            results = psql_execute_list(cursor, '''SELECT job_id
-                    FROM jobhistorylastevent
-                    WHERE origin = %s AND event NOT IN %s;''',
+            results = psql_execute_list(cursor, '''SELECT state.job_id, request.image, state.event
+                    FROM JobCurrentState state
+                        INNER JOIN JobRequest request ON request.job_id = state.job_id
+                    WHERE state.origin = %s AND state.event NOT IN %s;''',
                 (APP_ROLE, tuple(JobTracker.JOB_FINAL_STATES),),
                 fetch_result=True)
-            return [row[0] for row in results]  # one column per row
+            return [(str(job_id), image, event) for job_id, image, event in results]
         except Exception as ex:
             logging.error(f'Failed to retrieve unfinished jobs, ignoring ...: {ex}')
             logging.error(traceback.format_exc())
             return []
 
-    def _update_job_status(self, job_id, last_event = None):
+    def _get_expected_runtime(self, image: str | None) -> float | None:
+        if image is None:
+            return None
+        cached = self.expected_runtimes.get(image)
+        if cached is not None and time.monotonic() - cached[1] < EXPECTED_RUNTIME_TTL:
+            return cached[0]
         try:
-            logging.info(f'Updating job status of {job_id} ...')
-            status_json = KubeHelper.get_job_status_json(job_id)
-            return self._save_job_status_json(job_id, status_json, last_event)
+            cursor = self.dbconn.cursor()
+            runtime = psql_execute_scalar(cursor, '''SELECT percentile_cont(0.5) WITHIN GROUP (ORDER BY runtime) FROM (
+                    SELECT extract(epoch FROM completed.time - started.time) AS runtime
+                    FROM JobRequest request
+                        INNER JOIN JobHistory started ON started.job_id = request.job_id AND started.event = 'Started'
+                        INNER JOIN JobHistory completed ON completed.job_id = request.job_id AND completed.event = 'Completed'
+                    WHERE request.image = %s
+                    ORDER BY completed.time DESC
+                    LIMIT %s) runtimes;''', [image, EXPECTED_RUNTIME_SAMPLES])
         except Exception as ex:
-            raise ValueError(f'Failed to update job status of {job_id}: {ex}') from ex
-
-    def _update_all_job_status(self):
-        if self.update_in_progress:
-            logging.info('JobTracker daemon: skipping as update is already running ...')
-            return
-        self.update_in_progress = True
-        logging.info('JobTracker daemon: updating all tracked jobs\' status ...')
-        tracked_job_ids = self.tracked_job_ids.copy()
-        m_job_last_status = self.m_job_last_status.copy()
-        m_job_updated_status = {}
-        jobs_to_remove = set()
-        logging.info(f'# of jobs to check: {len(tracked_job_ids)}')
-        for job_id in tracked_job_ids:
+            logging.error(f'Failed to get expected runtime of image {image}: {ex}')
+            runtime = None
+        runtime = float(runtime) if runtime is not None else None
+        self.expected_runtimes[image] = (runtime, time.monotonic())
+        return runtime
+
+    def _get_check_interval(self, job_id, now) -> float:
+        since_change = now - self.m_job_changed_time[job_id]
+        expected_runtime = self.m_job_expected_runtime[job_id]
+        if self.m_job_last_status[job_id] == 'Started' and expected_runtime is not None:
+            until_expected_end = expected_runtime - since_change
+            if until_expected_end > 0:
+                return min(max(until_expected_end, POLL_MIN_INTERVAL), POLL_MAX_INTERVAL)
+            # Overdue jobs are checked as if they had changed at their expected end.
+            since_change = -until_expected_end
+        return min(max(since_change * POLL_AGE_FACTOR, POLL_MIN_INTERVAL), POLL_MAX_INTERVAL)
+
+    def _schedule_check(self, job_id):
+        now = time.monotonic()
+        next_check = now + self._get_check_interval(job_id, now)
+        self.m_job_next_check[job_id] = next_check
+        heapq.heappush(self.check_heap, (next_check, job_id))
+        self.snapshot_changed.add(job_id)
+
+    def _poll_due_jobs(self):
+        self._check_due_jobs()
+        self._save_snapshot()
+
+    def _check_due_jobs(self):
+        now = time.monotonic()
+        due_job_ids = []
+        with self.update_lock:
+            while self.check_heap and self.check_heap[0][0] <= now and len(due_job_ids) < POLL_BUDGET_PER_TICK:
+                next_check, job_id = heapq.heappop(self.check_heap)
+                if self.m_job_next_check.get(job_id) == next_check:
+                    due_job_ids.append(job_id)
+        if due_job_ids:
+            logging.info(f'JobTracker: checking {len(due_job_ids)} due jobs, {len(self.check_heap)} scheduled')
+        for job_id in due_job_ids:
             try:
-                last_status = m_job_last_status[job_id]
-                status = self._update_job_status(job_id, last_status)
-                if status in JobTracker.JOB_FINAL_STATES:
-                    jobs_to_remove.add(job_id)
-                if status != last_status:
-                    m_job_updated_status[job_id] = status
+                status = self.informer.fetch_status(job_id)
             except Exception as ex:
-                logging.error(f'JobTracker daemon: {ex}')
-                logging.error(traceback.format_exc())
-
-        logging.info('JobTracker daemon: updating tracked job list ...')
-        if jobs_to_remove or m_job_updated_status:
+                logging.error(f'JobTracker: failed to check job {job_id}: {ex}')
+                with self.update_lock:
+                    if job_id in self.m_job_last_status:
+                        self._schedule_check(job_id)
+                continue
             with self.update_lock:
-                self.m_job_last_status.update(m_job_updated_status)
-                for job_id in jobs_to_remove:
-                    logging.info(f'Removing job {job_id} from tracked list ...')
-                    self.tracked_job_ids.remove(job_id)
-                    self.m_job_last_status.pop(job_id)
+                if job_id in self.m_job_last_status:
+                    self._update_job_status(job_id, status)
+                if job_id in self.m_job_last_status:
+                    self._schedule_check(job_id)
 
-        logging.info('JobTracker daemon: update completed')
-        self.update_in_progress = False
+    def _on_job_status(self, job_id, status):
+        with self.update_lock:
+            if job_id in self.m_job_last_status:
+                self._update_job_status(job_id, status)
+
+    def _on_jobs_listed(self, statuses, list_time):
+        """Reconcile all tracked jobs with a full listing, as changes may have been missed while not watching."""
+        logging.info(f'JobTracker: reconciling {len(self.m_job_last_status)} tracked jobs ...')
+        with self.update_lock:
+            for job_id in list(self.m_job_last_status):
+                if job_id in statuses:
+                    self._update_job_status(job_id, statuses[job_id])
+                elif self.m_job_tracked_time[job_id] < list_time:
+                    # Jobs tracked after the listing was requested may just not be listed yet.
+                    self._update_job_status(job_id, None)
+
+    def _update_job_status(self, job_id, status_json):
+        """Save the status of a tracked job, and stop tracking it once final. Must be called with the update lock."""
+        try:
+            last_status = self.m_job_last_status[job_id]
+            status = self._save_job_status_json(job_id, status_json, last_status)
+        except Exception as ex:
+            logging.error(f'JobTracker: failed to update job status of {job_id}: {ex}')
+            logging.error(traceback.format_exc())
+            return
+        if status in JobTracker.JOB_FINAL_STATES:
+            self._remove_job(job_id)
+            if status == 'Completed' and self.output_size_recorder is not None:
+                self.output_size_recorder.record(job_id)
+        elif status != last_status:
+            self.m_job_last_status[job_id] = status
+            self.m_job_changed_time[job_id] = time.monotonic()
+            # Jobs that just changed are checked again soon.
+            self._schedule_check(job_id)
 
     def _save_job_status_json(self, job_id, status, last_event):
         try:
@@ -278,43 +442,50 @@ class JobTracker:
                 timestamp = datetime.now(tz=timezone.utc)
             logging.info(f'Job status of {job_id}: {event} at {timestamp}')
             if event != last_event:
-                save_job_history(self.dbconn, job_id, event, timestamp)
+                # Final events are written right away, as the job is no longer tracked afterwards.
+                self.history_writer.save(job_id, event, timestamp, sync=event in JobTracker.JOB_FINAL_STATES)
             return event
         except Exception as ex:
             raise ValueError(f'Failed to save job status. job_id={job_id}, status={status}.') from ex
 
-def get_job_request_from_queue():
+def handle_job_message(job_launcher: JobLauncher, job_tracker: JobTracker, message: str):
+    """Launch and track the job of a queue message. Raises if the job could not be created."""
     try:
-        logging.info('Waiting for new job request ...')
-        message = run_command('./get_message_from_queue.sh')
-    except Exception as ex:
-        logging.error('Failed to get job request: %s', ex)
-        logging.error(traceback.format_exc())
-        return None
-
+        request = decode_job_message(message)
+    except ValueError as ex:
+        logging.error('Failed to decode queue message:\n%s', message)
+        raise MessageRejected('Failed to decode queue message.') from ex
+    logging.info(f'Received message:\n%s', yaml.safe_dump(request, default_flow_style=False))
+    if request is None or 'job_id' not in request:
+        raise MessageRejected(f'Empty request or missing job_id in request: {request}')
+    handle_job_request(job_launcher, job_tracker, request)
+
+def give_up_job_message(history_writer: JobHistoryWriter, message: str):
+    """Mark the job of a queue message that failed too many times as CreateFailed, before the message is dropped."""
+    request = decode_job_message(message)
+    history_writer.save(request['job_id'], 'CreateFailed', datetime.now(timezone.utc), sync=True)
+
+def handle_job_request(job_launcher: JobLauncher, job_tracker: JobTracker, request: dict):
+    job_id = request['job_id']
     try:
-        return yaml.safe_load(message)
-    except yaml.error.YAMLError as ex:
-        logging.error('Failed to load YAML from queue message:\n%s', message)
-        logging.error(traceback.format_exc())
-        return None
+        job_launcher.launch_job(request)
+    except Exception as ex:
+        raise ValueError(f'Failed to handle job request for job_id={job_id}') from ex
+    job_tracker.track_job(job_id, request.get('image'))
 
 def main():
-    job_launcher = JobLauncher()
-    job_tracker = JobTracker()
-    while True:
-        request = get_job_request_from_queue()
-        logging.info(f'Received message:\n%s', yaml.safe_dump(request, default_flow_style=False))
-        if request is None or 'job_id' not in request:
-            logging.error('Empty request or missing job_id in request:\n%s', request)
-            continue
-        try:
-            job_id = request['job_id']
-            job_launcher.launch_job(request)
-            job_tracker.track_job(job_id)
-        except Exception as ex:
-            logging.error(f'Failed to handle job request for job_id={job_id}: %s', str(ex))
-            logging.error(traceback.format_exc())
+    start_metrics_server()
+    history_writer = JobHistoryWriter()
+    job_launcher = JobLauncher(history_writer)
+    job_tracker = JobTracker(history_writer, OutputSizeRecorder('job-uuid'))
+    consumer = JobConsumer(lambda message: handle_job_message(job_launcher, job_tracker, message),
+                           lambda message: give_up_job_message(history_writer, message))
+    heartbeat = RegionHeartbeat(job_tracker, consumer)
+    heartbeat.start()
+    if WORK_STEALING:
+        WorkStealer(lambda request: handle_job_request(job_launcher, job_tracker, request),
+                    history_writer, job_tracker, consumer, heartbeat).start()
+    consumer.run()
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s',
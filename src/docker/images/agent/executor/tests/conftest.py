@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import pytest
+from kubernetes import client
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+os.environ.setdefault('APP_ROLE', 'agent.executor.test')
+os.environ.setdefault('REGION', 'test')
+
+import kube
+
+NAMESPACE = 'test'
+LABEL_KEY = 'job-uuid'
+
+def create_job(job_id: str, resource_version: str, status: dict) -> dict:
+    return {
+        'apiVersion': 'batch/v1',
+        'kind': 'Job',
+        'metadata': { 'name': f'job-{job_id}', 'namespace': NAMESPACE, 'labels': { LABEL_KEY: job_id },
+                      'resourceVersion': resource_version },
+        'status': status,
+    }
+
+def wait_for(predicate, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, 'Timed out'
+        time.sleep(0.05)
+
+
+class KubeApiStub:
+    """A stand-in for the jobs endpoint of the kubernetes API server, that serves scripted responses.
+
+    Successive list requests get the successive `lists`, and the last one once all were served. Watch
+    requests get the response of `watches` for their resource version: either events, streamed before
+    the connection is closed, or an HTTP status. Watches from other resource versions are held open, even
+    once stopped, so that the informers left running by the tests stay idle.
+    """
+
+    def __init__(self):
+        # (resource version, jobs) of successive list requests.
+        self.lists: list[tuple[str, list[dict]]] = []
+        # Resource version -> events to stream before disconnecting, or HTTP status to return.
+        self.watches: dict[str, list[dict] | int] = {}
+        # ('list', None) or ('watch', resource version) of every request, in order.
+        self.requests: list[tuple[str, str | None]] = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._create_handler())
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _create_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = { key: values[0] for key, values in parse_qs(url.query).items() }
+                if url.path != f'/apis/batch/v1/namespaces/{NAMESPACE}/jobs':
+                    return self._send_status(404)
+                if query.get('watch', '').lower() == 'true':
+                    self._watch(query.get('resourceVersion'))
+                else:
+                    self._list(query.get('labelSelector'))
+
+            def _list(self, label_selector: str):
+                with stub.lock:
+                    stub.requests.append(('list', None))
+                    resource_version, jobs = stub.lists.pop(0) if len(stub.lists) > 1 else stub.lists[0]
+                label_key = label_selector.split('=')[0]
+                value = label_selector.partition('=')[2]
+                jobs = [job for job in jobs if label_key in job['metadata']['labels']
+                        and (not value or job['metadata']['labels'][label_key] == value)]
+                self._send_json(200, { 'apiVersion': 'batch/v1', 'kind': 'JobList',
+                                       'metadata': { 'resourceVersion': resource_version }, 'items': jobs })
+
+            def _watch(self, resource_version: str):
+                with stub.lock:
+                    stub.requests.append(('watch', resource_version))
+                    response = stub.watches.get(resource_version)
+                if isinstance(response, int):
+                    return self._send_status(response)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                if response is None:
+                    threading.Event().wait()
+                    return
+                for event in response:
+                    self.wfile.write(json.dumps(event).encode() + b'\n')
+                    self.wfile.flush()
+
+            def _send_status(self, code: int):
+                self._send_json(code, { 'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure', 'code': code,
+                                        'reason': 'Expired' if code == 410 else 'NotFound', 'message': f'status {code}' })
+
+            def _send_json(self, code: int, body: dict):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+@pytest.fixture
+def kube_api(monkeypatch):
+    """A `KubeApiStub` that the kubernetes clients of the agent are configured to use."""
+    stub = KubeApiStub()
+    configuration = client.Configuration()
+    configuration.host = stub.url
+    default_configuration = client.Configuration.get_default_copy()
+    client.Configuration.set_default(configuration)
+    monkeypatch.setattr(kube, 'load_kube_config', lambda: NAMESPACE)
+    yield stub
+    client.Configuration.set_default(default_configuration)
+    stub.stop()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import consumer
+from consumer import JobConsumer, MessageRejected
+
+
+class ConnectionStub:
+    """Runs the callbacks of the consumer right away, and records how messages were settled."""
+
+    def __init__(self):
+        self.settled: list[tuple] = []
+        self.delays: list[float] = []
+
+    def add_callback_threadsafe(self, callback):
+        callback()
+
+    def call_later(self, delay: float, callback):
+        self.delays.append(delay)
+        callback()
+
+    def basic_ack(self, delivery_tag: int):
+        self.settled.append(('ack', delivery_tag))
+
+    def basic_nack(self, delivery_tag: int, requeue: bool = True):
+        self.settled.append(('nack', delivery_tag, requeue))
+
+    def basic_publish(self, exchange: str, routing_key: str, body: bytes, properties):
+        self.settled.append(('publish', routing_key, body, properties.headers))
+
+
+def handle(handle_message, attempts: int = 0, give_up_message=None) -> ConnectionStub:
+    connection = ConnectionStub()
+    job_consumer = JobConsumer(handle_message, give_up_message, workers=1, max_attempts=3)
+    job_consumer.in_flight = 1
+    job_consumer._handle(connection, connection, 1, b'message', attempts)
+    assert job_consumer.in_flight == 0
+    return connection
+
+def fail_with(ex: Exception):
+    def handle_message(message: str):
+        raise ex
+    return handle_message
+
+@pytest.fixture(autouse=True)
+def broker_env(monkeypatch):
+    monkeypatch.setenv('BROKER_URL', 'amqp://localhost')
+    monkeypatch.setenv('QUEUE_PERFIX', 'test')
+
+def test_handled_message_is_acked():
+    connection = handle(lambda message: None)
+    assert connection.settled == [('ack', 1)]
+    assert connection.delays == []
+
+def test_rejected_message_is_dropped():
+    wrapped = ValueError('Failed to handle job request')
+    wrapped.__cause__ = MessageRejected('Failed to create job config')
+    for ex in [MessageRejected('Failed to decode queue message.'), wrapped]:
+        connection = handle(fail_with(ex))
+        assert connection.settled == [('nack', 1, False)]
+        assert connection.delays == []
+
+def test_message_failing_transiently_is_requeued_after_delay():
+    connection = handle(fail_with(ValueError('Failed to connect to database.')), attempts=1)
+    assert connection.settled == [('publish', 'test.test', b'message', { consumer.ATTEMPTS_HEADER: 2 }), ('ack', 1)]
+    assert connection.delays == [consumer.CONSUMER_REQUEUE_DELAY]
+
+def test_message_failing_transiently_is_given_up_after_max_attempts():
+    given_up = []
+    connection = handle(fail_with(ValueError('Failed to connect to database.')), attempts=2, give_up_message=given_up.append)
+    assert given_up == ['message']
+    assert connection.settled == [('nack', 1, False)]
+    assert connection.delays == []
+
+def test_message_that_fails_to_be_given_up_is_requeued_after_delay():
+    connection = handle(fail_with(ValueError('Failed to connect to database.')), attempts=2,
+                        give_up_message=fail_with(ValueError('Failed to save job history.')))
+    assert connection.settled == [('nack', 1, True)]
+    assert connection.delays == [consumer.CONSUMER_REQUEUE_DELAY]
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+from types import SimpleNamespace
+
+import pytest
+
+import heartbeat
+from heartbeat import RegionHeartbeat
+from kube import REGION_NODE_LABEL
+
+
+def create_node(name: str, cpu: str, memory: str) -> SimpleNamespace:
+    return SimpleNamespace(metadata=SimpleNamespace(name=name), spec=SimpleNamespace(unschedulable=None),
+                           status=SimpleNamespace(allocatable={ 'cpu': cpu, 'memory': memory },
+                                                  conditions=[SimpleNamespace(type='Ready', status='True')]))
+
+
+class CoreApiStub:
+    def __init__(self, nodes: list[SimpleNamespace]):
+        self.nodes = nodes
+        self.label_selectors: list[str] = []
+
+    def list_node(self, label_selector: str):
+        self.label_selectors.append(label_selector)
+        return SimpleNamespace(items=self.nodes)
+
+    def list_pod_for_all_namespaces(self, field_selector: str):
+        return SimpleNamespace(items=[])
+
+
+class ConnectionStub:
+    closed = False
+
+    def cursor(self):
+        return None
+
+
+@pytest.fixture
+def upserts(monkeypatch) -> list[list]:
+    upserts = []
+    monkeypatch.setattr(heartbeat, 'get_db_connection', lambda autocommit=False: ConnectionStub())
+    monkeypatch.setattr(heartbeat, 'load_kube_config', lambda: 'test')
+    monkeypatch.setattr(heartbeat, 'psql_execute_list', lambda cursor, query, args: upserts.append(args))
+    return upserts
+
+def send_heartbeat(nodes: list[SimpleNamespace]) -> RegionHeartbeat:
+    region_heartbeat = RegionHeartbeat(SimpleNamespace(get_job_counts=lambda: (1, 2)), SimpleNamespace(in_flight=3))
+    region_heartbeat.core_api = CoreApiStub(nodes)
+    region_heartbeat._send_heartbeat()
+    assert region_heartbeat.core_api.label_selectors == [f'{REGION_NODE_LABEL}={heartbeat.REGION}']
+    return region_heartbeat
+
+def test_heartbeat_reports_capacity_of_region_nodes(upserts):
+    region_heartbeat = send_heartbeat([create_node('a', '4', '8Gi'), create_node('b', '2', '4Gi')])
+
+    assert region_heartbeat.free_resources == (6., 12 * 2**30)
+    assert len(upserts) == 1
+    assert upserts[0][:7] == [heartbeat.REGION, 6., 12 * 2**30, 0., 0, 1, 5]
+
+def test_heartbeat_is_skipped_without_region_nodes(upserts):
+    region_heartbeat = send_heartbeat([])
+
+    assert region_heartbeat.free_resources is None
+    assert upserts == []
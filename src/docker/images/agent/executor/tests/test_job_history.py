@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+from datetime import datetime, timezone
+
+import psycopg2
+import pytest
+
+import job_history
+from job_history import JobHistoryWriter
+
+TIMESTAMP = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class DatabaseStub:
+    """Stands in for the JobHistory table, and rejects events of unknown jobs as a foreign key would."""
+
+    def __init__(self):
+        self.rows: list[tuple] = []
+        self.unknown_job_ids: set[str] = set()
+        self.reachable = True
+        self.closed = False
+
+    def connect(self, autocommit=False):
+        return self
+
+    def close(self):
+        pass
+
+    def cursor(self):
+        return None
+
+    def execute_values(self, cursor, query: str, rows: list[tuple]) -> int:
+        # psql_execute_values raises psycopg2 errors as the cause of a ValueError.
+        if not self.reachable:
+            raise ValueError('Failed to execute SQL query') from psycopg2.OperationalError('server closed the connection')
+        if any(row[0] in self.unknown_job_ids for row in rows):
+            raise ValueError('Failed to execute SQL query') from psycopg2.IntegrityError('violates foreign key constraint')
+        self.rows.extend(rows)
+        return len(rows)
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = DatabaseStub()
+    monkeypatch.setattr(job_history, 'get_db_connection', database.connect)
+    monkeypatch.setattr(job_history, 'psql_execute_values', database.execute_values)
+    return database
+
+@pytest.fixture
+def writer(database):
+    # Only explicit flushes, so that the tests control when events are written.
+    writer = JobHistoryWriter(max_size=100, interval=3600, buffer_max_size=200)
+    yield writer
+    database.reachable = True
+    writer.close()
+
+def get_job_ids(rows: list[tuple]) -> list[str]:
+    return [row[0] for row in rows]
+
+def test_rejected_event_is_dropped_without_holding_back_the_others(database, writer):
+    database.unknown_job_ids = { 'b' }
+    for job_id in ['a', 'b', 'c']:
+        writer.save(job_id, 'Started', TIMESTAMP)
+
+    rejected_rows = writer.flush()
+
+    assert get_job_ids(rejected_rows) == ['b']
+    assert get_job_ids(database.rows) == ['a', 'c']
+    assert writer.buffer == []
+    # Later synchronous saves are not affected.
+    writer.save('d', 'Completed', TIMESTAMP, sync=True)
+    assert get_job_ids(database.rows) == ['a', 'c', 'd']
+
+def test_synchronous_save_raises_once_its_event_is_rejected(database, writer):
+    database.unknown_job_ids = { 'a' }
+
+    with pytest.raises(ValueError, match='rejected'):
+        writer.save('a', 'Completed', TIMESTAMP, sync=True)
+    assert writer.buffer == []
+
+def test_events_are_kept_while_database_is_unreachable(database, writer):
+    database.reachable = False
+    writer.save('a', 'Started', TIMESTAMP)
+
+    with pytest.raises(ValueError):
+        writer.save('b', 'Completed', TIMESTAMP, sync=True)
+    assert get_job_ids(row for row, _ in writer.buffer) == ['a', 'b']
+
+    database.reachable = True
+    assert writer.flush() == []
+    assert get_job_ids(database.rows) == ['a', 'b']
+
+def test_oldest_events_are_dropped_beyond_buffer_size(database, writer):
+    database.reachable = False
+    for i in range(250):
+        writer.save(str(i), 'Started', TIMESTAMP)
+        if i % 100 == 99:
+            with pytest.raises(ValueError):
+                writer.flush()
+
+    assert get_job_ids(row for row, _ in writer.buffer) == [str(i) for i in range(50, 250)]
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import threading
+
+from conftest import LABEL_KEY, create_job, wait_for
+from kube import JobInformer
+
+STARTED = { 'active': 1, 'startTime': '2024-01-01T00:00:00+00:00' }
+COMPLETED = { 'succeeded': 1, 'startTime': '2024-01-01T00:00:00+00:00', 'completionTime': '2024-01-01T00:01:00+00:00' }
+
+
+class InformerCallbacks:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statuses: list[tuple[str, dict | None]] = []
+        self.listings: list[dict[str, dict]] = []
+
+    def on_status(self, label_value: str, status: dict | None):
+        with self.lock:
+            self.statuses.append((label_value, status))
+
+    def on_list(self, statuses: dict[str, dict], list_time: float):
+        with self.lock:
+            self.listings.append(statuses)
+
+
+def start_informer(callbacks: InformerCallbacks) -> JobInformer:
+    informer = JobInformer(LABEL_KEY, callbacks.on_status, callbacks.on_list)
+    informer.start()
+    return informer
+
+def test_informer_resumes_watch_after_disconnect_and_lists_again_once_expired(kube_api):
+    kube_api.lists = [
+        ('10', [create_job('a', '9', STARTED), create_job('b', '8', STARTED)]),
+        ('20', [create_job('a', '11', COMPLETED), create_job('c', '19', STARTED)]),
+    ]
+    kube_api.watches = {
+        # The connection is closed after a change of a, so the watch resumes from its version.
+        '10': [{ 'type': 'MODIFIED', 'object': create_job('a', '11', COMPLETED) }],
+        # By then, that version has expired.
+        '11': 410,
+    }
+    callbacks = InformerCallbacks()
+    informer = start_informer(callbacks)
+
+    wait_for(lambda: kube_api.requests[-1:] == [('watch', '20')])
+    assert kube_api.requests == [('list', None), ('watch', '10'), ('watch', '11'), ('list', None), ('watch', '20')]
+    assert [set(statuses) for statuses in callbacks.listings] == [{ 'a', 'b' }, { 'a', 'c' }]
+    assert callbacks.statuses == [('a', COMPLETED)]
+    # The second listing replaces the statuses of the first.
+    assert informer.get_status('a') == COMPLETED
+    assert informer.get_status('b') is None
+    assert informer.get_status('c') == STARTED
+
+def test_informer_lists_again_after_expired_error_event(kube_api):
+    kube_api.lists = [('10', [create_job('a', '9', STARTED)]), ('20', [create_job('a', '15', COMPLETED)])]
+    kube_api.watches = {
+        '10': [{ 'type': 'ERROR', 'object': { 'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure', 'code': 410,
+                                              'reason': 'Expired', 'message': 'too old resource version' } }],
+    }
+    callbacks = InformerCallbacks()
+    informer = start_informer(callbacks)
+
+    wait_for(lambda: kube_api.requests[-1:] == [('watch', '20')])
+    assert kube_api.requests[0] == ('list', None)
+    assert kube_api.requests[-2:] == [('list', None), ('watch', '20')]
+    assert set(kube_api.requests[1:-2]) == { ('watch', '10') }
+    assert informer.get_status('a') == COMPLETED
+
+def test_informer_applies_deletions_and_skips_bookmarks(kube_api):
+    kube_api.lists = [('10', [create_job('a', '9', STARTED)])]
+    kube_api.watches = {
+        '10': [
+            { 'type': 'BOOKMARK', 'object': { 'kind': 'Job', 'apiVersion': 'batch/v1', 'metadata': { 'resourceVersion': '12' } } },
+            { 'type': 'DELETED', 'object': create_job('a', '13', STARTED) },
+        ],
+    }
+    callbacks = InformerCallbacks()
+    informer = start_informer(callbacks)
+
+    wait_for(lambda: kube_api.requests[-1:] == [('watch', '13')])
+    assert callbacks.statuses == [('a', None)]
+    assert informer.get_status('a') is None
+
+def test_fetch_status_reads_from_api_server(kube_api):
+    kube_api.lists = [('10', [create_job('a', '9', COMPLETED)])]
+    informer = JobInformer(LABEL_KEY, lambda *args: None, lambda *args: None)
+
+    assert informer.fetch_status('a') == COMPLETED
+    assert informer.fetch_status('b') is None
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+import subprocess
+
+import pytest
+
+import output_sizes
+from output_sizes import wrap_command_with_output_sizes, parse_output_sizes
+
+
+@pytest.fixture
+def termination_log(tmp_path, monkeypatch):
+    path = tmp_path / 'termination-log'
+    path.write_text('')
+    monkeypatch.setattr(output_sizes, 'TERMINATION_MESSAGE_PATH', str(path))
+    return path
+
+def run(script: str, output_path) -> int:
+    return subprocess.run(['sh', '-c', wrap_command_with_output_sizes(script, [str(output_path)])]).returncode
+
+def test_outputs_are_measured_after_success(tmp_path, termination_log):
+    (tmp_path / 'out').mkdir()
+    (tmp_path / 'out' / 'data').write_bytes(b'x' * 8192)
+
+    assert run('exit 0', tmp_path / 'out') == 0
+    assert parse_output_sizes(termination_log.read_text())[str(tmp_path / 'out')] >= 8192
+
+def test_outputs_are_not_measured_after_failure(tmp_path, termination_log):
+    (tmp_path / 'out').mkdir()
+
+    assert run('exit 3', tmp_path / 'out') == 3
+    assert termination_log.read_text() == ''
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+
+import pytest
+
+from conftest import create_job, wait_for
+from tracker_snapshot import TrackedJob
+import worker
+from worker import JobTracker
+
+STARTED = { 'active': 1, 'startTime': '2024-01-01T00:00:00+00:00' }
+COMPLETED = { 'succeeded': 1, 'startTime': '2024-01-01T00:00:00+00:00', 'completionTime': '2024-01-01T00:01:00+00:00' }
+
+
+class HistoryWriterStub:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events: list[tuple[str, str, bool]] = []
+
+    def save(self, job_id: str, event: str, timestamp, sync: bool = False):
+        with self.lock:
+            self.events.append((job_id, event, sync))
+
+    def get_events(self) -> list[tuple[str, str, bool]]:
+        with self.lock:
+            return list(self.events)
+
+
+class TrackerSnapshotStub:
+    def __init__(self, tracked_jobs: list[TrackedJob]):
+        self.tracked_jobs = tracked_jobs
+
+    def load(self) -> list[TrackedJob]:
+        return self.tracked_jobs
+
+    def save(self, jobs: list[TrackedJob]):
+        pass
+
+    def delete(self, job_ids: list[str]):
+        pass
+
+
+class ConnectionStub:
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def create_tracker(kube_api, monkeypatch):
+    """Create a JobTracker whose database is stubbed, with the given snapshot and unfinished jobs."""
+    trackers = []
+    monkeypatch.setattr(worker, 'get_db_connection', lambda autocommit=False: ConnectionStub())
+    monkeypatch.setattr(JobTracker, '_get_expected_runtime', lambda self, image: None)
+
+    def create(unfinished_jobs: list[tuple[str, str, str]], snapshot_jobs: list[TrackedJob] | None = None) -> JobTracker:
+        monkeypatch.setattr(worker, 'TrackerSnapshot', lambda origin: TrackerSnapshotStub(snapshot_jobs or []))
+        monkeypatch.setattr(JobTracker, '_get_unfinished_jobs', lambda self: unfinished_jobs)
+        tracker = JobTracker(HistoryWriterStub())
+        trackers.append(tracker)
+        return tracker
+
+    yield create
+    for tracker in trackers:
+        tracker.poll_daemon.cancel()
+
+def test_listing_completes_and_reports_missing_jobs_as_not_found(kube_api, create_tracker):
+    kube_api.lists = [('10', [create_job('a', '9', COMPLETED), create_job('c', '8', STARTED)])]
+    tracker = create_tracker([('a', 'image', 'Started'), ('b', 'image', 'Created'), ('c', 'image', 'Created')])
+
+    wait_for(lambda: kube_api.requests[-1:] == [('watch', '10')])
+    assert sorted(tracker.history_writer.get_events()) == [
+        ('a', 'Completed', True), ('b', 'NotFound', True), ('c', 'Started', False)]
+    assert tracker.get_job_counts() == (1, 0)
+
+def test_listing_does_not_report_jobs_tracked_since_as_not_found(kube_api, create_tracker):
+    kube_api.lists = [('10', [create_job('a', '9', STARTED)])]
+    tracker = create_tracker([('a', 'image', 'Created')])
+    wait_for(lambda: kube_api.requests[-1:] == [('watch', '10')])
+    assert tracker.history_writer.get_events() == [('a', 'Started', False)]
+
+    list_time = time.monotonic()
+    tracker.track_job('b')
+    tracker._on_jobs_listed({}, list_time)
+
+    assert tracker.history_writer.get_events() == [('a', 'Started', False), ('a', 'NotFound', True)]
+    assert tracker.get_job_counts() == (0, 1)
+
+def test_unfinished_jobs_missing_from_snapshot_are_tracked(kube_api, create_tracker):
+    kube_api.lists = [('10', [create_job('a', '9', STARTED), create_job('b', '8', STARTED)])]
+    now = time.monotonic()
+    tracker = create_tracker([('a', 'image', 'Created'), ('b', 'image', 'KubeCreated')],
+                             snapshot_jobs=[TrackedJob('a', 'Started', now, now + 60, None)])
+
+    wait_for(lambda: kube_api.requests[-1:] == [('watch', '10')])
+    # a resumes with its status of the snapshot, so only b is found to have started.
+    assert tracker.history_writer.get_events() == [('b', 'Started', False)]
+    assert tracker.get_job_counts() == (2, 0)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""Compare the former DISTINCT ON view over JobHistory with the JobCurrentState table.
+
+Usage: python benchmarks/jobcurrentstate.py [--jobs 200000] [--events-per-job 5] [--repeat 20]
+
+Connects with the POSTGRES_HOST, POSTGRES_DB, POSTGRES_USER and POSTGRES_PASSWORD environment variables,
+or libpq's PG* variables, and works in a scratch schema that is dropped at the end, so it can run next to
+the real tables. The schema files of init/schemas are used as they are. JobHistory is seeded with
+`jobs * events-per-job` rows, about 1M by default, before JobCurrentState is created and backfilled, as on an
+existing deployment. Each query is then timed against the view and the table, followed by the cost of
+the trigger on inserts.
+"""
+
+import argparse
+import os
+import statistics
+import time
+import psycopg2
+
+SCHEMAS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'init', 'schemas')
+SCRATCH_SCHEMA = 'bench_jobcurrentstate'
+REGIONS = ['us-west', 'us-central', 'us-east']
+FINAL_EVENTS = ('Completed', 'Failed', 'NotFound', 'CreateFailed')
+
+LEGACY_VIEW = '''CREATE VIEW JobHistoryLastEventLegacy
+AS
+    SELECT DISTINCT ON (job_id)
+            job_id, event, time, origin
+        FROM JobHistory
+        ORDER BY job_id, time DESC;'''
+
+# Query name -> (query with {relation}, function returning the arguments of a run).
+QUERIES = {
+    'status of one job': ('SELECT job_id, event, time FROM {relation} WHERE job_id = %s;',
+                          lambda cursor: [_get_random_job_id(cursor)]),
+    'unfinished jobs of an agent': ('SELECT job_id FROM {relation} WHERE origin = %s AND event NOT IN %s;',
+                                    lambda cursor: [f'agent.executor.{REGIONS[0]}', FINAL_EVENTS]),
+    'first page by time': ('SELECT job_id, event, time FROM {relation} ORDER BY time, job_id LIMIT 100;',
+                           lambda cursor: []),
+}
+
+def _get_random_job_id(cursor) -> str:
+    cursor.execute('SELECT job_id FROM JobRequest TABLESAMPLE SYSTEM (1) LIMIT 1;')
+    row = cursor.fetchone()
+    if row is None:
+        cursor.execute('SELECT job_id FROM JobRequest LIMIT 1;')
+        row = cursor.fetchone()
+    return row[0]
+
+def connect():
+    params = { key: os.environ[env_var] for key, env_var in [('host', 'POSTGRES_HOST'), ('dbname', 'POSTGRES_DB'),
+                                                               ('user', 'POSTGRES_USER'), ('password', 'POSTGRES_PASSWORD')]
+               if env_var in os.environ }
+    conn = psycopg2.connect(**params)
+    conn.autocommit = True
+    return conn
+
+def run_schema_file(cursor, path: str):
+    with open(os.path.join(SCHEMAS_DIR, path)) as f:
+        cursor.execute(f.read())
+
+def create_schema(cursor, jobs: int, events_per_job: int):
+    cursor.execute(f'DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE; CREATE SCHEMA {SCRATCH_SCHEMA};')
+    cursor.execute(f'SET search_path TO {SCRATCH_SCHEMA}, public;')
+    cursor.execute("SELECT to_regproc('uuid_generate_v4') IS NOT NULL;")
+    if not cursor.fetchone()[0]:
+        try:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS "uuid-ossp";')
+        except psycopg2.Error:
+            # Servers without uuid-ossp, e.g. local test builds; gen_random_uuid() is built in since PostgreSQL 13.
+            cursor.execute('CREATE FUNCTION uuid_generate_v4() RETURNS uuid AS $$ SELECT gen_random_uuid() $$ LANGUAGE sql;')
+    run_schema_file(cursor, 'tables/table.jobrequest.sql')
+    run_schema_file(cursor, 'tables/table.jobhistory.sql')
+
+    print(f'Seeding {jobs} jobs and up to {jobs * events_per_job} history rows ...')
+    start = time.perf_counter()
+    cursor.execute('''INSERT INTO JobRequest (job_id, name, image, command)
+                        SELECT gen_random_uuid(), 'job-' || i, 'image-' || (i %% 20), 'true'
+                        FROM generate_series(1, %s) i;''', [jobs])
+    # The events of a job follow each other by a minute, and the last jobs are still running.
+    cursor.execute('''INSERT INTO JobHistory (job_id, event, time, origin)
+                        SELECT request.job_id, events.event,
+                               timestamptz '2024-01-01' + (request.n * interval '1 second') + (events.i * interval '1 minute'),
+                               CASE WHEN events.i < 2 THEN 'master.job-scheduler'
+                                    ELSE 'agent.executor.' || (%s::text[])[1 + request.n %% %s] END
+                        FROM (SELECT job_id, row_number() OVER () AS n FROM JobRequest) request,
+                            LATERAL (SELECT i, (ARRAY['Created', 'Enqueued', 'Dequeued', 'Started', 'Completed'])[1 + i] AS event
+                                     FROM generate_series(0, %s - 1) i) events
+                        WHERE events.i < 4 OR request.n %% 20 != 0;''', [REGIONS, len(REGIONS), min(events_per_job, 5)])
+    print(f'Seeded in {time.perf_counter() - start:.1f}s')
+
+    start = time.perf_counter()
+    run_schema_file(cursor, 'tables/table.jobcurrentstate.sql')
+    run_schema_file(cursor, 'triggers/trigger.jobhistory.jobcurrentstate.sql')
+    for index_file in ['index.jobhistory.sql', 'index.jobhistory.event_time.sql', 'index.jobcurrentstate.sql']:
+        run_schema_file(cursor, f'indices/{index_file}')
+    cursor.execute(LEGACY_VIEW)
+    cursor.execute('ANALYZE JobRequest; ANALYZE JobHistory; ANALYZE JobCurrentState;')
+    print(f'Backfilled JobCurrentState and created indices in {time.perf_counter() - start:.1f}s')
+
+def time_query(cursor, query: str, get_args, repeat: int) -> float:
+    """Get the median duration of a query in milliseconds."""
+    durations = []
+    for _ in range(repeat):
+        args = get_args(cursor)
+        start = time.perf_counter()
+        cursor.execute(query, args)
+        cursor.fetchall()
+        durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations)
+
+def time_inserts(cursor, rows: int, with_trigger: bool) -> float:
+    """Get the duration in milliseconds of inserting one event per job for `rows` jobs."""
+    event = 'Failed' if with_trigger else 'NotFound'
+    cursor.execute(f'ALTER TABLE JobHistory {"ENABLE" if with_trigger else "DISABLE"} TRIGGER trigger_jobhistory_update_jobcurrentstate;')
+    start = time.perf_counter()
+    cursor.execute('''INSERT INTO JobHistory (job_id, event, time, origin)
+                        SELECT job_id, %s, now(), 'benchmark' FROM JobRequest LIMIT %s;''', [event, rows])
+    duration = (time.perf_counter() - start) * 1000
+    cursor.execute('ALTER TABLE JobHistory ENABLE TRIGGER trigger_jobhistory_update_jobcurrentstate;')
+    return duration
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=200000)
+    parser.add_argument('--events-per-job', type=int, default=5, choices=range(1, 6))
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--insert-rows', type=int, default=10000)
+    parser.add_argument('--keep', action='store_true', help=f'keep the {SCRATCH_SCHEMA} schema')
+    args = parser.parse_args()
+
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        create_schema(cursor, args.jobs, args.events_per_job)
+        print(f'\n{"query":<30} {"view (ms)":>12} {"table (ms)":>12} {"speedup":>9}')
+        for name, (query, get_args) in QUERIES.items():
+            view_time = time_query(cursor, query.format(relation='JobHistoryLastEventLegacy'), get_args, args.repeat)
+            table_time = time_query(cursor, query.format(relation='JobCurrentState'), get_args, args.repeat)
+            print(f'{name:<30} {view_time:>12.2f} {table_time:>12.2f} {view_time / table_time:>8.0f}x')
+        without_trigger = time_inserts(cursor, args.insert_rows, with_trigger=False)
+        with_trigger = time_inserts(cursor, args.insert_rows, with_trigger=True)
+        print(f'\ninsert {args.insert_rows} history rows: {without_trigger:.0f}ms without trigger, '
+              f'{with_trigger:.0f}ms with trigger')
+    finally:
+        if not args.keep:
+            cursor.execute(f'DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE;')
+        conn.close()
+
+if __name__ == '__main__':
+    main()
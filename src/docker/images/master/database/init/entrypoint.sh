@@ -13,6 +13,15 @@ psql -v ON_ERROR_STOP=1 -c 'CREATE EXTENSION IF NOT EXISTS "uuid-ossp";'
 psql -v ON_ERROR_STOP=1 -f ./schemas/tables/table.jobrequest.sql
 psql -v ON_ERROR_STOP=1 -f ./schemas/tables/table.jobconfig.sql
 psql -v ON_ERROR_STOP=1 -f ./schemas/tables/table.jobhistory.sql
+psql -v ON_ERROR_STOP=1 -f ./schemas/tables/table.jobdeferral.sql
+psql -v ON_ERROR_STOP=1 -f ./schemas/tables/table.datasetsize.sql
+psql -v ON_ERROR_STOP=1 -f ./schemas/tables/table.regioncapacity.sql
+psql -v ON_ERROR_STOP=1 -f ./schemas/tables/table.jobsteal.sql
+psql -v ON_ERROR_STOP=1 -f ./schemas/tables/table.jobtrackersnapshot.sql
+psql -v ON_ERROR_STOP=1 -f ./schemas/tables/table.jobplacementlease.sql
+psql -v ON_ERROR_STOP=1 -f ./schemas/tables/table.jobcurrentstate.sql
+
+find ./schemas/triggers -iname "*.sql" -exec psql -v ON_ERROR_STOP=1 -f {} \;
 
 find ./schemas/indices -iname "*.sql" -exec psql -v ON_ERROR_STOP=1 -f {} \;
 find ./schemas/views -iname "*.sql" -exec psql -v ON_ERROR_STOP=1 -f {} \;
@@ -0,0 +1,4 @@
+CREATE INDEX index_datasetsize_updated_at ON DatasetSize
+(
+    updated_at
+)
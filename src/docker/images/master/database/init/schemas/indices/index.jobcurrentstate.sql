@@ -0,0 +1,16 @@
+CREATE INDEX index_jobcurrentstate_origin_event ON JobCurrentState
+(
+    origin,
+    event
+);
+
+CREATE INDEX index_jobcurrentstate_name ON JobCurrentState
+(
+    name text_pattern_ops
+);
+
+CREATE INDEX index_jobcurrentstate_time_id ON JobCurrentState
+(
+    time,
+    job_id
+);
@@ -0,0 +1,4 @@
+CREATE INDEX index_jobdeferral_dispatch_time ON JobDeferral
+(
+    dispatch_time
+)
@@ -0,0 +1,5 @@
+CREATE INDEX index_jobhistory_event_time ON JobHistory
+(
+    event,
+    time
+)
@@ -0,0 +1,4 @@
+CREATE INDEX index_jobplacementlease_expires_at ON JobPlacementLease
+(
+    expires_at
+)
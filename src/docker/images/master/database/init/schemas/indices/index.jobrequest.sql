@@ -0,0 +1,4 @@
+CREATE INDEX index_jobrequest_image ON JobRequest
+(
+    image
+)
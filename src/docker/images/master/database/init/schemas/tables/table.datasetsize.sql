@@ -0,0 +1,7 @@
+CREATE TABLE DatasetSize(
+    url VARCHAR(256) PRIMARY KEY,
+    size_bytes BIGINT NOT NULL,
+    -- Set by the database on every write, so that readers can pull the rows updated since their last read.
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT clock_timestamp(),
+    source VARCHAR(16) NOT NULL
+)
@@ -1,4 +1,5 @@
 CREATE TABLE JobConfig(
     job_id UUID NOT NULL REFERENCES JobRequest(job_id),
-    job_config jsonb NOT NULL
+    job_config jsonb NOT NULL,
+    CONSTRAINT job_config_unique_job_id UNIQUE (job_id)
 )
@@ -0,0 +1,15 @@
+CREATE TABLE JobCurrentState(
+    job_id UUID PRIMARY KEY REFERENCES JobRequest(job_id),
+    name VARCHAR(64) NOT NULL,
+    event VARCHAR(16) NOT NULL,
+    time TIMESTAMP WITH TIME ZONE NOT NULL,
+    origin VARCHAR(32) NOT NULL
+);
+
+-- Backfill from existing history, if any.
+INSERT INTO JobCurrentState (job_id, name, event, time, origin)
+    SELECT DISTINCT ON (history.job_id)
+            history.job_id, jobs.name, history.event, history.time, history.origin
+        FROM JobHistory history INNER JOIN JobRequest jobs
+            ON history.job_id = jobs.job_id
+        ORDER BY history.job_id, history.time DESC;
@@ -0,0 +1,6 @@
+CREATE TABLE JobDeferral(
+    job_id UUID PRIMARY KEY REFERENCES JobRequest(job_id),
+    region VARCHAR(32) NOT NULL,
+    dispatch_time TIMESTAMP WITH TIME ZONE NOT NULL,
+    message jsonb NOT NULL
+)
@@ -0,0 +1,7 @@
+-- Jobs being placed by a scheduler worker, which renews their lease for as long as it holds them.
+-- Jobs whose lease expired were lost by their worker, and are placed again by another one.
+CREATE TABLE JobPlacementLease(
+    job_id UUID PRIMARY KEY REFERENCES JobRequest(job_id),
+    owner VARCHAR(128) NOT NULL,
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+)
@@ -3,5 +3,9 @@ CREATE TABLE JobRequest (
     name VARCHAR(64) NOT NULL,
     image VARCHAR(128) NOT NULL,
     command VARCHAR(1024) NOT NULL,
-    max_delay INTERVAL DEFAULT INTERVAL '0'
+    max_delay INTERVAL DEFAULT INTERVAL '0',
+    -- Client-supplied key of the submission, so that retries do not create duplicate jobs.
+    idempotency_key VARCHAR(128) UNIQUE,
+    -- The submitted request, so that jobs stuck before placement can be placed again.
+    request JSONB
 )
@@ -0,0 +1,8 @@
+CREATE TABLE JobSteal(
+    job_id UUID PRIMARY KEY REFERENCES JobRequest(job_id),
+    from_region VARCHAR(32) NOT NULL,
+    to_region VARCHAR(32) NOT NULL,
+    -- Relative increase of the job's estimated emission, or NULL if there was no estimate.
+    carbon_penalty DOUBLE PRECISION,
+    time TIMESTAMP WITH TIME ZONE NOT NULL
+)
@@ -0,0 +1,9 @@
+CREATE TABLE JobTrackerSnapshot(
+    origin VARCHAR(32) NOT NULL,
+    job_id UUID NOT NULL REFERENCES JobRequest(job_id),
+    last_status VARCHAR(16),
+    changed_time TIMESTAMP WITH TIME ZONE NOT NULL,
+    next_check_time TIMESTAMP WITH TIME ZONE NOT NULL,
+    expected_runtime DOUBLE PRECISION,
+    PRIMARY KEY (origin, job_id)
+)
@@ -0,0 +1,11 @@
+CREATE TABLE RegionCapacity(
+    region VARCHAR(32) PRIMARY KEY,
+    allocatable_cpu DOUBLE PRECISION NOT NULL,
+    allocatable_memory BIGINT NOT NULL,
+    requested_cpu DOUBLE PRECISION NOT NULL,
+    requested_memory BIGINT NOT NULL,
+    running_jobs INTEGER NOT NULL,
+    backlog INTEGER NOT NULL,
+    origin VARCHAR(32) NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL
+)
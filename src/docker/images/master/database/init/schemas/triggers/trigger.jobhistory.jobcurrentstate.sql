@@ -0,0 +1,27 @@
+-- Keep JobCurrentState in sync with the latest event of each job in JobHistory,
+-- and notify listeners on the job_history channel of every new event. Repeatable
+-- events, such as 'Retrying', are recorded again by updating their time.
+CREATE FUNCTION jobhistory_update_jobcurrentstate() RETURNS trigger AS $$
+DECLARE
+    job_name VARCHAR(64);
+BEGIN
+    SELECT jobs.name INTO job_name FROM JobRequest jobs WHERE jobs.job_id = NEW.job_id;
+    INSERT INTO JobCurrentState (job_id, name, event, time, origin)
+        VALUES (NEW.job_id, job_name, NEW.event, NEW.time, NEW.origin)
+        ON CONFLICT (job_id) DO UPDATE
+            SET event = EXCLUDED.event, time = EXCLUDED.time, origin = EXCLUDED.origin
+            WHERE JobCurrentState.time <= EXCLUDED.time;
+    PERFORM pg_notify('job_history', json_build_object(
+        'job_id', NEW.job_id,
+        'job_name', job_name,
+        'event', NEW.event,
+        'timestamp', extract(epoch FROM NEW.time),
+        'origin', NEW.origin
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trigger_jobhistory_update_jobcurrentstate
+    AFTER INSERT OR UPDATE OF time ON JobHistory
+    FOR EACH ROW EXECUTE FUNCTION jobhistory_update_jobcurrentstate();
@@ -2,7 +2,7 @@
 
 import time
 import traceback
-from flask import Flask, g, current_app, jsonify
+from flask import Flask, g, current_app, jsonify, request, Response
 from flask_restful import Api
 import webargs
 import secrets
@@ -10,6 +10,10 @@ import logging
 from werkzeug.exceptions import UnprocessableEntity, HTTPException
 
 from api.util import CustomJSONEncoder
+from api.config import ASYNC_PLACEMENT
+from api.helpers.postgres import get_db_connection_pool
+from api.helpers.metrics import get_metrics, REQUEST_LATENCY
+from prometheus_client import CONTENT_TYPE_LATEST
 
 class CustomApi(Api):
     def handle_error(self, ex: Exception):
@@ -39,8 +43,10 @@ def create_app():
         app.logger.handlers = gunicorn_logger.handlers
         app.logger.setLevel(gunicorn_logger.level)
 
-    from api.routes.job_scheduler import JobSchduler
-    from api.routes.job_status import JobStatus
+    from api.routes.job_scheduler import JobSchduler, JobSchdulerBatch, g_carbon_api_client, g_deferred_job_releaser, g_dataset_size_index, \
+        g_region_capacity, g_stuck_job_sweeper
+    from api.routes.job_status import JobStatus, JobStatusBulk, JobStatusList, JobStatusStream, g_job_event_listener
+    from api.routes.job_analytics import JobLatency
 
     # Alternatively, use this and `from varname import nameof`.
     errors_custom_responses = {
@@ -52,7 +58,12 @@ def create_app():
 
     api = CustomApi(app, errors=errors_custom_responses)
     api.add_resource(JobSchduler, '/job-scheduler/')
+    api.add_resource(JobSchdulerBatch, '/job-scheduler/batch/')
     api.add_resource(JobStatus, '/job-status/')
+    api.add_resource(JobStatusBulk, '/job-status/bulk/')
+    api.add_resource(JobStatusList, '/job-status/list/')
+    api.add_resource(JobStatusStream, '/job-status/stream/')
+    api.add_resource(JobLatency, '/job-analytics/latency/')
 
     # Source: https://github.com/marshmallow-code/webargs/issues/181#issuecomment-621159812
     @webargs.flaskparser.parser.error_handler
@@ -67,13 +78,33 @@ def create_app():
             messages=error.messages,
         )
 
+    g_deferred_job_releaser.start(app)
+    if ASYNC_PLACEMENT:
+        # Only the placement worker leases jobs, see `StuckJobSweeper`.
+        g_stuck_job_sweeper.start(app)
+    g_dataset_size_index.start(app)
+    g_region_capacity.start(app)
+    g_job_event_listener.start(app)
+
     @app.before_request
     def before_request():
         g.start = time.time()
 
+    @app.after_request
+    def after_request(response):
+        endpoint = request.url_rule.rule if request.url_rule else 'unknown'
+        REQUEST_LATENCY.labels(endpoint, request.method, response.status_code).observe(time.time() - g.start)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(get_metrics(), mimetype=CONTENT_TYPE_LATEST)
+
     @app.teardown_request
     def teardown_request(exception=None):
         diff = time.time() - g.start
         app.logger.debug(f'Request took {1000 * diff:.0f}ms')
+        app.logger.debug(f'Database connection pool: {get_db_connection_pool().get_stats()}')
+        app.logger.debug(f'Carbon API client: {g_carbon_api_client.get_stats()}')
 
     return app
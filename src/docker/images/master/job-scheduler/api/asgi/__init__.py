@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import asyncio
+import contextlib
+import logging
+import time
+import uuid
+from datetime import datetime, timezone
+from fastapi import FastAPI, Request, Query
+from fastapi.responses import JSONResponse, Response
+from marshmallow import ValidationError
+import marshmallow_dataclass
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from api.models.job_request import JobRequest, IDEMPOTENCY_KEY_MAX_LENGTH
+from api.asgi.carbon_api_client import AsyncCarbonApiClient
+from api.asgi.job_queue import AsyncJobQueue
+from api.asgi.job_dispatcher import AsyncJobDispatcher, create_db_pool
+from api.asgi.region_backlog import AsyncRegionBacklogMonitor
+from api.helpers.job_dispatcher import UNDISPATCHED_EVENTS, dump_job_request, is_same_job_request
+from api.helpers.cache import TtlCache
+from api.helpers.metrics import get_metrics, STAGE_LATENCY, REQUEST_LATENCY, ADMISSION_REJECTIONS
+from api.util import CustomJSONEncoder
+from api.config import IDEMPOTENCY_CACHE_SIZE, ADMISSION_POLICY, REGION_BACKLOG_REFRESH_INTERVAL
+
+logger = logging.getLogger('uvicorn.error')
+
+# Served by uvicorn: `uvicorn --factory api.asgi:create_app`.
+#
+# Only job submission and single job status lookups are implemented; the batch, bulk, list and
+# stream endpoints and background placement remain served by the WSGI app.
+
+class CustomJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return CustomJSONEncoder().encode(content).encode()
+
+
+def get_idempotency_key_reused_response(idempotency_key: str) -> CustomJSONResponse:
+    return CustomJSONResponse({'errors': {'Idempotency-Key': f'{idempotency_key} was already used for a different job request.'}},
+                              status_code=422)
+
+
+def create_app() -> FastAPI:
+    job_request_schema = marshmallow_dataclass.class_schema(JobRequest)()
+    # Idempotency key -> (job id, job name, saved request) of jobs that were dispatched, see `JobSchduler`.
+    idempotent_jobs = TtlCache(float('inf'), IDEMPOTENCY_CACHE_SIZE)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app: FastAPI):
+        pool = await create_db_pool()
+        carbon_api_client = AsyncCarbonApiClient()
+        job_queue = AsyncJobQueue()
+        await job_queue.connect()
+        region_backlog = AsyncRegionBacklogMonitor(job_queue)
+        app.state.pool = pool
+        app.state.region_backlog = region_backlog
+        app.state.job_dispatcher = AsyncJobDispatcher(pool, carbon_api_client, job_queue, region_backlog)
+        releaser = asyncio.create_task(app.state.job_dispatcher.run_deferred_job_releaser())
+        backlog_refresher = asyncio.create_task(region_backlog.run())
+        try:
+            yield
+        finally:
+            releaser.cancel()
+            backlog_refresher.cancel()
+            await job_queue.close()
+            await carbon_api_client.close()
+            await pool.close()
+
+    app = FastAPI(lifespan=lifespan, default_response_class=CustomJSONResponse)
+
+    @app.middleware('http')
+    async def measure_request_latency(request: Request, call_next):
+        start = time.monotonic()
+        response = await call_next(request)
+        REQUEST_LATENCY.labels(request.url.path, request.method, response.status_code).observe(time.monotonic() - start)
+        return response
+
+    @app.exception_handler(ValueError)
+    async def handle_value_error(request: Request, ex: ValueError):
+        logger.error(ex, exc_info=ex)
+        return CustomJSONResponse({'error': str(ex)}, status_code=500)
+
+    @app.post('/job-scheduler/')
+    async def post_job(request: Request):
+        start = time.monotonic()
+        try:
+            job_request: JobRequest = job_request_schema.load(await request.json())
+        except ValidationError as ex:
+            return CustomJSONResponse({'errors': ex.messages}, status_code=422)
+        STAGE_LATENCY.labels('validation').observe(time.monotonic() - start)
+        logger.info(f'post_job({job_request})')
+        job_uuid = uuid.uuid4()
+        job_id = str(job_uuid)
+        job_request.spec.name += f'-{job_uuid.hex[:10]}'
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is not None and not 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+            return CustomJSONResponse({'errors': {'Idempotency-Key': f'Must have 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters.'}}, status_code=422)
+        if idempotency_key and (existing_job := idempotent_jobs.get(idempotency_key)) is not None:
+            if not is_same_job_request(existing_job[2], job_request):
+                return get_idempotency_key_reused_response(idempotency_key)
+            return CustomJSONResponse({ 'job_uuid': existing_job[0], 'job_name': existing_job[1] }, status_code=200)
+        # See `is_admission_rejected()` of the WSGI app.
+        if ADMISSION_POLICY == 'reject' and request.app.state.region_backlog.are_all_regions_saturated():
+            logger.warning('Rejecting job submission, as every region is saturated')
+            ADMISSION_REJECTIONS.inc()
+            return CustomJSONResponse({ 'error': 'Every region is saturated, retry later.' }, status_code=429,
+                                      headers={ 'Retry-After': str(max(1, int(REGION_BACKLOG_REFRESH_INTERVAL))) })
+
+        job_dispatcher: AsyncJobDispatcher = request.app.state.job_dispatcher
+        existing_job = await job_dispatcher.save_job_request(job_id, job_request, idempotency_key)
+        if existing_job is None:
+            await job_dispatcher.save_job_history(job_id, 'Created', datetime.now(timezone.utc))
+        else:
+            # See `JobSchduler._resume_job()`.
+            if not is_same_job_request(existing_job[2], job_request):
+                return get_idempotency_key_reused_response(idempotency_key)
+            job_id, job_request.spec.name, _ = existing_job
+            event = await job_dispatcher.get_last_event(job_id)
+            logger.info(f'Idempotency key {idempotency_key} was used by job {job_id}, which is {event}')
+            if event not in UNDISPATCHED_EVENTS:
+                idempotent_jobs.put(idempotency_key, existing_job)
+                return CustomJSONResponse({ 'job_uuid': job_id, 'job_name': job_request.spec.name }, status_code=200)
+            if not await job_dispatcher.claim_retry(job_id):
+                return CustomJSONResponse({ 'job_uuid': job_id, 'job_name': job_request.spec.name,
+                                            'error': 'The job is still being dispatched, retry later.' }, status_code=409)
+        try:
+            placement = await job_dispatcher.get_best_location(job_request)
+        except Exception:
+            await job_dispatcher.save_job_history(job_id, 'PlacementFailed', datetime.now(timezone.utc))
+            raise
+        try:
+            await job_dispatcher.dispatch_job(job_id, job_request, placement)
+        except Exception as ex:
+            await job_dispatcher.save_job_history(job_id, 'EnqueueFailed', datetime.now(timezone.utc))
+            raise ValueError('Failed to send job to queue') from ex
+        if idempotency_key:
+            idempotent_jobs.put(idempotency_key, (job_id, job_request.spec.name, dump_job_request(job_request)))
+        return CustomJSONResponse({
+            'job_uuid': job_id,
+            'job_name': job_request.spec.name,
+        }, status_code=201)
+
+    @app.get('/job-status/')
+    async def get_job_status(request: Request, job_id: uuid.UUID | None = Query(default=None), job_name: str | None = Query(default=None)):
+        if not job_id and not job_name:
+            error_message_either_id_or_name_is_required = 'Either job_id or job_name is required'
+            return CustomJSONResponse({'errors': {
+                'job_id': error_message_either_id_or_name_is_required,
+                'job_name': error_message_either_id_or_name_is_required,
+            }}, status_code=422)
+        job_description = f'job_id={job_id}' if job_id else f'job_name={job_name}'
+        logger.info(f'Getting job status with {job_description}')
+        try:
+            if job_id:
+                row = await request.app.state.pool.fetchrow('SELECT job_id, event, time FROM JobCurrentState WHERE job_id = $1;', job_id)
+            else:
+                row = await request.app.state.pool.fetchrow('SELECT job_id, event, time FROM JobCurrentState WHERE name = $1;', job_name)
+            assert row is not None, 'Job not found'
+        except Exception as ex:
+            raise ValueError(f'Failed to get job status ({job_description}).') from ex
+        return {
+            'job_id': row['job_id'],
+            'event': row['event'],
+            'timestamp': row['time'],
+        }
+
+    @app.get('/metrics')
+    async def metrics():
+        return Response(get_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+    return app
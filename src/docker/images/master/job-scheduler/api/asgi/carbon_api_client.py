@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+import logging
+import time
+from datetime import timedelta
+import httpx
+
+from api.helpers.cache import AsyncTtlCache
+from api.helpers.carbon_api_client import CarbonLookup
+from api.helpers.metrics import CARBON_API_LATENCY
+from api.config import CARBON_API_ENDPOINT, CARBON_API_CACHE_TTL, CARBON_API_TIMEOUT
+
+logger = logging.getLogger('uvicorn.error')
+
+class AsyncCarbonApiClient:
+    """Asyncio counterpart of `CarbonApiClient`, sharing its request and response format."""
+
+    def __init__(self):
+        self.client = httpx.AsyncClient(timeout=CARBON_API_TIMEOUT)
+        self.url = f'http://{CARBON_API_ENDPOINT}/carbon-aware-scheduler/'
+        self.cache = AsyncTtlCache(CARBON_API_CACHE_TTL)
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def get_carbon_emissions_by_location(self, original_location: str, candidate_locations: list[str], input_size_gb: float = 0, output_size_gb: float = 0,
+                                               max_delay: timedelta = timedelta()) -> dict[str, dict]:
+        lookup = CarbonLookup.create(original_location, candidate_locations, input_size_gb, output_size_gb, max_delay)
+        return await self.cache.get_or_compute(lookup, lambda: self._request_carbon_emissions(lookup))
+
+    async def _request_carbon_emissions(self, lookup: CarbonLookup) -> dict[str, dict]:
+        logger.info(f'Requesting carbon emissions for {lookup.candidate_locations} at {lookup.start_time} ...')
+        start = time.monotonic()
+        try:
+            # The carbon API takes its parameters as the JSON body of a GET request.
+            response = await self.client.request('GET', self.url, json=lookup.get_payload())
+            response.raise_for_status()
+            result = response.json()
+        except Exception as ex:
+            raise ValueError(f'Failed to get carbon emissions from carbon API: {ex}') from ex
+        finally:
+            CARBON_API_LATENCY.observe(time.monotonic() - start)
+        return lookup.parse_response(result)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+import asyncpg
+
+from api.models.job_request import JobRequest
+from api.asgi.carbon_api_client import AsyncCarbonApiClient
+from api.asgi.job_queue import AsyncJobQueue
+from api.asgi.region_backlog import AsyncRegionBacklogMonitor
+from api.helpers.dataset_size_index import normalize_storage_url
+from api.helpers.job_dispatcher import Placement, create_job_message, serialize_job_message, get_best_placement, dump_job_request, \
+    get_job_history_conflict_clause
+from api.helpers.metrics import time_stage, DB_ERRORS
+from api.util import get_env_var
+from api.config import REGIONS as AVAILABLE_LOCATIONS
+from api.config import POSTGRES_POOL_MAX_SIZE, CARBON_API_DATA_SIZE_PRECISION, STUCK_JOB_TIMEOUT
+from api.config import DEFERRAL_MIN_DELAY, DEFERRAL_RETRY_INTERVAL, DEFERRAL_POLL_INTERVAL, DEFERRAL_RELEASE_BATCH_SIZE
+
+APP_ROLE = get_env_var('APP_ROLE')
+
+logger = logging.getLogger('uvicorn.error')
+
+async def _init_connection(conn: asyncpg.Connection):
+    await conn.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+async def create_db_pool() -> asyncpg.Pool:
+    try:
+        return await asyncpg.create_pool(host=get_env_var('POSTGRES_HOST'),
+                                         database=get_env_var('POSTGRES_DB'),
+                                         user=get_env_var('POSTGRES_USER'),
+                                         password=get_env_var('POSTGRES_PASSWORD'),
+                                         min_size=1,
+                                         max_size=POSTGRES_POOL_MAX_SIZE,
+                                         init=_init_connection)
+    except Exception as ex:
+        DB_ERRORS.labels('connect').inc()
+        raise ValueError("Failed to connect to database.") from ex
+
+
+class AsyncJobDispatcher:
+    """Asyncio counterpart of `JobDispatcher` for single job submissions.
+
+    Dataset sizes are read from the DatasetSize table, which the WSGI service keeps up to date. Jobs are
+    kept away from regions whose queue backlog is saturated, but region capacity reports are not used.
+    """
+
+    def __init__(self, pool: asyncpg.Pool, carbon_api_client: AsyncCarbonApiClient, job_queue: AsyncJobQueue,
+                 region_backlog: AsyncRegionBacklogMonitor):
+        self.pool = pool
+        self.carbon_api_client = carbon_api_client
+        self.job_queue = job_queue
+        self.region_backlog = region_backlog
+
+    async def save_job_request(self, job_id: str, job_request: JobRequest, idempotency_key: str = None) -> tuple[str, str, dict | None] | None:
+        """Save the job request, or return the (job id, job name, saved request) of the job already saved with the same idempotency key."""
+        try:
+            with time_stage('save_job_request'):
+                async with self.pool.acquire() as conn:
+                    inserted_job_id = await conn.fetchval('''INSERT INTO JobRequest (job_id, name, image, command, max_delay, idempotency_key, request)
+                                                                VALUES ($1, $2, $3, $4, $5, $6, $7)
+                                                                ON CONFLICT (idempotency_key) DO NOTHING
+                                                                RETURNING job_id;''',
+                                                          uuid.UUID(job_id), job_request.spec.name, job_request.spec.image,
+                                                          ' '.join(job_request.spec.command), job_request.spec.max_delay, idempotency_key,
+                                                          dump_job_request(job_request))
+                    if inserted_job_id is not None:
+                        return None
+                    row = await conn.fetchrow('SELECT job_id, name, request FROM JobRequest WHERE idempotency_key = $1;', idempotency_key)
+                    return str(row['job_id']), row['name'], row['request']
+        except asyncpg.PostgresError as ex:
+            DB_ERRORS.labels('execute').inc()
+            raise ValueError(f'Failed to save job request (job_id={job_id}).') from ex
+
+    async def save_job_history(self, job_id: str, event: str, timestamp: datetime, conn: asyncpg.Connection = None):
+        await self.save_job_histories([job_id], event, timestamp, conn)
+
+    async def save_job_histories(self, job_ids: list[str], event: str, timestamp: datetime, conn: asyncpg.Connection = None):
+        try:
+            with time_stage('save_job_history'):
+                await (conn or self.pool).execute(f'''INSERT INTO JobHistory (job_id, event, time, origin)
+                                                        SELECT unnest($1::uuid[]), $2, $3, $4
+                                                        {get_job_history_conflict_clause(event)}''',
+                                                  [uuid.UUID(str(job_id)) for job_id in job_ids], event, timestamp, APP_ROLE)
+        except asyncpg.PostgresError as ex:
+            DB_ERRORS.labels('execute').inc()
+            raise ValueError(f'Failed to save job history for {len(job_ids)} jobs.') from ex
+
+    async def get_last_event(self, job_id: str) -> str | None:
+        return await self.pool.fetchval('SELECT event FROM JobCurrentState WHERE job_id = $1;', uuid.UUID(job_id))
+
+    async def claim_retry(self, job_id: str, stuck_after: timedelta = STUCK_JOB_TIMEOUT) -> bool:
+        """See `JobDispatcher.claim_retry()`."""
+        return await self.pool.fetchval(f'''WITH undispatched AS (
+                                                SELECT state.job_id, state.time FROM JobCurrentState state
+                                                    WHERE state.job_id = $1
+                                                        AND (state.event IN ('PlacementFailed', 'EnqueueFailed')
+                                                             OR state.event IN ('Created', 'Retrying') AND state.time < now() - $2::interval
+                                                                AND NOT EXISTS (SELECT FROM JobPlacementLease lease
+                                                                                    WHERE lease.job_id = state.job_id AND lease.expires_at >= now()))
+                                                    FOR UPDATE)
+                                            INSERT INTO JobHistory (job_id, event, time, origin)
+                                                SELECT job_id, 'Retrying', greatest(now(), time), $3 FROM undispatched
+                                                {get_job_history_conflict_clause('Retrying')}
+                                                RETURNING job_id;''', uuid.UUID(job_id), stuck_after, APP_ROLE) is not None
+
+    async def get_best_location(self, job_request: JobRequest) -> Placement:
+        with time_stage('get_best_location'):
+            return get_best_placement(job_request, await self._get_emissions_by_location(job_request),
+                                      self.region_backlog.get_saturated_regions())
+
+    async def dispatch_job(self, job_id: str, job_request: JobRequest, placement: Placement):
+        """Enqueue the job if it should start now, or hold it until its start time otherwise."""
+        job_message = create_job_message(job_id, job_request, placement)
+        if placement.start_time is not None and placement.start_time > datetime.now(timezone.utc) + DEFERRAL_MIN_DELAY:
+            try:
+                async with self.pool.acquire() as conn, conn.transaction():
+                    await conn.execute('INSERT INTO JobDeferral (job_id, region, message, dispatch_time) VALUES ($1, $2, $3, $4)',
+                                       uuid.UUID(job_id), placement.region, job_message, placement.start_time)
+                    await self.save_job_history(job_id, 'Deferred', datetime.now(timezone.utc), conn)
+            except asyncpg.PostgresError as ex:
+                DB_ERRORS.labels('execute').inc()
+                raise ValueError(f'Failed to defer job {job_id}.') from ex
+            return
+        with time_stage('enqueue'):
+            await self.job_queue.send_message_to_region(placement.region, serialize_job_message(job_message))
+        self.region_backlog.record_enqueued(placement.region, 1)
+        try:
+            await self.save_job_history(job_id, 'Enqueued', datetime.now(timezone.utc))
+        except Exception:
+            # The job is already on its queue, so report it as dispatched regardless.
+            logger.error('Failed to record Enqueued event', exc_info=True)
+
+    async def release_due_jobs(self, limit: int) -> int:
+        """Enqueue up to `limit` deferred jobs whose start time has come, see `JobDispatcher.release_due_jobs()`."""
+        async with self.pool.acquire() as conn, conn.transaction():
+            rows = await conn.fetch('''SELECT job_id, region, message FROM JobDeferral
+                                        WHERE dispatch_time <= now()
+                                        ORDER BY dispatch_time
+                                        LIMIT $1
+                                        FOR UPDATE SKIP LOCKED;''', limit)
+            if not rows:
+                return 0
+            logger.info(f'Releasing {len(rows)} deferred jobs ...')
+            # Jobs of saturated regions are held back like jobs that failed to be enqueued.
+            saturated_regions = self.region_backlog.get_saturated_regions()
+            due_rows = [row for row in rows if row['region'] not in saturated_regions]
+            results = await asyncio.gather(*[
+                self.job_queue.send_message_to_region(row['region'], serialize_job_message(row['message'])) for row in due_rows
+            ], return_exceptions=True)
+            released_rows = [row for row, result in zip(due_rows, results) if not isinstance(result, BaseException)]
+            released_job_ids = [row['job_id'] for row in released_rows]
+            failed_job_ids = list({ row['job_id'] for row in rows } - set(released_job_ids))
+            for row in released_rows:
+                self.region_backlog.record_enqueued(row['region'], 1)
+            if released_job_ids:
+                await conn.execute('DELETE FROM JobDeferral WHERE job_id = ANY($1::uuid[]);', released_job_ids)
+                await self.save_job_histories(released_job_ids, 'Enqueued', datetime.now(timezone.utc), conn)
+            if failed_job_ids:
+                await conn.execute('UPDATE JobDeferral SET dispatch_time = $1 WHERE job_id = ANY($2::uuid[]);',
+                                   datetime.now(timezone.utc) + DEFERRAL_RETRY_INTERVAL, failed_job_ids)
+        return len(rows)
+
+    async def run_deferred_job_releaser(self):
+        """Release deferred jobs as they become due, until cancelled. See `DeferredJobReleaser`."""
+        while True:
+            wait_time = DEFERRAL_POLL_INTERVAL
+            try:
+                while await self.release_due_jobs(DEFERRAL_RELEASE_BATCH_SIZE) == DEFERRAL_RELEASE_BATCH_SIZE:
+                    pass
+                next_dispatch_time = await self.pool.fetchval('SELECT min(dispatch_time) FROM JobDeferral;')
+                if next_dispatch_time is not None:
+                    wait_time = min(max((next_dispatch_time - datetime.now(timezone.utc)).total_seconds(), 0), DEFERRAL_POLL_INTERVAL)
+            except Exception:
+                logger.error('Failed to release deferred jobs', exc_info=True)
+            await asyncio.sleep(wait_time)
+
+    async def _get_data_size(self, mountpoints: dict[str, str]) -> float:
+        if not mountpoints:
+            return 0
+        size_bytes = await self.pool.fetchval('SELECT coalesce(sum(size_bytes), 0) FROM DatasetSize WHERE url = ANY($1::text[]);',
+                                              [normalize_storage_url(url) for url in mountpoints.values()])
+        return round(size_bytes / 1e9, CARBON_API_DATA_SIZE_PRECISION)
+
+    async def _get_emissions_by_location(self, job_request: JobRequest) -> dict[str, dict] | None:
+        try:
+            emissions_by_location = await self.carbon_api_client.get_carbon_emissions_by_location(
+                job_request.original_location,
+                AVAILABLE_LOCATIONS,
+                await self._get_data_size(job_request.inputs),
+                await self._get_data_size(job_request.outputs),
+                job_request.spec.max_delay
+            )
+            missing_locations = set(AVAILABLE_LOCATIONS) - set(emissions_by_location.keys())
+            if missing_locations:
+                raise ValueError(f'No emission estimates for {missing_locations}')
+            return emissions_by_location
+        except Exception:
+            logger.warning('Failed to obtain best location to run job, returning default ...', exc_info=True)
+            return None
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import logging
+from collections import defaultdict, deque
+import aio_pika
+
+from api.helpers.metrics import QUEUE_ERRORS
+from api.config import BROKER_URL, QUEUE_PERFIX, REGIONS, QUEUE_PUBLISHER
+
+logger = logging.getLogger('uvicorn.error')
+
+class AsyncJobQueue:
+    """Publish job messages with aio-pika over a robust connection with publisher confirms.
+
+    Publishes are awaited until confirmed by the broker, so many can be in flight on one channel. With
+    the "memory" publisher, messages are kept in process memory instead, see `InMemoryPublisher`.
+    """
+
+    def __init__(self, regions: list[str] = REGIONS, publisher_type: str = QUEUE_PUBLISHER):
+        self.regions = regions
+        self.publisher_type = publisher_type
+        self.connection: aio_pika.abc.AbstractRobustConnection = None
+        self.channel: aio_pika.abc.AbstractChannel = None
+        self.messages: dict[str, deque[str]] = defaultdict(deque)
+
+    async def connect(self):
+        if self.publisher_type == 'memory':
+            return
+        self.connection = await aio_pika.connect_robust(BROKER_URL)
+        self.channel = await self.connection.channel(publisher_confirms=True)
+        for region in self.regions:
+            await self.channel.declare_queue(self._get_queue_name(region), durable=True)
+
+    async def close(self):
+        if self.connection is not None:
+            await self.connection.close()
+
+    async def get_backlogs(self) -> dict[str, int]:
+        """Get the number of messages waiting in the queue of each region."""
+        backlogs = {}
+        for region in self.regions:
+            queue_name = self._get_queue_name(region)
+            if self.publisher_type == 'memory':
+                backlogs[region] = len(self.messages[queue_name])
+            else:
+                queue = await self.channel.declare_queue(queue_name, passive=True)
+                backlogs[region] = queue.declaration_result.message_count
+        return backlogs
+
+    async def send_message_to_region(self, region: str, message: str):
+        try:
+            if self.publisher_type == 'memory':
+                self.messages[self._get_queue_name(region)].append(message)
+                return
+            await self.channel.default_exchange.publish(
+                aio_pika.Message(message.encode(), delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+                routing_key=self._get_queue_name(region),
+                mandatory=True)
+        except Exception:
+            QUEUE_ERRORS.labels(region).inc()
+            raise
+
+    def _get_queue_name(self, region: str) -> str:
+        return f"{QUEUE_PERFIX}.{region}"
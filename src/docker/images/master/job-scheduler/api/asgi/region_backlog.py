@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+import asyncio
+import logging
+
+from api.helpers.region_backlog import RegionBacklogMonitor
+
+logger = logging.getLogger('uvicorn.error')
+
+class AsyncRegionBacklogMonitor(RegionBacklogMonitor):
+    """Asyncio counterpart of `RegionBacklogMonitor`, over an `AsyncJobQueue`.
+
+    Queue depths are refreshed by `run()` in the background instead of by the callers, so that requests
+    never wait for the broker.
+    """
+
+    def get_backlogs(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.backlogs)
+
+    async def run(self):
+        """Refresh queue depths every refresh interval, until cancelled."""
+        if not self.is_enabled():
+            return
+        while True:
+            try:
+                self.update(await self.job_queue.get_backlogs())
+            except Exception as ex:
+                logger.warning(f'Failed to get region backlogs, keeping the last known ones: {ex!r}')
+            await asyncio.sleep(self.refresh_interval)
@@ -1,10 +1,102 @@
 #!/usr/bin/env python3
 
-from api.util import get_env_var
+from datetime import timedelta
+
+from api.util import get_env_var, get_env_var_or_default
 
 BROKER_URL = get_env_var("BROKER_URL")
 QUEUE_PERFIX = get_env_var("QUEUE_PERFIX")
 REGIONS = get_env_var("REGIONS").split(":")
 CARBON_API_ENDPOINT = get_env_var("CARBON_API_ENDPOINT")
+CARBON_API_TIMEOUT = float(get_env_var_or_default("CARBON_API_TIMEOUT", 10))
+CARBON_API_LOCATION_PREFIX = get_env_var_or_default("CARBON_API_LOCATION_PREFIX", "Nautilus")
+CARBON_API_DEFAULT_RUNTIME = int(get_env_var_or_default("CARBON_API_DEFAULT_RUNTIME", 900))
+CARBON_API_WATTS_PER_CORE = float(get_env_var_or_default("CARBON_API_WATTS_PER_CORE", 5))
+CARBON_DATA_SOURCE = get_env_var_or_default("CARBON_DATA_SOURCE", "azure")
+# Carbon data granularity in seconds; lookups are cached per time bucket of this size.
+CARBON_DATA_GRANULARITY = int(get_env_var_or_default("CARBON_DATA_GRANULARITY", 300))
+CARBON_API_CACHE_TTL = float(get_env_var_or_default("CARBON_API_CACHE_TTL", CARBON_DATA_GRANULARITY))
+# Number of decimal places (in GB) data sizes are rounded to before lookup.
+CARBON_API_DATA_SIZE_PRECISION = int(get_env_var_or_default("CARBON_API_DATA_SIZE_PRECISION", 0))
+
+# One of "pika" (persistent connection), "amqp-tools" (spawn amqp-publish per message) or "memory".
+QUEUE_PUBLISHER = get_env_var_or_default("QUEUE_PUBLISHER", "pika")
+PUBLISHER_MAX_ATTEMPTS = int(get_env_var_or_default("PUBLISHER_MAX_ATTEMPTS", 3))
+# Job messages whose JSON is larger than this many bytes are sent compressed.
+JOB_MESSAGE_COMPRESSION_THRESHOLD = int(get_env_var_or_default("JOB_MESSAGE_COMPRESSION_THRESHOLD", 4096))
+
+BATCH_MAX_SIZE = int(get_env_var_or_default("BATCH_MAX_SIZE", 1000))
+
+# Number of idempotency keys of dispatched jobs kept in memory by each worker, in front of the database.
+IDEMPOTENCY_CACHE_SIZE = int(get_env_var_or_default("IDEMPOTENCY_CACHE_SIZE", 10000))
+
+STATUS_BULK_MAX_SIZE = int(get_env_var_or_default("STATUS_BULK_MAX_SIZE", 10000))
+STATUS_LIST_MAX_LIMIT = int(get_env_var_or_default("STATUS_LIST_MAX_LIMIT", 10000))
+# Status streams send a keep-alive comment when idle, and are closed after the max duration.
+STATUS_STREAM_KEEPALIVE_INTERVAL = float(get_env_var_or_default("STATUS_STREAM_KEEPALIVE_INTERVAL", 15))
+STATUS_STREAM_MAX_DURATION = float(get_env_var_or_default("STATUS_STREAM_MAX_DURATION", 3600))
+
+# Number of jobs whose last event is kept in memory by the job event listener of each worker.
+JOB_EVENT_CACHE_SIZE = int(get_env_var_or_default("JOB_EVENT_CACHE_SIZE", 100000))
+JOB_EVENT_SUBSCRIBER_QUEUE_SIZE = int(get_env_var_or_default("JOB_EVENT_SUBSCRIBER_QUEUE_SIZE", 100))
+
+# When enabled, submissions return 202 right after the job is saved, and a background placement
+# worker places and enqueues jobs in batches.
+ASYNC_PLACEMENT = get_env_var_or_default("ASYNC_PLACEMENT", "false").lower() in ("1", "true", "yes")
+PLACEMENT_BATCH_SIZE = int(get_env_var_or_default("PLACEMENT_BATCH_SIZE", 100))
+PLACEMENT_BATCH_WAIT = float(get_env_var_or_default("PLACEMENT_BATCH_WAIT", 0.2))
+PLACEMENT_SHUTDOWN_TIMEOUT = float(get_env_var_or_default("PLACEMENT_SHUTDOWN_TIMEOUT", 20))
+# Jobs held by a placement worker are leased for this long, and the lease is renewed at every sweep
+# interval. Jobs whose lease expired, because their worker died before placing them, are placed again.
+STUCK_JOB_TIMEOUT = timedelta(seconds=float(get_env_var_or_default("STUCK_JOB_TIMEOUT", 300)))
+STUCK_JOB_SWEEP_INTERVAL = float(get_env_var_or_default("STUCK_JOB_SWEEP_INTERVAL", 60))
+
+# CPU cores and memory bytes that one placement batch may assign to each region.
+PLACEMENT_REGION_CPU_BUDGET = float(get_env_var_or_default("PLACEMENT_REGION_CPU_BUDGET", "inf"))
+PLACEMENT_REGION_MEMORY_BUDGET = float(get_env_var_or_default("PLACEMENT_REGION_MEMORY_BUDGET", "inf"))
+
+# Dataset sizes older than the TTL (in seconds) are re-probed in the background.
+DATASET_SIZE_TTL = float(get_env_var_or_default("DATASET_SIZE_TTL", 6 * 3600))
+DATASET_SIZE_REFRESH_INTERVAL = float(get_env_var_or_default("DATASET_SIZE_REFRESH_INTERVAL", 60))
+# Refreshes read again the sizes updated this many seconds before the last one they saw, as rows may be
+# committed after rows that were updated later.
+DATASET_SIZE_REFRESH_OVERLAP = timedelta(seconds=float(get_env_var_or_default("DATASET_SIZE_REFRESH_OVERLAP", 10)))
+# PVC sizes are recorded by the agents from the outputs of completed jobs.
+DATASET_SIZE_PROBERS = [t for t in get_env_var_or_default("DATASET_SIZE_PROBERS", "s3").split(",") if t]
+
+# Regions with at least this many messages waiting in their queue are saturated, and receive no new jobs.
+REGION_BACKLOG_LIMIT = float(get_env_var_or_default("REGION_BACKLOG_LIMIT", "inf"))
+REGION_BACKLOG_REFRESH_INTERVAL = float(get_env_var_or_default("REGION_BACKLOG_REFRESH_INTERVAL", 5))
+# What to do with new submissions when every region is saturated: "reject" them with 429, or "defer"
+# them by ADMISSION_DEFER_DELAY. Jobs that were already accepted are always deferred.
+ADMISSION_POLICY = get_env_var_or_default("ADMISSION_POLICY", "reject")
+ADMISSION_DEFER_DELAY = timedelta(seconds=float(get_env_var_or_default("ADMISSION_DEFER_DELAY", 300)))
+
+# Regions whose agent heartbeat is older than this many seconds, or that have no free CPU or memory,
+# receive no new jobs while other regions can take them.
+REGION_CAPACITY_STALE_AFTER = float(get_env_var_or_default("REGION_CAPACITY_STALE_AFTER", 90))
+REGION_CAPACITY_REFRESH_INTERVAL = float(get_env_var_or_default("REGION_CAPACITY_REFRESH_INTERVAL", 10))
+
+# Delay-tolerant jobs whose best start time is further out than this are held until then.
+DEFERRAL_MIN_DELAY = timedelta(seconds=float(get_env_var_or_default("DEFERRAL_MIN_DELAY", 60)))
+DEFERRAL_RETRY_INTERVAL = timedelta(seconds=float(get_env_var_or_default("DEFERRAL_RETRY_INTERVAL", 30)))
+DEFERRAL_POLL_INTERVAL = float(get_env_var_or_default("DEFERRAL_POLL_INTERVAL", 30))
+DEFERRAL_RELEASE_BATCH_SIZE = int(get_env_var_or_default("DEFERRAL_RELEASE_BATCH_SIZE", 500))
+
+# Latency analytics are computed per time window of job submissions, and cached per window for the TTL.
+ANALYTICS_CACHE_TTL = float(get_env_var_or_default("ANALYTICS_CACHE_TTL", 300))
+ANALYTICS_MAX_WINDOWS = int(get_env_var_or_default("ANALYTICS_MAX_WINDOWS", 1000))
+
+# Request threads of each gunicorn worker, see gunicorn.conf.py.
+GUNICORN_THREADS = int(get_env_var_or_default("GUNICORN_THREADS", 8))
+# Every request thread may hold a connection, and so may the placement worker, the stuck job sweeper, the
+# deferred job releaser, the dataset size index and the region capacity monitor.
+POSTGRES_POOL_MAX_SIZE = int(get_env_var_or_default("POSTGRES_POOL_MAX_SIZE", GUNICORN_THREADS + 5))
+POSTGRES_POOL_CHECKOUT_TIMEOUT = float(get_env_var_or_default("POSTGRES_POOL_CHECKOUT_TIMEOUT", 5))
+POSTGRES_POOL_HEALTH_CHECK_INTERVAL = float(get_env_var_or_default("POSTGRES_POOL_HEALTH_CHECK_INTERVAL", 30))
 
 assert len(REGIONS) > 0, 'Must have at least one region'
+assert POSTGRES_POOL_MAX_SIZE >= GUNICORN_THREADS, 'POSTGRES_POOL_MAX_SIZE must be at least GUNICORN_THREADS'
+assert ADMISSION_POLICY in ("reject", "defer"), f'Unknown admission policy "{ADMISSION_POLICY}"'
+assert ADMISSION_DEFER_DELAY > DEFERRAL_MIN_DELAY, 'ADMISSION_DEFER_DELAY must exceed DEFERRAL_MIN_DELAY'
+assert STUCK_JOB_SWEEP_INTERVAL < STUCK_JOB_TIMEOUT.total_seconds(), 'STUCK_JOB_SWEEP_INTERVAL must be less than STUCK_JOB_TIMEOUT'
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import asyncio
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+class _InFlightCall:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value: Any = None
+        self.error: Exception = None
+
+
+class TtlCache:
+    """A thread-safe LRU cache whose entries expire `ttl` seconds after they are stored.
+
+    Concurrent `get_or_compute()` calls for the same missing key share a single computation.
+    """
+
+    def __init__(self, ttl: float, max_size: int = 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.in_flight: dict[Hashable, _InFlightCall] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return entry[1]
+            call = self.in_flight.get(key)
+            if call is None:
+                self.misses += 1
+                call = self.in_flight[key] = _InFlightCall()
+                is_leader = True
+            else:
+                self.coalesced += 1
+                is_leader = False
+
+        if not is_leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = compute()
+            self.put(key, call.value)
+            return call.value
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            call.event.set()
+
+    def get(self, key: Hashable) -> Any | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get_stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+            }
+
+
+class AsyncTtlCache:
+    """An asyncio counterpart of `TtlCache`, for use from a single event loop."""
+
+    def __init__(self, ttl: float, max_size: int = 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.in_flight: dict[Hashable, asyncio.Future] = {}
+
+    async def get_or_compute(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            return entry[1]
+        future = self.in_flight.get(key)
+        if future is not None:
+            # Shielded, so that a cancelled waiter does not cancel the shared computation.
+            return await asyncio.shield(future)
+        future = self.in_flight[key] = asyncio.ensure_future(compute())
+        try:
+            value = await asyncio.shield(future)
+        finally:
+            self.in_flight.pop(key, None)
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return value
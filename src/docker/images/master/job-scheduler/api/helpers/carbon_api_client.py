@@ -1,12 +1,118 @@
 #!/usr/bin/env python3
 
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone, timedelta
+from flask import current_app
 import requests
 
-from api.models.job_request import JobLocation
+from api.helpers.cache import TtlCache
+from api.helpers.metrics import CARBON_API_LATENCY
+from api.config import *
+
+def get_time_bucket(t: datetime) -> datetime:
+    timestamp = t.timestamp()
+    return datetime.fromtimestamp(timestamp - timestamp % CARBON_DATA_GRANULARITY, tz=timezone.utc)
+
+def to_carbon_api_location(location: str) -> str:
+    return f'{CARBON_API_LOCATION_PREFIX}:{location}'
+
+def from_carbon_api_location(location_id: str) -> str:
+    return location_id.removeprefix(f'{CARBON_API_LOCATION_PREFIX}:')
+
+
+@dataclass(frozen=True)
+class CarbonLookup:
+    """A carbon API lookup, with its parameters bucketed so that it can be used as a cache key."""
+    original_location: str
+    candidate_locations: tuple[str, ...]
+    start_time: datetime
+    input_size_gb: float
+    output_size_gb: float
+    max_delay_s: int
+
+    @staticmethod
+    def create(original_location: str, candidate_locations: list[str], input_size_gb: float = 0, output_size_gb: float = 0,
+               max_delay: timedelta = timedelta()) -> 'CarbonLookup':
+        return CarbonLookup(original_location,
+                            tuple(sorted(candidate_locations)),
+                            get_time_bucket(datetime.now(timezone.utc)),
+                            round(input_size_gb, CARBON_API_DATA_SIZE_PRECISION),
+                            round(output_size_gb, CARBON_API_DATA_SIZE_PRECISION),
+                            int(max_delay.total_seconds()) // CARBON_DATA_GRANULARITY * CARBON_DATA_GRANULARITY)
+
+    def get_payload(self) -> dict:
+        return {
+            'runtime': CARBON_API_DEFAULT_RUNTIME,
+            'schedule': {
+                'type': 'onetime',
+                'start_time': self.start_time.isoformat(),
+                'max_delay': self.max_delay_s,
+            },
+            'dataset': {
+                'input_size_gb': self.input_size_gb,
+                'output_size_gb': self.output_size_gb,
+            },
+            'original_location': to_carbon_api_location(self.original_location) if self.original_location else None,
+            'candidate_locations': [{ 'id': to_carbon_api_location(location) } for location in self.candidate_locations],
+            'use_prediction': True,
+            'carbon_data_source': CARBON_DATA_SOURCE,
+            'watts_per_core': CARBON_API_WATTS_PER_CORE,
+            'core_count': 1,
+        }
+
+    def parse_response(self, result: dict) -> dict[str, dict]:
+        """Get the emissions by location from a carbon API response.
+
+        Returns a dict from location to its `total_emission`, `compute_emission`, `migration_emission`,
+        `weighted_score` and `start_time`, the lowest-carbon time within the max delay for the job to start.
+        """
+        try:
+            emissions_by_location = {}
+            for location_id, raw_scores in result['raw-scores'].items():
+                emissions_by_location[from_carbon_api_location(location_id)] = {
+                    'total_emission': raw_scores['carbon-emission'],
+                    'compute_emission': raw_scores['carbon-emission-from-compute'],
+                    'migration_emission': raw_scores['carbon-emission-from-migration'],
+                    'weighted_score': result['weighted-scores'][location_id],
+                    # Start delays are reported in seconds relative to the requested start time, one per schedule occurrence.
+                    'start_time': self.start_time + timedelta(seconds=min(result['details'][location_id]['start_delay'][0], self.max_delay_s)),
+                }
+        except (KeyError, IndexError, TypeError) as ex:
+            raise ValueError(f'Unexpected response from carbon API: {result}') from ex
+        if not emissions_by_location:
+            raise ValueError(f'Carbon API returned no candidate locations: {result}')
+        return emissions_by_location
+
 
 class CarbonApiClient:
+    """Client of the carbon API, with lookups cached per candidate set, time bucket and data size."""
+
     def __init__(self):
         self.session = requests.Session()
+        self.url = f'http://{CARBON_API_ENDPOINT}/carbon-aware-scheduler/'
+        self.cache = TtlCache(CARBON_API_CACHE_TTL)
+
+    def get_carbon_emissions_by_location(self, original_location: str, candidate_locations: list[str], input_size_gb: float = 0, output_size_gb: float = 0,
+                                         max_delay: timedelta = timedelta()) -> dict[str, dict]:
+        """Get the estimated emissions of running a job in each candidate location, see `CarbonLookup.parse_response()`."""
+        lookup = CarbonLookup.create(original_location, candidate_locations, input_size_gb, output_size_gb, max_delay)
+        return self.cache.get_or_compute(lookup, lambda: self._request_carbon_emissions(lookup))
+
+    def get_stats(self) -> dict:
+        return {
+            'cache': self.cache.get_stats(),
+        }
 
-    def get_carbon_emissions_by_location(self, original_location: str, candidate_locations: list[JobLocation], input_size_gb: int = 0, output_size_gb: int = 0) -> list:
-        raise NotImplementedError()
+    def _request_carbon_emissions(self, lookup: CarbonLookup) -> dict[str, dict]:
+        current_app.logger.info(f'Requesting carbon emissions for {lookup.candidate_locations} at {lookup.start_time} ...')
+        start = time.monotonic()
+        try:
+            response = self.session.get(self.url, json=lookup.get_payload(), timeout=CARBON_API_TIMEOUT)
+            response.raise_for_status()
+            result = response.json()
+        except Exception as ex:
+            raise ValueError(f'Failed to get carbon emissions from carbon API: {ex}') from ex
+        finally:
+            CARBON_API_LATENCY.observe(time.monotonic() - start)
+        return lookup.parse_response(result)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import json
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable
+from flask import current_app
+
+from api.models.job_request import parse_storage_url
+from api.helpers.postgres import *
+from api.util import get_command_output
+from api.config import DATASET_SIZE_TTL, DATASET_SIZE_REFRESH_INTERVAL, DATASET_SIZE_REFRESH_OVERLAP, DATASET_SIZE_PROBERS
+
+def normalize_storage_url(url: str) -> str:
+    return url.rstrip('/')
+
+def probe_s3_size(paths: list[str]) -> int:
+    """Get the size of an S3 path in bytes, using the rclone remote named after its region."""
+    region, path = paths
+    result = get_command_output(['rclone', 'size', '--json', f'{region}:{path}'])
+    return int(json.loads(result)['bytes'])
+
+PROBERS: dict[str, tuple[str, Callable[[list[str]], int]]] = {
+    # storage type: (required command, prober)
+    's3': ('rclone', probe_s3_size),
+}
+
+
+class DatasetSizeIndex:
+    """In-memory index of dataset sizes by storage URL, backed by the DatasetSize table.
+
+    Lookups are dictionary reads and never touch the database. A background thread pulls rows updated
+    since its last refresh, by their update time set by the database, and probes URLs that were looked up but are unknown or older than the TTL.
+    The sizes of PVCs cannot be probed from here; agents record them as jobs that write to them complete.
+    """
+
+    def __init__(self, ttl: float = DATASET_SIZE_TTL, refresh_interval: float = DATASET_SIZE_REFRESH_INTERVAL,
+                 prober_types: list[str] = DATASET_SIZE_PROBERS):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.prober_types = prober_types
+        self.probers: dict[str, Callable[[list[str]], int]] = {}
+        # Normalized URL -> (size in bytes, update time as a POSIX timestamp)
+        self.sizes: dict[str, tuple[int, float]] = {}
+        self.lock = threading.Lock()
+        self.urls_to_probe: set[str] = set()
+        self.last_update_time = datetime.fromtimestamp(0, tz=timezone.utc)
+        self.thread: threading.Thread = None
+
+    def get_size_bytes(self, url: str) -> int | None:
+        url = normalize_storage_url(url)
+        entry = self.sizes.get(url)
+        if entry is None or time.time() - entry[1] > self.ttl:
+            with self.lock:
+                self.urls_to_probe.add(url)
+        return entry[0] if entry is not None else None
+
+    def get_total_size_gb(self, urls: list[str]) -> float:
+        """Get the total size of the given datasets in GB, counting unknown ones as empty."""
+        return sum(self.get_size_bytes(url) or 0 for url in urls) / 1e9
+
+    def record_sizes(self, sizes: dict[str, int], source: str):
+        if not sizes:
+            return
+        with get_pooled_db_cursor() as cursor:
+            psql_execute_values(cursor, '''INSERT INTO DatasetSize (url, size_bytes, source) VALUES %s
+                                            ON CONFLICT (url) DO UPDATE
+                                                SET size_bytes = EXCLUDED.size_bytes,
+                                                    updated_at = EXCLUDED.updated_at,
+                                                    source = EXCLUDED.source;''', [
+                (url, size, source) for url, size in sizes.items()
+            ])
+        now = time.time()
+        for url, size in sizes.items():
+            self.sizes[url] = (size, now)
+
+    def start(self, app):
+        for storage_type in self.prober_types:
+            command, prober = PROBERS[storage_type]
+            if shutil.which(command):
+                self.probers[storage_type] = prober
+            else:
+                app.logger.warning(f'{command} not found, dataset sizes of {storage_type} storage will not be probed.')
+        self.thread = threading.Thread(target=self._run, args=(app,), name='dataset-size-index', daemon=True)
+        self.thread.start()
+
+    def _run(self, app):
+        with app.app_context():
+            while True:
+                try:
+                    self._refresh()
+                    self._probe()
+                except Exception:
+                    current_app.logger.error('Failed to update dataset size index', exc_info=True)
+                time.sleep(self.refresh_interval)
+
+    def _refresh(self):
+        """Load the sizes updated since the last refresh, including those recorded by other workers and agents."""
+        with get_pooled_db_cursor() as cursor:
+            rows = psql_execute_list(cursor, 'SELECT url, size_bytes, updated_at FROM DatasetSize WHERE updated_at > %s;',
+                                     [self.last_update_time - DATASET_SIZE_REFRESH_OVERLAP], fetch_result=True)
+        for url, size, updated_at in rows:
+            self.sizes[url] = (size, updated_at.timestamp())
+            self.last_update_time = max(self.last_update_time, updated_at)
+
+    def _probe(self):
+        with self.lock:
+            urls, self.urls_to_probe = self.urls_to_probe, set()
+        sizes = {}
+        for url in urls:
+            storage_type, paths = parse_storage_url(url)
+            if storage_type not in self.probers:
+                continue
+            try:
+                sizes[url] = self.probers[storage_type](paths)
+            except Exception as ex:
+                current_app.logger.warning(f'Failed to probe dataset size of {url}: {ex}')
+        if sizes:
+            current_app.logger.info(f'Probed dataset sizes: {sizes}')
+        self.record_sizes(sizes, 'probe')
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import threading
+from datetime import datetime, timezone
+from flask import current_app
+
+from api.helpers.job_dispatcher import JobDispatcher
+from api.config import DEFERRAL_POLL_INTERVAL, DEFERRAL_RELEASE_BATCH_SIZE
+
+class DeferredJobReleaser:
+    """Enqueue deferred jobs once their start time has come.
+
+    Held jobs are kept in the JobDeferral table, indexed by dispatch time, so they survive restarts.
+    Each gunicorn worker runs one releaser, which only reads the due head of that index; row locks
+    keep concurrent releasers from enqueuing the same job twice.
+    """
+
+    def __init__(self, job_dispatcher: JobDispatcher, poll_interval: float = DEFERRAL_POLL_INTERVAL,
+                 batch_size: int = DEFERRAL_RELEASE_BATCH_SIZE):
+        self.job_dispatcher = job_dispatcher
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+        self.thread: threading.Thread = None
+
+    def start(self, app):
+        self.thread = threading.Thread(target=self._run, args=(app,), name='deferred-job-releaser', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self, app):
+        with app.app_context():
+            current_app.logger.info('Deferred job releaser started.')
+            while not self.stopped.is_set():
+                self.stopped.wait(self._release_and_get_wait_time())
+
+    def _release_and_get_wait_time(self) -> float:
+        """Release all due jobs, and return how long to wait until the next one is due."""
+        try:
+            while self.job_dispatcher.release_due_jobs(self.batch_size) == self.batch_size:
+                pass
+            next_dispatch_time = self.job_dispatcher.get_next_dispatch_time()
+        except Exception:
+            current_app.logger.error('Failed to release deferred jobs', exc_info=True)
+            return self.poll_interval
+        if next_dispatch_time is None:
+            return self.poll_interval
+        wait_time = (next_dispatch_time - datetime.now(timezone.utc)).total_seconds()
+        return min(max(wait_time, 0), self.poll_interval)
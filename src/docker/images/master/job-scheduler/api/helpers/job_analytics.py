@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import math
+from datetime import datetime, timezone
+from flask import current_app
+
+from api.helpers.postgres import *
+from api.helpers.cache import TtlCache
+from api.config import ANALYTICS_CACHE_TTL
+
+# Stages of a job's life, as (name, start event, end event) of JobHistory.
+LATENCY_STAGES = [
+    ('submit_to_enqueue', 'Created', 'Enqueued'),
+    ('enqueue_to_dequeue', 'Enqueued', 'Dequeued'),
+    ('dequeue_to_create', 'Dequeued', 'KubeCreated'),
+    ('create_to_start', 'KubeCreated', 'Started'),
+    ('run', 'Started', 'Completed'),
+]
+LATENCY_PERCENTILES = [0.5, 0.9, 0.99]
+GROUP_BY_COLUMNS = ['region', 'image']
+
+
+class JobAnalytics:
+    """Latency percentiles of the stages of jobs, computed from JobHistory in a single set-based query.
+
+    Jobs are grouped by the time window of their submission, and optionally by region and image. The
+    region of a job is the one whose agent dequeued it. Results are cached per window for
+    ANALYTICS_CACHE_TTL, as windows keep changing while their jobs run.
+    """
+
+    def __init__(self, ttl: float = ANALYTICS_CACHE_TTL):
+        # (window start, window size, group by columns) -> groups of the window.
+        self.cache = TtlCache(ttl)
+
+    def get_stage_latencies(self, start: datetime, end: datetime, window: int, group_by: list[str]) -> list[dict]:
+        """Get the latency percentiles of every stage, per window of `window` seconds between `start` and `end`.
+
+        Windows are aligned on multiples of their size since the epoch.
+        """
+        group_by = [column for column in GROUP_BY_COLUMNS if column in group_by]
+        window_starts = range(math.floor(start.timestamp() / window) * window, math.ceil(end.timestamp() / window) * window, window)
+        windows = { window_start: self.cache.get((window_start, window, tuple(group_by))) for window_start in window_starts }
+        missing = [window_start for window_start, groups in windows.items() if groups is None]
+        if missing:
+            computed = self._compute(missing[0], missing[-1] + window, window, group_by)
+            for window_start in missing:
+                windows[window_start] = computed.get(window_start, [])
+                self.cache.put((window_start, window, tuple(group_by)), windows[window_start])
+        return [{ 'window_start': datetime.fromtimestamp(window_start, tz=timezone.utc), 'groups': groups }
+                for window_start, groups in windows.items()]
+
+    def _compute(self, start: int, end: int, window: int, group_by: list[str]) -> dict[int, list[dict]]:
+        current_app.logger.info(f'Computing stage latencies from {start} to {end} per {window}s, grouped by {group_by}')
+        event_columns = ',\n                            '.join(f"max(history.time) FILTER (WHERE history.event = '{event}') AS {event.lower()}"
+                                   for event in sorted({ event for _, *events in LATENCY_STAGES for event in events } - {'Created'}))
+        stage_values = ', '.join(f"('{stage}', extract(epoch FROM {end_event.lower()} - {start_event.lower()})::float8)"
+                                 for stage, start_event, end_event in LATENCY_STAGES)
+        group_columns = ''.join(f'{column}, ' for column in group_by)
+        try:
+            with get_pooled_db_cursor() as cursor:
+                rows = psql_execute_list(cursor, f'''
+                    WITH jobs AS (
+                        SELECT floor(extract(epoch FROM created.time) / %(window)s)::bigint * %(window)s AS window_start,
+                            request.image,
+                            max(regexp_replace(history.origin, '^.*\\.', '')) FILTER (WHERE history.event = 'Dequeued') AS region,
+                            created.time AS created,
+                            {event_columns}
+                        FROM JobHistory created
+                            INNER JOIN JobRequest request ON request.job_id = created.job_id
+                            INNER JOIN JobHistory history ON history.job_id = created.job_id
+                        WHERE created.event = 'Created' AND created.time >= to_timestamp(%(start)s) AND created.time < to_timestamp(%(end)s)
+                        GROUP BY created.job_id, created.time, request.image
+                    )
+                    SELECT window_start, {group_columns}stage, count(*),
+                            percentile_cont(%(percentiles)s::float8[]) WITHIN GROUP (ORDER BY latency)
+                        FROM jobs CROSS JOIN LATERAL (VALUES {stage_values}) AS stages(stage, latency)
+                        WHERE latency IS NOT NULL
+                        GROUP BY window_start, {group_columns}stage
+                        ORDER BY window_start, {group_columns}stage;''', {
+                    'window': window, 'start': start, 'end': end, 'percentiles': LATENCY_PERCENTILES,
+                }, fetch_result=True)
+        except Exception as ex:
+            raise ValueError('Failed to compute stage latencies.') from ex
+
+        windows: dict[int, dict[tuple, dict]] = {}
+        for window_start, *values in rows:
+            group_values = tuple(values[:len(group_by)])
+            stage, count, percentiles = values[len(group_by):]
+            groups = windows.setdefault(int(window_start), {})
+            group = groups.setdefault(group_values, dict(zip(group_by, group_values)) | { 'stages': {} })
+            group['stages'][stage] = { 'count': count } | {
+                f'p{round(percentile * 100)}': value for percentile, value in zip(LATENCY_PERCENTILES, percentiles)
+            }
+        return { window_start: list(groups.values()) for window_start, groups in windows.items() }
@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+import marshmallow_dataclass
+import numpy as np
+
+from api.models.job_request import JobRequest
+from api.helpers.placement_engine import score_jobs, assign_jobs, UNASSIGNED
+from api.helpers.carbon_api_client import CarbonApiClient
+from api.helpers.job_queue import JobQueue
+from api.helpers.dataset_size_index import DatasetSizeIndex
+from api.helpers.region_backlog import RegionBacklogMonitor
+from api.helpers.region_capacity import RegionCapacityMonitor
+from api.helpers.job_message import encode_job_message
+from api.helpers.metrics import time_stage, PLACEMENT_FALLBACKS, PLACEMENT_OVERFLOWS
+from api.helpers.postgres import *
+from api.config import REGIONS as AVAILABLE_LOCATIONS
+from api.config import DEFERRAL_MIN_DELAY, DEFERRAL_RETRY_INTERVAL, ADMISSION_DEFER_DELAY, STUCK_JOB_TIMEOUT
+from api.config import PLACEMENT_REGION_CPU_BUDGET, PLACEMENT_REGION_MEMORY_BUDGET, CARBON_API_DATA_SIZE_PRECISION
+from api.util import parse_kube_cpu, parse_kube_memory
+
+# Resource requests assumed by the agents for jobs that do not specify any.
+DEFAULT_REQUEST_CPU = 1.
+DEFAULT_REQUEST_MEMORY = parse_kube_memory('256Mi')
+
+# Events that a job goes through again when its dispatch is retried. They are recorded again at every
+# occurrence, so that the last one becomes the current state of the job; other events are recorded once.
+REPEATABLE_EVENTS = ('Retrying', 'PlacementFailed', 'EnqueueFailed')
+# Current states of the jobs that are not known to be dispatched, see `JobDispatcher.claim_retry()`.
+UNDISPATCHED_EVENTS = ('Created', 'Retrying', 'PlacementFailed', 'EnqueueFailed')
+
+APP_ROLE = get_env_var('APP_ROLE')
+JOB_REQUEST_SCHEMA = marshmallow_dataclass.class_schema(JobRequest)()
+
+
+def create_job_message(job_id: str, job_request: JobRequest, placement: 'Placement' = None) -> dict:
+    job_message = {
+        'job_id': job_id,
+        'name': job_request.spec.name,
+        'image': job_request.spec.image,
+        'command': job_request.spec.command,
+        # 'max_delay': job_request.spec.max_delay,
+        'inputs': job_request.get_parsed_mountpoints(job_request.inputs),
+        'outputs': job_request.get_parsed_mountpoints(job_request.outputs),
+    }
+    if job_request.resources:
+        job_message |= {
+            'resources.requests.cpu': job_request.resources.requests.cpu,
+            'resources.requests.memory': job_request.resources.requests.memory,
+            'resources.limits.cpu': job_request.resources.limits.cpu,
+            'resources.limits.memory': job_request.resources.limits.memory,
+        }
+    if placement is not None and placement.emissions is not None:
+        job_message['emissions'] = placement.emissions
+    return job_message
+
+def serialize_job_message(job_message: dict) -> str:
+    return encode_job_message(job_message)
+
+def get_job_history_conflict_clause(event: str) -> str:
+    """Get the ON CONFLICT clause of JobHistory inserts of an event, see REPEATABLE_EVENTS."""
+    if event in REPEATABLE_EVENTS:
+        return 'ON CONFLICT (job_id, event) DO UPDATE SET time = EXCLUDED.time, origin = EXCLUDED.origin'
+    return 'ON CONFLICT (job_id, event) DO NOTHING'
+
+def dump_job_request(job_request: JobRequest) -> dict:
+    """Get the JSON of a job request, as saved in JobRequest.request."""
+    return JOB_REQUEST_SCHEMA.dump(job_request)
+
+def load_job_request(request: dict) -> JobRequest:
+    return JOB_REQUEST_SCHEMA.load(request)
+
+def is_same_job_request(saved_request: dict | None, job_request: JobRequest) -> bool:
+    """Whether a submission asks for the same job as a saved request, e.g. when retried with the same idempotency key.
+
+    Names are compared without the job id suffix that every submission gets. Jobs saved before their
+    request was kept match any submission.
+    """
+    if saved_request is None:
+        return True
+    return _remove_job_name_suffix(dump_job_request(job_request)) == _remove_job_name_suffix(saved_request)
+
+def _remove_job_name_suffix(request: dict) -> dict:
+    return request | { 'spec': request['spec'] | { 'name': request['spec']['name'].rsplit('-', 1)[0] } }
+
+
+@dataclass
+class Placement:
+    region: str
+    # When the job should start, or None to start right away.
+    start_time: datetime = None
+    # Estimated total emission of the job in every region, if known. Lets idle agents of other regions
+    # judge whether to steal the job.
+    emissions: dict[str, float] = None
+
+def get_best_placement(job_request: JobRequest, emissions_by_location: dict[str, dict] | None,
+                       excluded_regions: set[str] = frozenset()) -> Placement:
+    """Get the lowest-emission placement of a job outside excluded regions, or the first region that is
+    not excluded if there are no estimates.
+
+    If every region is excluded, the job is placed as if none were, but held for ADMISSION_DEFER_DELAY.
+    See `JobDispatcher.get_excluded_regions()`.
+    """
+    candidate_locations = [location for location in AVAILABLE_LOCATIONS if location not in excluded_regions]
+    all_excluded = not candidate_locations
+    if all_excluded:
+        candidate_locations = AVAILABLE_LOCATIONS
+    if emissions_by_location is None:
+        PLACEMENT_FALLBACKS.inc()
+        placement = Placement(candidate_locations[0])
+    else:
+        best_location = min(candidate_locations, key=lambda k: emissions_by_location[k]['total_emission'])
+        start_time = emissions_by_location[best_location]['start_time'] if job_request.spec.max_delay else None
+        placement = Placement(best_location, start_time, get_total_emissions(emissions_by_location))
+    return _hold_placement(placement) if all_excluded else placement
+
+def _hold_placement(placement: Placement) -> Placement:
+    """Delay a placement until the backlogs of saturated regions had time to drain."""
+    hold_until = datetime.now(timezone.utc) + ADMISSION_DEFER_DELAY
+    return Placement(placement.region, max(placement.start_time or hold_until, hold_until), placement.emissions)
+
+def get_total_emissions(emissions_by_location: dict[str, dict]) -> dict[str, float]:
+    return { location: emissions['total_emission'] for location, emissions in emissions_by_location.items() }
+
+
+class JobDispatcher:
+    """Persist, place and enqueue jobs, batching database writes and placement decisions."""
+
+    def __init__(self, carbon_api_client: CarbonApiClient, job_queue: JobQueue, dataset_size_index: DatasetSizeIndex,
+                 region_backlog: RegionBacklogMonitor, region_capacity: RegionCapacityMonitor):
+        self.carbon_api_client = carbon_api_client
+        self.job_queue = job_queue
+        self.dataset_size_index = dataset_size_index
+        self.region_backlog = region_backlog
+        self.region_capacity = region_capacity
+
+    def get_best_location(self, job_request: JobRequest) -> Placement:
+        return get_best_placement(job_request, self._get_emissions_by_location(job_request), self.get_excluded_regions())
+
+    def get_excluded_regions(self) -> set[str]:
+        """Get the regions that should receive no new jobs.
+
+        Those are the saturated regions, and the regions that are out of capacity or whose agent stopped
+        sending heartbeats. The latter are only excluded while some region remains, as capacity
+        reports are advisory; every region is excluded only if every region is saturated.
+        """
+        saturated_regions = self.region_backlog.get_saturated_regions()
+        excluded_regions = saturated_regions | self.region_capacity.get_unavailable_regions()
+        if excluded_regions >= set(AVAILABLE_LOCATIONS):
+            return saturated_regions
+        return excluded_regions
+
+    def get_data_size(self, name: str, mountpoints: dict[str, str]) -> float:
+        """Get the total size in GB of the datasets mounted by a job, as far as it is known."""
+        return round(self.dataset_size_index.get_total_size_gb(list(mountpoints.values())), CARBON_API_DATA_SIZE_PRECISION)
+
+    def save_job_requests(self, job_requests: dict[str, JobRequest]):
+        """Save all job requests, keyed by job id, in a single multi-row insert."""
+        current_app.logger.info(f'Saving {len(job_requests)} job requests ...')
+        try:
+            with get_pooled_db_cursor() as cursor:
+                result = psql_execute_values(cursor, 'INSERT INTO JobRequest (job_id, name, image, command, max_delay, request) VALUES %s', [
+                    (job_id, job_request.spec.name, job_request.spec.image, ' '.join(job_request.spec.command), job_request.spec.max_delay,
+                     Json(dump_job_request(job_request)))
+                    for job_id, job_request in job_requests.items()
+                ])
+            current_app.logger.debug(result)
+        except Exception as ex:
+            raise ValueError(f'Failed to save {len(job_requests)} job requests.') from ex
+
+    def save_job_histories(self, job_ids: list[str], event: str, timestamp: datetime):
+        """Record the same event for all jobs in a single multi-row insert."""
+        current_app.logger.info(f'Saving job history for {len(job_ids)} jobs, event={event}, timestamp={timestamp}')
+        try:
+            with time_stage('save_job_history'), get_pooled_db_cursor() as cursor:
+                self._insert_job_histories(cursor, job_ids, event, timestamp)
+        except Exception as ex:
+            raise ValueError(f'Failed to save job history for {len(job_ids)} jobs.') from ex
+
+    def lease_jobs(self, job_ids: list[str], owner: str, duration: timedelta):
+        """Lease jobs to a placement worker for `duration`, taking them over from any previous owner."""
+        with get_pooled_db_cursor() as cursor:
+            psql_execute_list(cursor, '''INSERT INTO JobPlacementLease (job_id, owner, expires_at)
+                                            SELECT job_id, %s, now() + %s FROM unnest(%s::uuid[]) AS job_id
+                                            ON CONFLICT (job_id) DO UPDATE SET owner = EXCLUDED.owner, expires_at = EXCLUDED.expires_at;''',
+                              [owner, duration, job_ids])
+
+    def renew_leases(self, job_ids: list[str], owner: str, duration: timedelta):
+        """Extend the leases that `owner` still holds on the given jobs by `duration` from now."""
+        with get_pooled_db_cursor() as cursor:
+            psql_execute_list(cursor, '''UPDATE JobPlacementLease SET expires_at = now() + %s
+                                            WHERE owner = %s AND job_id = ANY(%s::uuid[]);''', [duration, owner, job_ids])
+
+    def release_leases(self, job_ids: list[str]):
+        with get_pooled_db_cursor() as cursor:
+            psql_execute_list(cursor, 'DELETE FROM JobPlacementLease WHERE job_id = ANY(%s::uuid[]);', [job_ids])
+
+    def claim_expired_jobs(self, owner: str, duration: timedelta, limit: int) -> dict[str, JobRequest]:
+        """Lease up to `limit` jobs whose lease expired before they were placed to `owner`, and return their requests.
+
+        Leases expire when the placement worker that held them died, as it renews them otherwise, and
+        are released once jobs were dispatched. Concurrent callers claim disjoint sets of jobs.
+        """
+        with get_pooled_db_transaction() as cursor:
+            rows = psql_execute_list(cursor, '''WITH expired AS (
+                                                    SELECT lease.job_id, request.request FROM JobPlacementLease lease
+                                                        INNER JOIN JobCurrentState state ON state.job_id = lease.job_id
+                                                        INNER JOIN JobRequest request ON request.job_id = lease.job_id
+                                                        WHERE lease.expires_at < now() AND state.event IN ('Created', 'Retrying', 'Placed') AND request.request IS NOT NULL
+                                                        ORDER BY lease.expires_at
+                                                        LIMIT %s
+                                                        FOR UPDATE OF lease SKIP LOCKED)
+                                                UPDATE JobPlacementLease lease SET owner = %s, expires_at = now() + %s
+                                                    FROM expired
+                                                    WHERE lease.job_id = expired.job_id
+                                                    RETURNING expired.job_id, expired.request;''',
+                                     [limit, owner, duration], fetch_result=True)
+        job_requests = {}
+        for job_id, request in rows:
+            try:
+                job_requests[str(job_id)] = load_job_request(request)
+            except Exception:
+                current_app.logger.error(f'Failed to load the request of job {job_id}', exc_info=True)
+        return job_requests
+
+    def claim_retry(self, job_id: str, stuck_after: timedelta = STUCK_JOB_TIMEOUT) -> bool:
+        """Claim the dispatch of a job that failed to be placed or enqueued, by recording its 'Retrying' event.
+
+        The current state of the job is locked while it is checked, so that only one of concurrent retries
+        claims the job. Jobs left 'Created' or 'Retrying' for longer than `stuck_after` by a request that
+        died can be claimed too, unless a placement worker holds their lease.
+        """
+        with get_pooled_db_cursor() as cursor:
+            return bool(psql_execute_list(cursor, f'''WITH undispatched AS (
+                                                            SELECT state.job_id, state.time FROM JobCurrentState state
+                                                                WHERE state.job_id = %s
+                                                                    AND (state.event IN ('PlacementFailed', 'EnqueueFailed')
+                                                                         OR state.event IN ('Created', 'Retrying') AND state.time < now() - %s
+                                                                            AND NOT EXISTS (SELECT FROM JobPlacementLease lease
+                                                                                                WHERE lease.job_id = state.job_id AND lease.expires_at >= now()))
+                                                                FOR UPDATE)
+                                                        INSERT INTO JobHistory (job_id, event, time, origin)
+                                                            SELECT job_id, 'Retrying', greatest(now(), time), %s FROM undispatched
+                                                            {get_job_history_conflict_clause('Retrying')}
+                                                            RETURNING job_id;''', [job_id, stuck_after, APP_ROLE], fetch_result=True))
+
+    def place_jobs(self, job_requests: dict[str, JobRequest]) -> dict[str, Placement]:
+        """Choose a region for every job under the per-region CPU and memory budgets of a batch.
+
+        The carbon API is called once per distinct candidate set, and all jobs are then assigned at once
+        by the placement engine, so that a burst of jobs does not all land on the greenest region.
+        Budgets are capped by the free capacity that agents report for their region. Excluded regions
+        receive no jobs, unless every region is excluded, see `get_best_placement()`.
+        """
+        job_ids = list(job_requests.keys())
+        excluded_regions = self.get_excluded_regions()
+        emissions_by_key: dict[tuple, dict[str, dict]] = {}
+        for job_id in job_ids:
+            key = self._get_placement_key(job_requests[job_id])
+            if key not in emissions_by_key:
+                emissions_by_key[key] = self._get_emissions_by_location(job_requests[job_id])
+        current_app.logger.info(f'Placing {len(job_requests)} jobs with {len(emissions_by_key)} carbon lookups ...')
+
+        placements = {}
+        # Jobs without emission estimates fall back to the default region.
+        placeable_job_ids = []
+        for job_id in job_ids:
+            emissions_by_location = emissions_by_key[self._get_placement_key(job_requests[job_id])]
+            if emissions_by_location is None or excluded_regions >= set(AVAILABLE_LOCATIONS):
+                placements[job_id] = get_best_placement(job_requests[job_id], emissions_by_location, excluded_regions)
+            else:
+                placeable_job_ids.append(job_id)
+        if not placeable_job_ids:
+            return placements
+
+        all_emissions = [emissions_by_key[self._get_placement_key(job_requests[job_id])] for job_id in placeable_job_ids]
+        carbon = np.array([[emissions[region]['compute_emission'] for region in AVAILABLE_LOCATIONS]
+                           for emissions in all_emissions])[:, :, None]
+        migration = np.array([[emissions[region]['migration_emission'] for region in AVAILABLE_LOCATIONS]
+                              for emissions in all_emissions])
+        job_cores = np.array([self._get_job_cores(job_requests[job_id]) for job_id in placeable_job_ids])
+        job_memory = np.array([self._get_job_memory(job_requests[job_id]) for job_id in placeable_job_ids])
+        scores = score_jobs(carbon, job_cores, np.zeros(len(placeable_job_ids), dtype=np.int64), migration)
+        scores[:, [region in excluded_regions for region in AVAILABLE_LOCATIONS], :] = np.inf
+        free_cpu, free_memory = self.region_capacity.get_free_resources(AVAILABLE_LOCATIONS)
+        region_indices, _ = assign_jobs(scores, job_cores, job_memory,
+                                        np.minimum(PLACEMENT_REGION_CPU_BUDGET, free_cpu),
+                                        np.minimum(PLACEMENT_REGION_MEMORY_BUDGET, free_memory))
+
+        overflow = 0
+        for i, job_id in enumerate(placeable_job_ids):
+            region_index = region_indices[i]
+            if region_index == UNASSIGNED:
+                # Every region that is not excluded is over budget; run the job where it is greenest anyway.
+                overflow += 1
+                region_index = np.argmin(scores[i, :, 0])
+            region = AVAILABLE_LOCATIONS[region_index]
+            start_time = all_emissions[i][region]['start_time'] if job_requests[job_id].spec.max_delay else None
+            placements[job_id] = Placement(region, start_time, get_total_emissions(all_emissions[i]))
+        if overflow:
+            PLACEMENT_OVERFLOWS.inc(overflow)
+            current_app.logger.warning(f'{overflow} jobs exceeded the region budgets and were placed in their best region.')
+        return placements
+
+    def dispatch_jobs(self, job_requests: dict[str, JobRequest], placements: dict[str, Placement]) -> dict[str, Exception]:
+        """Enqueue the jobs that should start now and hold the others until their start time.
+
+        Records the 'Enqueued' or 'Deferred' event of each job, and returns the error of every job that
+        could be neither enqueued nor deferred, keyed by job id.
+        """
+        min_start_time = datetime.now(timezone.utc) + DEFERRAL_MIN_DELAY
+        deferred = {}
+        immediate = {}
+        for job_id, placement in placements.items():
+            job_message = (placement.region, create_job_message(job_id, job_requests[job_id], placement))
+            if placement.start_time is not None and placement.start_time > min_start_time:
+                deferred[job_id] = job_message + (placement.start_time,)
+            else:
+                immediate[job_id] = job_message
+
+        errors = {}
+        if deferred:
+            try:
+                self._defer_jobs(deferred)
+            except Exception as ex:
+                current_app.logger.error(f'Failed to defer {len(deferred)} jobs', exc_info=True)
+                errors |= { job_id: ex for job_id in deferred }
+        if immediate:
+            errors |= self._enqueue_messages(immediate)
+            enqueued_job_ids = [job_id for job_id in immediate if job_id not in errors]
+            if enqueued_job_ids:
+                try:
+                    self.save_job_histories(enqueued_job_ids, 'Enqueued', datetime.now(timezone.utc))
+                except Exception:
+                    # The jobs are already on their queues, so report them as dispatched regardless.
+                    current_app.logger.error('Failed to record Enqueued events', exc_info=True)
+        return errors
+
+    def release_due_jobs(self, limit: int) -> int:
+        """Enqueue up to `limit` deferred jobs whose start time has come, and return how many were due.
+
+        Due rows are locked with SKIP LOCKED, so concurrent workers release disjoint sets of jobs.
+        Jobs that fail to be enqueued are retried after DEFERRAL_RETRY_INTERVAL.
+        """
+        with get_pooled_db_transaction() as cursor:
+            rows = psql_execute_list(cursor, '''SELECT job_id, region, message FROM JobDeferral
+                                                WHERE dispatch_time <= now()
+                                                ORDER BY dispatch_time
+                                                LIMIT %s
+                                                FOR UPDATE SKIP LOCKED;''', [limit], fetch_result=True)
+            if not rows:
+                return 0
+            current_app.logger.info(f'Releasing {len(rows)} deferred jobs ...')
+            # Jobs of saturated regions are held back like jobs that failed to be enqueued.
+            saturated_regions = self.region_backlog.get_saturated_regions()
+            errors = self._enqueue_messages({ str(job_id): (region, message) for job_id, region, message in rows
+                                              if region not in saturated_regions })
+            errors |= { str(job_id): ValueError(f'Region {region} is saturated')
+                        for job_id, region, _ in rows if region in saturated_regions }
+            released_job_ids = [job_id for job_id, _, _ in rows if str(job_id) not in errors]
+            if released_job_ids:
+                psql_execute_list(cursor, 'DELETE FROM JobDeferral WHERE job_id = ANY(%s);', [released_job_ids])
+                self._insert_job_histories(cursor, released_job_ids, 'Enqueued', datetime.now(timezone.utc))
+            if errors:
+                psql_execute_list(cursor, 'UPDATE JobDeferral SET dispatch_time = %s WHERE job_id = ANY(%s::uuid[]);',
+                                  [datetime.now(timezone.utc) + DEFERRAL_RETRY_INTERVAL, list(errors.keys())])
+        return len(rows)
+
+    def get_next_dispatch_time(self) -> datetime | None:
+        with get_pooled_db_cursor() as cursor:
+            return psql_execute_scalar(cursor, 'SELECT min(dispatch_time) FROM JobDeferral;')
+
+    def _defer_jobs(self, deferred: dict[str, tuple[str, dict, datetime]]):
+        current_app.logger.info(f'Deferring {len(deferred)} jobs ...')
+        with get_pooled_db_transaction() as cursor:
+            psql_execute_values(cursor, 'INSERT INTO JobDeferral (job_id, region, message, dispatch_time) VALUES %s', [
+                (job_id, region, Json(job_message), dispatch_time)
+                for job_id, (region, job_message, dispatch_time) in deferred.items()
+            ])
+            self._insert_job_histories(cursor, list(deferred.keys()), 'Deferred', datetime.now(timezone.utc))
+
+    def _enqueue_messages(self, messages: dict[str, tuple[str, dict]]) -> dict[str, Exception]:
+        """Send job messages, keyed by job id, to the queues of their regions, grouped by region.
+
+        Returns the error of every job that failed to be enqueued, keyed by job id.
+        """
+        messages_by_region: dict[str, dict[str, str]] = defaultdict(dict)
+        for job_id, (region, job_message) in messages.items():
+            messages_by_region[region][job_id] = serialize_job_message(job_message)
+        errors = {}
+        with time_stage('enqueue'):
+            for region, serialized_messages in messages_by_region.items():
+                region_errors = self.job_queue.send_messages_to_region(region, serialized_messages)
+                self.region_backlog.record_enqueued(region, len(serialized_messages) - len(region_errors))
+                errors |= region_errors
+        return errors
+
+    def _insert_job_histories(self, cursor, job_ids: list[str], event: str, timestamp: datetime):
+        result = psql_execute_values(cursor, f'INSERT INTO JobHistory (job_id, event, time, origin) VALUES %s {get_job_history_conflict_clause(event)}', [
+            (job_id, event, timestamp, APP_ROLE) for job_id in job_ids
+        ])
+        current_app.logger.debug(result)
+
+    def _get_emissions_by_location(self, job_request: JobRequest) -> dict[str, dict] | None:
+        try:
+            emissions_by_location = self.carbon_api_client.get_carbon_emissions_by_location(
+                job_request.original_location,
+                AVAILABLE_LOCATIONS,
+                self.get_data_size(job_request.spec.name, job_request.inputs),
+                self.get_data_size(job_request.spec.name, job_request.outputs),
+                job_request.spec.max_delay
+            )
+            missing_locations = set(AVAILABLE_LOCATIONS) - set(emissions_by_location.keys())
+            if missing_locations:
+                raise ValueError(f'No emission estimates for {missing_locations}')
+            return emissions_by_location
+        except Exception:
+            current_app.logger.warning('Failed to obtain best location to run job, returning default ...', exc_info=True)
+            return None
+
+    def _get_job_cores(self, job_request: JobRequest) -> float:
+        return parse_kube_cpu(job_request.resources.requests.cpu) if job_request.resources else DEFAULT_REQUEST_CPU
+
+    def _get_job_memory(self, job_request: JobRequest) -> float:
+        return parse_kube_memory(job_request.resources.requests.memory) if job_request.resources else DEFAULT_REQUEST_MEMORY
+
+    def _get_placement_key(self, job_request: JobRequest) -> tuple:
+        return (job_request.original_location,
+                tuple(AVAILABLE_LOCATIONS),
+                self.get_data_size(job_request.spec.name, job_request.inputs),
+                self.get_data_size(job_request.spec.name, job_request.outputs),
+                job_request.spec.max_delay)
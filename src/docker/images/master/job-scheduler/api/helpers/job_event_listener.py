@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import json
+import queue
+import select
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from flask import current_app
+
+from api.helpers.postgres import get_db_connection
+from api.config import JOB_EVENT_CACHE_SIZE, JOB_EVENT_SUBSCRIBER_QUEUE_SIZE
+
+JOB_HISTORY_CHANNEL = 'job_history'
+
+class JobEventSubscription:
+    def __init__(self, job_id: str = None, job_name: str = None):
+        self.job_id = job_id
+        self.job_name = job_name
+        self.queue: queue.Queue = queue.Queue(maxsize=JOB_EVENT_SUBSCRIBER_QUEUE_SIZE)
+
+    def matches(self, job_event: dict) -> bool:
+        if self.job_id:
+            return job_event['job_id'] == self.job_id
+        return job_event['job_name'] == self.job_name
+
+
+class JobEventListener:
+    """Listen to JobHistory notifications on a dedicated connection, fan them out to subscribers,
+    and keep the last event of recently seen jobs in memory.
+
+    Cached events are only served while the listener is connected: events may be missed while it is
+    disconnected, so the cache is cleared on every reconnect.
+    """
+
+    def __init__(self, cache_size: int = JOB_EVENT_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        # job_id -> last event, in LRU order
+        self.last_events: OrderedDict[str, dict] = OrderedDict()
+        self.job_ids_by_name: dict[str, str] = {}
+        self.subscriptions: set[JobEventSubscription] = set()
+        self.connected = False
+        self.thread: threading.Thread = None
+
+    def start(self, app):
+        self.thread = threading.Thread(target=self._run, args=(app,), name='job-event-listener', daemon=True)
+        self.thread.start()
+
+    def get_last_event(self, job_id: str = None, job_name: str = None) -> dict | None:
+        with self.lock:
+            if not self.connected:
+                return None
+            if not job_id:
+                job_id = self.job_ids_by_name.get(job_name)
+            job_event = self.last_events.get(job_id)
+            if job_event is not None:
+                self.last_events.move_to_end(job_id)
+            return job_event
+
+    def put_last_event(self, job_event: dict):
+        """Cache an event read from the database, unless a newer one has been received since."""
+        with self.lock:
+            if self.connected:
+                self._update_last_event(job_event)
+
+    def subscribe(self, job_id: str = None, job_name: str = None) -> JobEventSubscription:
+        subscription = JobEventSubscription(job_id, job_name)
+        with self.lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: JobEventSubscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def _run(self, app):
+        with app.app_context():
+            retry_delay = 1
+            while True:
+                try:
+                    self._listen()
+                except Exception:
+                    current_app.logger.error(f'Job event listener disconnected, retrying in {retry_delay}s ...', exc_info=True)
+                with self.lock:
+                    self.connected = False
+                    self.last_events.clear()
+                    self.job_ids_by_name.clear()
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 60)
+
+    def _listen(self):
+        conn = get_db_connection(autocommit=True)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f'LISTEN {JOB_HISTORY_CHANNEL};')
+            with self.lock:
+                self.connected = True
+            current_app.logger.info(f'Listening to {JOB_HISTORY_CHANNEL} notifications ...')
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notification = conn.notifies.pop(0)
+                    self._handle_notification(notification.payload)
+        finally:
+            conn.close()
+
+    def _handle_notification(self, payload: str):
+        try:
+            job_event = json.loads(payload)
+            job_event['timestamp'] = datetime.fromtimestamp(float(job_event['timestamp']), tz=timezone.utc)
+        except (ValueError, KeyError, TypeError):
+            current_app.logger.warning(f'Ignoring malformed job event: {payload}')
+            return
+        with self.lock:
+            self._update_last_event(job_event)
+            subscriptions = [s for s in self.subscriptions if s.matches(job_event)]
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait(job_event)
+            except queue.Full:
+                current_app.logger.warning(f'Dropping job event for slow subscriber: {job_event}')
+
+    def _update_last_event(self, job_event: dict):
+        job_id = job_event['job_id']
+        cached_event = self.last_events.get(job_id)
+        if cached_event is not None and cached_event['timestamp'] > job_event['timestamp']:
+            return
+        self.last_events[job_id] = job_event
+        self.last_events.move_to_end(job_id)
+        if job_event.get('job_name'):
+            self.job_ids_by_name[job_event['job_name']] = job_id
+        while len(self.last_events) > self.cache_size:
+            _, evicted_event = self.last_events.popitem(last=False)
+            self.job_ids_by_name.pop(evicted_event.get('job_name'), None)
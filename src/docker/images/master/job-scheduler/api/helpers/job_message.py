@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+
+import base64
+import json
+import zlib
+
+from api.config import JOB_MESSAGE_COMPRESSION_THRESHOLD
+
+# Wire format of the job messages sent to the agents, kept in sync with agent/executor/src/job_message.py.
+#
+# A message is a JSON envelope: {"version": 1, "encoding": <encoding>, "payload": <payload>}, where
+# the payload is the job message itself for the "json" encoding, or the base64 of its zlib-compressed
+# JSON for the "zlib+json" encoding. Messages stay text, as older agents read them via amqp-consume.
+JOB_MESSAGE_VERSION = 1
+ENCODING_JSON = 'json'
+ENCODING_ZLIB_JSON = 'zlib+json'
+
+def encode_job_message(job_message: dict, compression_threshold: int = JOB_MESSAGE_COMPRESSION_THRESHOLD) -> str:
+    """Encode a job message, compressing it if its JSON is larger than the threshold in bytes."""
+    payload = json.dumps(job_message, separators=(',', ':'))
+    if len(payload) <= compression_threshold:
+        return json.dumps({ 'version': JOB_MESSAGE_VERSION, 'encoding': ENCODING_JSON, 'payload': job_message },
+                          separators=(',', ':'))
+    compressed_payload = base64.b64encode(zlib.compress(payload.encode())).decode('ascii')
+    return json.dumps({ 'version': JOB_MESSAGE_VERSION, 'encoding': ENCODING_ZLIB_JSON, 'payload': compressed_payload },
+                      separators=(',', ':'))
@@ -1,38 +1,173 @@
 #!/usr/bin/env python3
 
 import time
-import random
-from datetime import datetime
+import threading
+from collections import defaultdict, deque
 from flask import current_app
+import pika
+import pika.exceptions
 
-from api.util import get_env_var, run_command_and_print_output
+from api.util import run_command_and_print_output
+from api.helpers.metrics import QUEUE_ERRORS
 from api.config import *
 
+class PikaPublisher:
+    """Publish messages over one long-lived broker connection and channel with publisher confirms.
+
+    Queues are declared once per connection, and a publish that fails because the connection was
+    lost (e.g. dropped by the broker while idle) is retried on a fresh connection.
+    """
+
+    def __init__(self, broker_url: str, queue_names: list[str], max_attempts: int = PUBLISHER_MAX_ATTEMPTS):
+        self.parameters = pika.URLParameters(broker_url)
+        self.queue_names = queue_names
+        self.max_attempts = max_attempts
+        # BlockingConnection is not thread-safe.
+        self.lock = threading.Lock()
+        self.connection: pika.BlockingConnection = None
+        self.channel = None
+
+    def publish(self, queue_name: str, message: str):
+        with self.lock:
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    self._ensure_channel()
+                    self.channel.basic_publish(exchange='', routing_key=queue_name, body=message,
+                                               properties=pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent),
+                                               mandatory=True)
+                    return
+                except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as ex:
+                    current_app.logger.warning(f'Failed to publish to {queue_name} (attempt {attempt}/{self.max_attempts}): {ex!r}')
+                    self._close()
+                    if attempt == self.max_attempts:
+                        raise
+                    time.sleep(min(0.1 * 2 ** attempt, 2.))
+
+    def get_queue_depths(self, queue_names: list[str]) -> dict[str, int]:
+        with self.lock:
+            try:
+                self._ensure_channel()
+                return { queue_name: self.channel.queue_declare(queue=queue_name, passive=True).method.message_count
+                         for queue_name in queue_names }
+            except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError):
+                self._close()
+                raise
+
+    def _ensure_channel(self):
+        if self.connection is not None and self.connection.is_open and self.channel.is_open:
+            return
+        self._close()
+        current_app.logger.info('Connecting to broker ...')
+        self.connection = pika.BlockingConnection(self.parameters)
+        self.channel = self.connection.channel()
+        self.channel.confirm_delivery()
+        for queue_name in self.queue_names:
+            current_app.logger.info(f'Declaring queue {queue_name} ...')
+            self.channel.queue_declare(queue=queue_name, durable=True)
+
+    def _close(self):
+        if self.connection is not None and self.connection.is_open:
+            try:
+                self.connection.close()
+            except pika.exceptions.AMQPError:
+                pass
+        self.connection = None
+        self.channel = None
+
+
+class AmqpToolsPublisher:
+    """Publish messages by spawning amqp-publish for each message (legacy path)."""
+
+    def __init__(self, broker_url: str, queue_names: list[str]):
+        self.broker_url = broker_url
+        self.queue_names = queue_names
+        self.declared = False
+
+    def publish(self, queue_name: str, message: str):
+        if not self.declared:
+            for name in self.queue_names:
+                run_command_and_print_output([
+                    "/usr/bin/amqp-declare-queue",
+                    "--url", self.broker_url,
+                    "-q", name,
+                    "-d"
+                ])
+            self.declared = True
+        run_command_and_print_output([
+                "/usr/bin/amqp-publish",
+                "--url", self.broker_url,
+                "-r", queue_name,
+                "-p"
+            ], message)
+
+    def get_queue_depths(self, queue_names: list[str]) -> dict[str, int]:
+        # amqp-tools cannot inspect queues, so use a short-lived connection.
+        connection = pika.BlockingConnection(pika.URLParameters(self.broker_url))
+        try:
+            channel = connection.channel()
+            return { queue_name: channel.queue_declare(queue=queue_name, passive=True).method.message_count
+                     for queue_name in queue_names }
+        finally:
+            connection.close()
+
+
+class InMemoryPublisher:
+    """Keep published messages in process memory. Stand-in for a broker in local runs and benchmarks."""
+
+    def __init__(self, broker_url: str, queue_names: list[str]):
+        self.lock = threading.Lock()
+        self.queues: dict[str, deque[str]] = defaultdict(deque)
+        for queue_name in queue_names:
+            self.queues[queue_name]
+
+    def publish(self, queue_name: str, message: str):
+        with self.lock:
+            self.queues[queue_name].append(message)
+
+    def get_queue_depths(self, queue_names: list[str]) -> dict[str, int]:
+        with self.lock:
+            return { queue_name: len(self.queues[queue_name]) for queue_name in queue_names }
+
+
+PUBLISHER_TYPES = {
+    'pika': PikaPublisher,
+    'amqp-tools': AmqpToolsPublisher,
+    'memory': InMemoryPublisher,
+}
+
 class JobQueue:
-    def __init__(self, regions=REGIONS):
+    def __init__(self, regions=REGIONS, publisher_type=QUEUE_PUBLISHER):
         self.regions = regions
-        # self._init_job_queues()
-
-    def _init_job_queues(self):
-        for region in self.regions:
-            current_app.logger.info(f"Declaring queue for region {region} ...")
-            run_command_and_print_output([
-                "/usr/bin/amqp-declare-queue",
-                "--url", BROKER_URL,
-                "-q", self._get_queue_name(region),
-                "-d"
-            ])
-            self.send_message_to_region(region, 'Startup')
+        assert publisher_type in PUBLISHER_TYPES, f'Unknown queue publisher "{publisher_type}"'
+        self.publisher = PUBLISHER_TYPES[publisher_type](BROKER_URL, [self._get_queue_name(region) for region in regions])
 
     def _get_queue_name(self, region: str) -> str:
         return f"{QUEUE_PERFIX}.{region}"
 
 
+    def get_backlogs(self) -> dict[str, int]:
+        """Get the number of messages waiting in the queue of each region."""
+        queue_depths = self.publisher.get_queue_depths([self._get_queue_name(region) for region in self.regions])
+        return { region: queue_depths[self._get_queue_name(region)] for region in self.regions }
+
     def send_message_to_region(self, region: str, message: str):
         current_app.logger.info(f"Sending message to region {region}, len = {len(message)} ...")
-        run_command_and_print_output([
-                "/usr/bin/amqp-publish",
-                "--url", BROKER_URL,
-                "-r", self._get_queue_name(region),
-                "-p"
-            ], message)
+        try:
+            self.publisher.publish(self._get_queue_name(region), message)
+        except Exception:
+            QUEUE_ERRORS.labels(region).inc()
+            raise
+
+    def send_messages_to_region(self, region: str, messages: dict[str, str]) -> dict[str, Exception]:
+        """Send messages keyed by job id to a region and return the error of each failed message."""
+        current_app.logger.info(f"Sending {len(messages)} messages to region {region} ...")
+        queue_name = self._get_queue_name(region)
+        errors = {}
+        for job_id, message in messages.items():
+            try:
+                self.publisher.publish(queue_name, message)
+            except Exception as ex:
+                current_app.logger.error(f'Failed to send job {job_id} to region {region}: {ex!r}')
+                QUEUE_ERRORS.labels(region).inc()
+                errors[job_id] = ex
+        return errors
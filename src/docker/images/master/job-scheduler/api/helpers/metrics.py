@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+import os
+from contextlib import contextmanager
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess
+
+# Metrics are written to PROMETHEUS_MULTIPROC_DIR by every gunicorn worker, and aggregated across
+# workers when scraped. See gunicorn.conf.py for the lifecycle of that directory.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., float('inf'))
+
+REQUEST_LATENCY = Histogram('job_scheduler_request_seconds', 'Latency of HTTP requests, until the response is returned.',
+                            ['endpoint', 'method', 'status'], buckets=LATENCY_BUCKETS)
+STAGE_LATENCY = Histogram('job_scheduler_stage_seconds', 'Latency of each stage of job submission.',
+                          ['stage'], buckets=LATENCY_BUCKETS)
+CARBON_API_LATENCY = Histogram('job_scheduler_carbon_api_seconds', 'Latency of carbon API requests, excluding cache hits.',
+                               buckets=LATENCY_BUCKETS)
+PLACEMENT_FALLBACKS = Counter('job_scheduler_placement_fallbacks_total',
+                              'Jobs placed in the default region because no emission estimates were available.')
+PLACEMENT_OVERFLOWS = Counter('job_scheduler_placement_overflows_total',
+                              'Jobs placed in their best region even though every region was over budget.')
+DB_ERRORS = Counter('job_scheduler_db_errors_total', 'Database errors, by operation.', ['operation'])
+QUEUE_ERRORS = Counter('job_scheduler_queue_errors_total', 'Failures to publish a job message, by region.', ['region'])
+REGION_BACKLOG = Gauge('job_scheduler_region_backlog', 'Messages waiting in the queue of each region, as last seen by any worker.',
+                       ['region'], multiprocess_mode='mostrecent')
+ADMISSION_REJECTIONS = Counter('job_scheduler_admission_rejections_total', 'Job submissions rejected because every region was saturated.')
+
+@contextmanager
+def time_stage(stage: str):
+    with STAGE_LATENCY.labels(stage).time():
+        yield
+
+def get_metrics() -> bytes:
+    """Get all metrics in the Prometheus text format, aggregated across workers if running in multiprocess mode."""
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+UNASSIGNED = -1
+
+def score_jobs(carbon: np.ndarray, job_cores: np.ndarray, job_max_slots: np.ndarray,
+               migration: np.ndarray = None) -> np.ndarray:
+    """Score every (job, region, start slot) combination at once.
+
+    Args:
+        carbon: (regions, slots) emission of running one core for the job runtime, by region and start slot,
+            or (jobs, regions, slots) when it differs per job.
+        job_cores: (jobs,) requested CPU cores of each job.
+        job_max_slots: (jobs,) last start slot each job may use, i.e. its max delay in slots.
+        migration: optional (jobs, regions) emission of moving each job's data to each region.
+
+    Returns:
+        A (jobs, regions, slots) tensor of emissions, with infinity for start slots beyond a job's max delay.
+    """
+    if carbon.ndim == 2:
+        carbon = carbon[None, :, :]
+    scores = job_cores.astype(np.float32)[:, None, None] * carbon.astype(np.float32)
+    if migration is not None:
+        scores += migration.astype(np.float32)[:, :, None]
+    num_slots = carbon.shape[2]
+    too_late = np.arange(num_slots)[None, :] > job_max_slots[:, None]
+    scores[np.broadcast_to(too_late[:, None, :], scores.shape)] = np.inf
+    return scores
+
+
+def assign_jobs(scores: np.ndarray, job_cores: np.ndarray, job_memory: np.ndarray,
+                region_cores: np.ndarray, region_memory: np.ndarray,
+                job_duration_slots: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+    """Greedily assign jobs to regions and start slots under per-region CPU and memory budgets.
+
+    Jobs are assigned in order of regret, i.e. how much worse their second-best option is than their
+    best, so jobs with few good options are served first. Each job takes its lowest-emission option
+    that still fits in the region's remaining budget for every slot it runs in.
+
+    Args:
+        scores: (jobs, regions, slots) emissions from `score_jobs()`.
+        job_cores, job_memory: (jobs,) resource requests of each job.
+        region_cores, region_memory: (regions,) budget of each region, available at every slot.
+        job_duration_slots: optional (jobs,) number of slots each job occupies its region, default 1.
+
+    Returns:
+        (regions, slots) arrays of shape (jobs,) with the assignment of each job, or UNASSIGNED where no
+        option fits.
+    """
+    num_jobs, num_regions, num_slots = scores.shape
+    if job_duration_slots is None:
+        job_duration_slots = np.ones(num_jobs, dtype=np.int64)
+    assigned_regions = np.full(num_jobs, UNASSIGNED, dtype=np.int64)
+    assigned_slots = np.full(num_jobs, UNASSIGNED, dtype=np.int64)
+    if num_jobs == 0:
+        return assigned_regions, assigned_slots
+
+    flat_scores = scores.reshape(num_jobs, -1)
+    if flat_scores.shape[1] > 1:
+        best_two = np.partition(flat_scores, 1, axis=1)[:, :2]
+        regret = best_two[:, 1] - best_two[:, 0]
+        # Jobs with a single feasible option have infinite regret and go first.
+        regret[~np.isfinite(regret)] = np.inf
+    else:
+        regret = np.zeros(num_jobs)
+    order = np.argsort(-regret, kind='stable')
+
+    remaining_cores = np.repeat(region_cores.astype(np.float64)[:, None], num_slots, axis=1)
+    remaining_memory = np.repeat(region_memory.astype(np.float64)[:, None], num_slots, axis=1)
+    for job in order:
+        duration = int(job_duration_slots[job])
+        # The tightest remaining budget over each window of slots the job would run in.
+        window_cores = _get_window_min(remaining_cores, duration)
+        window_memory = _get_window_min(remaining_memory, duration)
+        fits = (window_cores >= job_cores[job]) & (window_memory >= job_memory[job])
+        candidate_scores = np.where(fits, scores[job], np.inf)
+        best = np.argmin(candidate_scores)
+        if not np.isfinite(candidate_scores.flat[best]):
+            continue
+        region, slot = divmod(int(best), num_slots)
+        assigned_regions[job] = region
+        assigned_slots[job] = slot
+        remaining_cores[region, slot:slot + duration] -= job_cores[job]
+        remaining_memory[region, slot:slot + duration] -= job_memory[job]
+    return assigned_regions, assigned_slots
+
+
+def _get_window_min(remaining: np.ndarray, duration: int) -> np.ndarray:
+    if duration <= 1:
+        return remaining
+    # Slots past the end of the horizon are assumed to have the budget of the last slot.
+    padded = np.concatenate([remaining, np.repeat(remaining[:, -1:], duration - 1, axis=1)], axis=1)
+    return sliding_window_view(padded, duration, axis=1).min(axis=-1)
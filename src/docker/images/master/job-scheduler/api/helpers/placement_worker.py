@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import atexit
+import os
+import queue
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+
+from api.models.job_request import JobRequest
+from api.helpers.job_dispatcher import JobDispatcher
+from api.helpers.metrics import time_stage
+from api.config import PLACEMENT_BATCH_SIZE, PLACEMENT_BATCH_WAIT, PLACEMENT_SHUTDOWN_TIMEOUT, STUCK_JOB_TIMEOUT
+
+_STOP = object()
+
+class PlacementWorker:
+    """Place and enqueue accepted jobs in the background, in batches.
+
+    Jobs are handed over through an in-process queue, so the worker lives and dies with its gunicorn
+    worker. Jobs still queued at a graceful shutdown are drained before exit. Submitted jobs are leased
+    to the worker in database until they are placed, and `StuckJobSweeper` renews those leases; jobs
+    lost to a crash are placed again by another worker once their lease expired.
+    """
+
+    def __init__(self, job_dispatcher: JobDispatcher, batch_size: int = PLACEMENT_BATCH_SIZE,
+                 batch_wait: float = PLACEMENT_BATCH_WAIT, lease_duration: timedelta = STUCK_JOB_TIMEOUT):
+        self.job_dispatcher = job_dispatcher
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.lease_duration = lease_duration
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.queue: queue.Queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread: threading.Thread = None
+        # Ids of the jobs that are leased to this worker, from their submission until they are placed.
+        self.leased_job_ids: set[str] = set()
+
+    def submit(self, job_requests: dict[str, JobRequest]):
+        """Lease jobs, keyed by job id, to this worker and queue them for placement."""
+        self.job_dispatcher.lease_jobs(list(job_requests.keys()), self.owner, self.lease_duration)
+        self._queue(job_requests)
+
+    def renew_leases(self):
+        with self.lock:
+            job_ids = list(self.leased_job_ids)
+        if job_ids:
+            self.job_dispatcher.renew_leases(job_ids, self.owner, self.lease_duration)
+
+    def resume_expired_jobs(self, limit: int) -> int:
+        """Take over up to `limit` jobs whose lease expired before they were placed, and return how many."""
+        job_requests = self.job_dispatcher.claim_expired_jobs(self.owner, self.lease_duration, limit)
+        if job_requests:
+            self._queue(job_requests)
+        return len(job_requests)
+
+    def stop(self, timeout: float = PLACEMENT_SHUTDOWN_TIMEOUT):
+        if self.thread is None:
+            return
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
+
+    def _queue(self, job_requests: dict[str, JobRequest]):
+        self._ensure_started()
+        with self.lock:
+            self.leased_job_ids.update(job_requests.keys())
+        for item in job_requests.items():
+            self.queue.put(item)
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            app = current_app._get_current_object()
+            self.thread = threading.Thread(target=self._run, args=(app,), name='placement-worker', daemon=True)
+            self.thread.start()
+            atexit.register(self.stop)
+
+    def _run(self, app):
+        with app.app_context():
+            current_app.logger.info('Placement worker started.')
+            stopping = False
+            while not stopping:
+                job_requests, stopping = self._get_batch()
+                if not job_requests:
+                    continue
+                try:
+                    self._place_and_enqueue(job_requests)
+                except Exception:
+                    current_app.logger.error(f'Failed to place {len(job_requests)} jobs', exc_info=True)
+            current_app.logger.info('Placement worker stopped.')
+
+    def _get_batch(self) -> tuple[dict[str, JobRequest], bool]:
+        """Wait for a job, then collect more until the batch is full or the batch wait elapses."""
+        job_requests = {}
+        item = self.queue.get()
+        deadline = time.monotonic() + self.batch_wait
+        while item is not _STOP:
+            job_id, job_request = item
+            job_requests[job_id] = job_request
+            if len(job_requests) >= self.batch_size:
+                return job_requests, False
+            try:
+                item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                return job_requests, False
+        # Drain everything still queued, including jobs submitted after the stop request.
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return job_requests, True
+            if item is not _STOP:
+                job_id, job_request = item
+                job_requests[job_id] = job_request
+
+    def _place_and_enqueue(self, job_requests: dict[str, JobRequest]):
+        job_ids = list(job_requests.keys())
+        try:
+            try:
+                with time_stage('place_jobs'):
+                    placements = self.job_dispatcher.place_jobs(job_requests)
+            except Exception:
+                self._save_job_histories(job_ids, 'PlacementFailed')
+                raise
+            # Recorded before dispatching, so that the events of the dispatch supersede it.
+            self._save_job_histories(job_ids, 'Placed')
+            errors = self.job_dispatcher.dispatch_jobs(job_requests, placements)
+            if errors:
+                self.job_dispatcher.save_job_histories(list(errors.keys()), 'EnqueueFailed', datetime.now(timezone.utc))
+        finally:
+            self._release_leases(job_ids)
+
+    def _save_job_histories(self, job_ids: list[str], event: str):
+        """Record an event that the placement does not depend on, logging rather than raising failures."""
+        try:
+            self.job_dispatcher.save_job_histories(job_ids, event, datetime.now(timezone.utc))
+        except Exception:
+            current_app.logger.error(f'Failed to record {event} events', exc_info=True)
+
+    def _release_leases(self, job_ids: list[str]):
+        with self.lock:
+            self.leased_job_ids.difference_update(job_ids)
+        try:
+            self.job_dispatcher.release_leases(job_ids)
+        except Exception:
+            # The leases expire on their own, and jobs that were placed are not claimed again.
+            current_app.logger.error(f'Failed to release the leases of {len(job_ids)} jobs', exc_info=True)
@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 
+import os
+import time
+import threading
 import psycopg2
 import psycopg2.extras
 import logging
 import traceback
+from contextlib import contextmanager
 from typing import Sequence, Any, Union
 from flask import current_app
 
 from api.util import get_env_var
+from api.helpers.metrics import DB_ERRORS
+from api.config import POSTGRES_POOL_MAX_SIZE, POSTGRES_POOL_CHECKOUT_TIMEOUT, POSTGRES_POOL_HEALTH_CHECK_INTERVAL
+
+Json = psycopg2.extras.Json
 
 def get_db_connection(host=None, database=None, autocommit=False):
     try:
@@ -18,8 +26,191 @@ def get_db_connection(host=None, database=None, autocommit=False):
         conn.autocommit = autocommit
         return conn
     except Exception as ex:
+        DB_ERRORS.labels('connect').inc()
         raise ValueError("Failed to connect to database.") from ex
 
+class PostgresConnectionPool:
+    """A bounded, thread-safe pool of database connections owned by a single worker process.
+
+    Connections are opened lazily up to `max_size`. A connection that has been idle for longer
+    than `health_check_interval` seconds is verified with a trivial query before it is handed out,
+    and callers wait at most `checkout_timeout` seconds for a connection to become available.
+    """
+
+    def __init__(self, max_size: int, checkout_timeout: float, health_check_interval: float,
+                 autocommit: bool = True):
+        assert max_size > 0, 'Pool must allow at least one connection'
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.autocommit = autocommit
+        self.condition = threading.Condition()
+        # Idle connections along with the time they were last returned to the pool.
+        self.idle_connections: list[tuple[psycopg2.extensions.connection, float]] = []
+        self.num_connections = 0
+        self.num_in_use = 0
+        self.num_checkouts = 0
+        self.num_waits = 0
+        self.num_timeouts = 0
+        self.num_discarded = 0
+        self.total_wait_time = 0.
+        self.max_wait_time = 0.
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of the `with` block."""
+        conn = self._checkout()
+        try:
+            yield conn
+        finally:
+            self._checkin(conn)
+
+    def get_stats(self) -> dict[str, int | float]:
+        with self.condition:
+            return {
+                'max_size': self.max_size,
+                'size': self.num_connections,
+                'in_use': self.num_in_use,
+                'idle': len(self.idle_connections),
+                'checkouts': self.num_checkouts,
+                'waits': self.num_waits,
+                'timeouts': self.num_timeouts,
+                'discarded': self.num_discarded,
+                'wait_time_total_s': self.total_wait_time,
+                'wait_time_max_s': self.max_wait_time,
+            }
+
+    def _checkout(self) -> psycopg2.extensions.connection:
+        start = time.monotonic()
+        deadline = start + self.checkout_timeout
+        while True:
+            conn, last_used = self._reserve_connection(start, deadline)
+            if conn is None:
+                try:
+                    return get_db_connection(autocommit=self.autocommit)
+                except Exception:
+                    self._release_reservation()
+                    raise
+            if self._is_healthy(conn, last_used):
+                return conn
+            self._discard(conn)
+            with self.condition:
+                self.num_in_use -= 1
+                self.condition.notify()
+
+    def _reserve_connection(self, start: float, deadline: float):
+        """Reserve either an idle connection or a slot for a new one, waiting until the deadline.
+
+        Returns (None, None) when the caller should open a new connection.
+        """
+        with self.condition:
+            waited = False
+            while not self.idle_connections and self.num_connections >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.num_timeouts += 1
+                    DB_ERRORS.labels('checkout').inc()
+                    raise ValueError(f'Timed out waiting for a database connection after {self.checkout_timeout}s.')
+                waited = True
+                self.condition.wait(remaining)
+            if waited:
+                wait_time = time.monotonic() - start
+                self.num_waits += 1
+                self.total_wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+            self.num_checkouts += 1
+            self.num_in_use += 1
+            if self.idle_connections:
+                return self.idle_connections.pop()
+            self.num_connections += 1
+            return None, None
+
+    def _release_reservation(self):
+        with self.condition:
+            self.num_connections -= 1
+            self.num_in_use -= 1
+            self.condition.notify()
+
+    def _is_healthy(self, conn: psycopg2.extensions.connection, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1;')
+            if not conn.autocommit:
+                conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkin(self, conn: psycopg2.extensions.connection):
+        reusable = not conn.closed
+        if reusable and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                reusable = False
+        if not reusable:
+            self._discard(conn)
+        with self.condition:
+            self.num_in_use -= 1
+            if reusable:
+                self.idle_connections.append((conn, time.monotonic()))
+            self.condition.notify()
+
+    def _discard(self, conn: psycopg2.extensions.connection):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self.condition:
+            self.num_connections -= 1
+            self.num_discarded += 1
+
+_g_db_connection_pool: PostgresConnectionPool = None
+_g_db_connection_pool_pid: int = None
+_g_db_connection_pool_lock = threading.Lock()
+
+def get_db_connection_pool() -> PostgresConnectionPool:
+    """Get the connection pool of the current worker process, creating it on first use."""
+    global _g_db_connection_pool, _g_db_connection_pool_pid
+    with _g_db_connection_pool_lock:
+        # Connections must never be shared across forked processes.
+        if _g_db_connection_pool is None or _g_db_connection_pool_pid != os.getpid():
+            _g_db_connection_pool = PostgresConnectionPool(POSTGRES_POOL_MAX_SIZE,
+                                                           POSTGRES_POOL_CHECKOUT_TIMEOUT,
+                                                           POSTGRES_POOL_HEALTH_CHECK_INTERVAL)
+            _g_db_connection_pool_pid = os.getpid()
+        return _g_db_connection_pool
+
+@contextmanager
+def get_pooled_db_cursor():
+    """Get a cursor on a pooled autocommit connection for the duration of the `with` block."""
+    with get_db_connection_pool().connection() as conn:
+        with conn.cursor() as cursor:
+            yield cursor
+
+@contextmanager
+def get_pooled_db_transaction(cursor_name: str = None, itersize: int = 2000):
+    """Get a cursor on a pooled connection whose statements are committed together at the end
+    of the `with` block, or rolled back if it raises.
+
+    If `cursor_name` is given, the cursor is a server-side cursor that fetches `itersize` rows at a
+    time as it is iterated, so large results are never held in memory at once.
+    """
+    with get_db_connection_pool().connection() as conn:
+        conn.autocommit = False
+        try:
+            with conn:
+                with conn.cursor(name=cursor_name) as cursor:
+                    if cursor_name:
+                        cursor.itersize = itersize
+                    yield cursor
+        finally:
+            conn.autocommit = True
+
 def psql_execute_scalar(cursor: psycopg2.extensions.cursor, query: str, args: Sequence[Any] = None) -> Any | None:
     """Execute the psql query and return the first column of first row."""
     try:
@@ -28,6 +219,7 @@ def psql_execute_scalar(cursor: psycopg2.extensions.cursor, query: str, args: Se
     except psycopg2.Error as ex:
         current_app.logger.error(f'psql_execute_scalar("{query}", {args}): {ex}')
         current_app.logger.error(traceback.format_exc())
+        DB_ERRORS.labels('execute').inc()
         raise ValueError("Failed to execute SQL query.")
     return result[0] if result is not None else None
 
@@ -41,6 +233,7 @@ def psql_execute_list(cursor: psycopg2.extensions.cursor, query: str,
     except psycopg2.Error as ex:
         current_app.logger.error(f'psql_execute_scalar("{query}", {args}): {ex}')
         current_app.logger.error(traceback.format_exc())
+        DB_ERRORS.labels('execute').inc()
         raise ValueError("Failed to execute SQL query.")
 
 def psql_execute_values(cursor: psycopg2.extensions.cursor, query: str,
@@ -52,6 +245,7 @@ def psql_execute_values(cursor: psycopg2.extensions.cursor, query: str,
     except psycopg2.Error as ex:
         current_app.logger.error(f'psql_execute_values("{query}", {args}): {ex}')
         current_app.logger.error(traceback.format_exc())
+        DB_ERRORS.labels('execute').inc()
         raise ValueError("Failed to execute SQL query.")
 
 psycopg2.extras.register_uuid()
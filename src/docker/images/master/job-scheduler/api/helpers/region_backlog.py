@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import math
+import threading
+import time
+from flask import current_app
+
+from api.helpers.job_queue import JobQueue
+from api.helpers.metrics import REGION_BACKLOG
+from api.config import REGION_BACKLOG_LIMIT, REGION_BACKLOG_REFRESH_INTERVAL
+
+class RegionBacklogMonitor:
+    """Track how many messages wait in the queue of each region, to keep jobs away from saturated regions.
+
+    Queue depths are read from the broker at most once per refresh interval. In between, messages
+    enqueued by this worker are added to the last known depths, so that a burst is accounted for
+    before the next refresh. If the broker cannot be queried, the last known depths are kept.
+    """
+
+    def __init__(self, job_queue: JobQueue, limit: float = REGION_BACKLOG_LIMIT,
+                 refresh_interval: float = REGION_BACKLOG_REFRESH_INTERVAL):
+        self.job_queue = job_queue
+        self.limit = limit
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.backlogs: dict[str, int] = {}
+        self.last_refresh_time = -math.inf
+
+    def is_enabled(self) -> bool:
+        return not math.isinf(self.limit)
+
+    def get_saturated_regions(self) -> set[str]:
+        if not self.is_enabled():
+            return set()
+        return { region for region, backlog in self.get_backlogs().items() if backlog >= self.limit }
+
+    def are_all_regions_saturated(self) -> bool:
+        return self.is_enabled() and self.get_saturated_regions() >= set(self.job_queue.regions)
+
+    def get_backlogs(self) -> dict[str, int]:
+        if time.monotonic() - self.last_refresh_time >= self.refresh_interval:
+            self._refresh()
+        with self.lock:
+            return dict(self.backlogs)
+
+    def record_enqueued(self, region: str, count: int):
+        with self.lock:
+            if region in self.backlogs:
+                self.backlogs[region] += count
+
+    def update(self, backlogs: dict[str, int]):
+        """Replace the last known depths with the ones just read from the broker."""
+        with self.lock:
+            self.backlogs = backlogs
+        for region, backlog in backlogs.items():
+            REGION_BACKLOG.labels(region).set(backlog)
+
+    def _refresh(self):
+        # Only one thread refreshes; the others use the last known depths in the meantime.
+        if not self.refresh_lock.acquire(blocking=False):
+            return
+        try:
+            self.update(self.job_queue.get_backlogs())
+        except Exception as ex:
+            current_app.logger.warning(f'Failed to get region backlogs, keeping the last known ones: {ex!r}')
+        finally:
+            self.last_refresh_time = time.monotonic()
+            self.refresh_lock.release()
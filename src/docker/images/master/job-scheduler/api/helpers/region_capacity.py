@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from flask import current_app
+
+from api.helpers.postgres import *
+from api.config import REGION_CAPACITY_REFRESH_INTERVAL, REGION_CAPACITY_STALE_AFTER
+
+@dataclass
+class RegionCapacity:
+    """Resources of a region as last reported by its agent's heartbeat, see the RegionCapacity table."""
+    allocatable_cpu: float
+    allocatable_memory: int
+    requested_cpu: float
+    requested_memory: int
+    running_jobs: int
+    backlog: int
+    updated_at: datetime
+
+    @property
+    def free_cpu(self) -> float:
+        return self.allocatable_cpu - self.requested_cpu
+
+    @property
+    def free_memory(self) -> int:
+        return self.allocatable_memory - self.requested_memory
+
+
+class RegionCapacityMonitor:
+    """In-memory snapshot of the RegionCapacity table, refreshed by a background thread.
+
+    Regions whose agent never reported are assumed to have unlimited capacity, so that placement works as
+    before until agents send heartbeats. Regions whose last heartbeat is older than the staleness limit
+    are unavailable, as are regions with no free CPU or memory.
+    """
+
+    def __init__(self, refresh_interval: float = REGION_CAPACITY_REFRESH_INTERVAL,
+                 stale_after: float = REGION_CAPACITY_STALE_AFTER):
+        self.refresh_interval = refresh_interval
+        self.stale_after = stale_after
+        self.capacities: dict[str, RegionCapacity] = {}
+        self.thread: threading.Thread = None
+
+    def get_capacity(self, region: str) -> RegionCapacity | None:
+        """Get the last reported capacity of a region, or None if it is unknown or stale."""
+        capacity = self.capacities.get(region)
+        if capacity is None or time.time() - capacity.updated_at.timestamp() > self.stale_after:
+            return None
+        return capacity
+
+    def get_unavailable_regions(self) -> set[str]:
+        unavailable = set()
+        for region in self.capacities:
+            capacity = self.get_capacity(region)
+            if capacity is None or capacity.free_cpu <= 0 or capacity.free_memory <= 0:
+                unavailable.add(region)
+        return unavailable
+
+    def get_free_resources(self, regions: list[str]) -> tuple[list[float], list[float]]:
+        """Get the free CPU cores and memory bytes of each region, infinite where the capacity is unknown or stale."""
+        capacities = [self.get_capacity(region) for region in regions]
+        return [max(capacity.free_cpu, 0) if capacity else float('inf') for capacity in capacities], \
+            [max(capacity.free_memory, 0) if capacity else float('inf') for capacity in capacities]
+
+    def start(self, app):
+        self.thread = threading.Thread(target=self._run, args=(app,), name='region-capacity-monitor', daemon=True)
+        self.thread.start()
+
+    def _run(self, app):
+        with app.app_context():
+            while True:
+                try:
+                    self._refresh()
+                except Exception:
+                    current_app.logger.error('Failed to refresh region capacities', exc_info=True)
+                time.sleep(self.refresh_interval)
+
+    def _refresh(self):
+        with get_pooled_db_cursor() as cursor:
+            rows = psql_execute_list(cursor, '''SELECT region, allocatable_cpu, allocatable_memory, requested_cpu, requested_memory,
+                                                    running_jobs, backlog, updated_at
+                                                FROM RegionCapacity;''', fetch_result=True)
+        # Replaced as a whole, so that readers never see a partial refresh.
+        self.capacities = { region: RegionCapacity(*values) for region, *values in rows }
+        stale_regions = [region for region in self.capacities if self.get_capacity(region) is None]
+        if stale_regions:
+            current_app.logger.warning(f'No recent heartbeat from regions {stale_regions}')
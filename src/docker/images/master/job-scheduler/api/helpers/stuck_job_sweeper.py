@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import threading
+from flask import current_app
+
+from api.helpers.placement_worker import PlacementWorker
+from api.config import STUCK_JOB_SWEEP_INTERVAL, PLACEMENT_BATCH_SIZE
+
+class StuckJobSweeper:
+    """Renew the leases of the jobs held by the placement worker, and take over the jobs of dead workers.
+
+    Jobs get stuck when the worker that accepted them dies before placing them, after which their lease
+    expires. Every gunicorn worker that places jobs asynchronously runs one sweeper, at startup and then
+    periodically; expired leases are claimed in database, so that each stuck job is placed again by a
+    single worker.
+    """
+
+    def __init__(self, placement_worker: PlacementWorker, interval: float = STUCK_JOB_SWEEP_INTERVAL,
+                 batch_size: int = PLACEMENT_BATCH_SIZE):
+        self.placement_worker = placement_worker
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+        self.thread: threading.Thread = None
+
+    def start(self, app):
+        self.thread = threading.Thread(target=self._run, args=(app,), name='stuck-job-sweeper', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self, app):
+        with app.app_context():
+            while not self.stopped.is_set():
+                self._sweep()
+                self.stopped.wait(self.interval)
+
+    def _sweep(self):
+        try:
+            self.placement_worker.renew_leases()
+        except Exception:
+            current_app.logger.error('Failed to renew the leases of queued jobs', exc_info=True)
+        try:
+            while True:
+                count = self.placement_worker.resume_expired_jobs(self.batch_size)
+                if count:
+                    current_app.logger.warning(f'Placing {count} jobs whose placement worker was lost again')
+                if count < self.batch_size:
+                    return
+        except Exception:
+            current_app.logger.error('Failed to sweep stuck jobs', exc_info=True)
@@ -12,6 +12,9 @@ from api.util import get_env_var
 from api.config import REGIONS as AVAILABLE_LOCATIONS
 from api.models.dataclass_extensions import *
 
+# Must match the length of JobRequest.idempotency_key in the database.
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+
 PATTERN_REGION = "|".join(map(re.escape, AVAILABLE_LOCATIONS))
 REGEX_BY_STORAGE_TYPE: dict[str, re.Pattern] = {
     'pvc': re.compile(r'^pvc://([\w.-]+)/?$'),
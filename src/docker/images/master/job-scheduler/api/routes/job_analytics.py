@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from flask import current_app
+from flask_restful import Resource
+from webargs.flaskparser import use_args
+from marshmallow import validates_schema, ValidationError
+import marshmallow_dataclass
+from marshmallow_dataclass import dataclass
+
+from api.helpers.job_analytics import JobAnalytics, GROUP_BY_COLUMNS
+from api.models.dataclass_extensions import *
+from api.config import ANALYTICS_MAX_WINDOWS
+
+g_job_analytics = JobAnalytics()
+
+
+@dataclass
+class JobLatencyRequest:
+    # Jobs submitted between start and end, by default over the last day.
+    start: Optional[datetime] = field(default=None, metadata=dict(validate=validate_is_timezone_aware))
+    end: Optional[datetime] = field(default=None, metadata=dict(validate=validate_is_timezone_aware))
+    # Window size in seconds.
+    window: int = field(default=3600, metadata=dict(validate=validate.Range(min=60)))
+    group_by: list[str] = field(default_factory=list, metadata=dict(validate=validate.ContainsOnly(GROUP_BY_COLUMNS)))
+
+    @validates_schema
+    def validate_schema(self, data, **kwargs):
+        end = data.get('end') or datetime.now(timezone.utc)
+        start = data.get('start') or end - timedelta(days=1)
+        if start >= end:
+            raise ValidationError({ 'start': 'start must be before end' })
+        if (end - start).total_seconds() / data.get('window', 3600) > ANALYTICS_MAX_WINDOWS:
+            raise ValidationError({ 'window': f'At most {ANALYTICS_MAX_WINDOWS} windows can be queried at once' })
+
+
+class JobLatency(Resource):
+    """Get the latency percentiles of the stages of jobs, from submission to completion, per window of submission time."""
+
+    @use_args(marshmallow_dataclass.class_schema(JobLatencyRequest)(), location='query')
+    def get(self, args: JobLatencyRequest):
+        current_app.logger.info(f'Getting job latencies with {args}')
+        end = args.end or datetime.now(timezone.utc)
+        start = args.start or end - timedelta(days=1)
+        return {
+            'window': args.window,
+            'windows': g_job_analytics.get_stage_latencies(start, end, args.window, args.group_by),
+        }
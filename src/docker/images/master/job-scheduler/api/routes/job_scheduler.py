@@ -1,107 +1,264 @@
 #!/usr/bin/env python3
 
+import time
 import uuid
 from datetime import datetime, timezone
-from flask import current_app
+from flask import current_app, g, request
 from flask_restful import Resource
 from webargs.flaskparser import use_args
+from werkzeug.exceptions import UnprocessableEntity
+from marshmallow import ValidationError
 import marshmallow_dataclass
 import yaml
 
-from api.models.job_request import JobRequest
+from api.models.job_request import JobRequest, IDEMPOTENCY_KEY_MAX_LENGTH
 from api.helpers.carbon_api_client import CarbonApiClient
 from api.helpers.job_queue import JobQueue
+from api.helpers.job_dispatcher import JobDispatcher, Placement, UNDISPATCHED_EVENTS, dump_job_request, is_same_job_request, \
+    get_job_history_conflict_clause
+from api.helpers.placement_worker import PlacementWorker
+from api.helpers.deferred_job_releaser import DeferredJobReleaser
+from api.helpers.stuck_job_sweeper import StuckJobSweeper
+from api.helpers.dataset_size_index import DatasetSizeIndex
+from api.helpers.region_backlog import RegionBacklogMonitor
+from api.helpers.region_capacity import RegionCapacityMonitor
 from api.helpers.postgres import *
-from api.config import REGIONS as AVAILABLE_LOCATIONS
+from api.helpers.metrics import time_stage, STAGE_LATENCY, ADMISSION_REJECTIONS
+from api.helpers.cache import TtlCache
+from api.config import BATCH_MAX_SIZE, ASYNC_PLACEMENT, IDEMPOTENCY_CACHE_SIZE, ADMISSION_POLICY, REGION_BACKLOG_REFRESH_INTERVAL
 
 g_carbon_api_client = CarbonApiClient()
 g_job_queue = JobQueue()
+g_dataset_size_index = DatasetSizeIndex()
+g_region_backlog = RegionBacklogMonitor(g_job_queue)
+g_region_capacity = RegionCapacityMonitor()
+g_job_dispatcher = JobDispatcher(g_carbon_api_client, g_job_queue, g_dataset_size_index, g_region_backlog, g_region_capacity)
+g_placement_worker = PlacementWorker(g_job_dispatcher)
+g_deferred_job_releaser = DeferredJobReleaser(g_job_dispatcher)
+g_stuck_job_sweeper = StuckJobSweeper(g_placement_worker)
+# Idempotency key -> (job id, job name, saved request) of jobs that were dispatched.
+g_idempotent_jobs = TtlCache(float('inf'), IDEMPOTENCY_CACHE_SIZE)
 APP_ROLE = get_env_var('APP_ROLE')
 
 
-class JobSchduler(Resource):
-    def __init__(self):
-        super().__init__()
-        self.dbconn = get_db_connection(autocommit=True)
+def is_admission_rejected() -> bool:
+    """Whether new submissions are turned away because every region is saturated, see ADMISSION_POLICY."""
+    if ADMISSION_POLICY != 'reject' or not g_region_backlog.are_all_regions_saturated():
+        return False
+    current_app.logger.warning('Rejecting job submission, as every region is saturated')
+    return True
+
+def get_retry_after_header() -> dict:
+    return { 'Retry-After': str(max(1, int(REGION_BACKLOG_REFRESH_INTERVAL))) }
 
-    def __del__(self):
-        self.dbconn.close()
 
+class JobSchduler(Resource):
     @use_args(marshmallow_dataclass.class_schema(JobRequest)())
     def post(self, job_request: JobRequest):
+        # Request parsing and validation by webargs happen before the handler is called.
+        STAGE_LATENCY.labels('validation').observe(time.time() - g.start)
         current_app.logger.info(f'{__class__}.post({job_request})')
         job_uuid = uuid.uuid4()
         job_id = str(job_uuid)
         job_request.spec.name += f'-{job_uuid.hex[:10]}'
-        self._save_job_request(job_id, job_request)
+        idempotency_key = self._get_idempotency_key()
+        if idempotency_key:
+            existing_job = g_idempotent_jobs.get(idempotency_key)
+            if existing_job is not None:
+                current_app.logger.info(f'Replaying job {existing_job[0]} for idempotency key {idempotency_key}')
+                self._check_same_job_request(idempotency_key, existing_job[2], job_request)
+                return self._get_response(*existing_job[:2]), 200
+        if is_admission_rejected():
+            ADMISSION_REJECTIONS.inc()
+            return { 'error': 'Every region is saturated, retry later.' }, 429, get_retry_after_header()
+        existing_job = self._save_job_request(job_id, job_request, idempotency_key)
+        if existing_job is not None:
+            return self._resume_job(idempotency_key, existing_job, job_request)
         self._save_job_history(job_id, 'Created', datetime.now(timezone.utc))
-        best_location = self._get_best_location(job_request)
-        job_message = {
-            'job_id': job_id,
-            'name': job_request.spec.name,
-            'image': job_request.spec.image,
-            'command': job_request.spec.command,
-            # 'max_delay': job_request.spec.max_delay,
-            'inputs': job_request.get_parsed_mountpoints(job_request.inputs),
-            'outputs': job_request.get_parsed_mountpoints(job_request.outputs),
-        }
-        if job_request.resources:
-            job_message |= {
-                'resources.requests.cpu': job_request.resources.requests.cpu,
-                'resources.requests.memory': job_request.resources.requests.memory,
-                'resources.limits.cpu': job_request.resources.limits.cpu,
-                'resources.limits.memory': job_request.resources.limits.memory,
-            }
-        self._send_job_to_queue(best_location, yaml.safe_dump(job_message, default_flow_style=False))
-        self._save_job_history(job_id, 'Enqueued', datetime.now(timezone.utc))
-        # TODO: wait for response, or return a request id
+        return self._place_and_dispatch_job(idempotency_key, job_id, job_request)
+
+    def _get_idempotency_key(self) -> str | None:
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is not None and not 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise UnprocessableEntity(f'Idempotency-Key must have 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters.')
+        return idempotency_key
+
+    def _check_same_job_request(self, idempotency_key: str, saved_request: dict | None, job_request: JobRequest):
+        if not is_same_job_request(saved_request, job_request):
+            raise UnprocessableEntity(f'Idempotency key {idempotency_key} was already used for a different job request.')
+
+    def _get_response(self, job_id: str, job_name: str) -> dict:
         return {
             'job_uuid': job_id,
-            'job_name': job_request.spec.name,
-        }, 201
+            'job_name': job_name,
+        }
 
-    def _get_best_location(self, job_request: JobRequest):
-        try:
-            emissions_by_location = g_carbon_api_client.get_carbon_emissions_by_location(
-                job_request.original_location,
-                AVAILABLE_LOCATIONS,
-                self._get_data_size(job_request.spec.name, job_request.inputs),
-                self._get_data_size(job_request.spec.name, job_request.inputs)
-            )
-            return min(emissions_by_location, key=lambda k: emissions_by_location[k]['total_emission'])
-        except Exception:
-            current_app.logger.warning('Failed to obtain best location to run job, returning default ...', exc_info=True)
-            return AVAILABLE_LOCATIONS[0]
+    def _place_and_dispatch_job(self, idempotency_key: str | None, job_id: str, job_request: JobRequest):
+        if ASYNC_PLACEMENT:
+            g_placement_worker.submit({ job_id: job_request })
+            status_code = 202
+        else:
+            try:
+                with time_stage('get_best_location'):
+                    placement = g_job_dispatcher.get_best_location(job_request)
+            except Exception:
+                # Let a retry with the same idempotency key place the job again.
+                self._save_failure(job_id, 'PlacementFailed')
+                raise
+            self._dispatch_job(job_id, job_request, placement)
+            # TODO: wait for response, or return a request id
+            status_code = 201
+        if idempotency_key:
+            g_idempotent_jobs.put(idempotency_key, (job_id, job_request.spec.name, dump_job_request(job_request)))
+        return self._get_response(job_id, job_request.spec.name), status_code
+
+    def _resume_job(self, idempotency_key: str, existing_job: tuple[str, str, dict | None], job_request: JobRequest):
+        """Handle a submission whose idempotency key was already used, by returning the original job.
+
+        The original job is dispatched again if it failed to be placed or enqueued, as the client is retrying it.
+        Only one of concurrent retries dispatches it; the others get 409 while it is being dispatched.
+        """
+        job_id, job_name, saved_request = existing_job
+        self._check_same_job_request(idempotency_key, saved_request, job_request)
+        with get_pooled_db_cursor() as cursor:
+            event = psql_execute_scalar(cursor, 'SELECT event FROM JobCurrentState WHERE job_id = %s;', [job_id])
+        current_app.logger.info(f'Idempotency key {idempotency_key} was used by job {job_id}, which is {event}')
+        if event in UNDISPATCHED_EVENTS:
+            if g_job_dispatcher.claim_retry(job_id):
+                job_request.spec.name = job_name
+                return self._place_and_dispatch_job(idempotency_key, job_id, job_request)
+            # Still being placed and enqueued by another request, which may fail yet.
+            return self._get_response(job_id, job_name) | { 'error': 'The job is still being dispatched, retry later.' }, 409
+        g_idempotent_jobs.put(idempotency_key, existing_job)
+        return self._get_response(job_id, job_name), 200
 
-    def _save_job_request(self, job_id, job_request: JobRequest):
+    def _save_job_request(self, job_id, job_request: JobRequest, idempotency_key: str = None) -> tuple[str, str, dict | None] | None:
+        """Save the job request, or return the (job id, job name, saved request) of the job already saved with the same idempotency key."""
         current_app.logger.info(f'Saving job request with job_id={job_id}:\n{yaml.dump(job_request)}')
         try:
-            cursor = self.dbconn.cursor()
-            result = psql_execute_values(cursor, 'INSERT INTO JobRequest (job_id, name, image, command, max_delay) VALUES %s', [
-                (job_id, job_request.spec.name, job_request.spec.image, ' '.join(job_request.spec.command), job_request.spec.max_delay)
-            ])
-            current_app.logger.debug(result)
+            with time_stage('save_job_request'), get_pooled_db_cursor() as cursor:
+                result = psql_execute_list(cursor, '''INSERT INTO JobRequest (job_id, name, image, command, max_delay, idempotency_key, request)
+                                                        VALUES (%s, %s, %s, %s, %s, %s, %s)
+                                                        ON CONFLICT (idempotency_key) DO NOTHING
+                                                        RETURNING job_id;''', [
+                    job_id, job_request.spec.name, job_request.spec.image, ' '.join(job_request.spec.command), job_request.spec.max_delay, idempotency_key,
+                    Json(dump_job_request(job_request))
+                ], fetch_result=True)
+                current_app.logger.debug(result)
+                if result:
+                    return None
+                [(existing_job_id, existing_job_name, existing_request)] = psql_execute_list(
+                    cursor, 'SELECT job_id, name, request FROM JobRequest WHERE idempotency_key = %s;', [idempotency_key], fetch_result=True)
+                return str(existing_job_id), existing_job_name, existing_request
         except Exception as ex:
             raise ValueError(f'Failed to save job request (job_id={job_id}).') from ex
 
     def _save_job_history(self, job_id: str, event: str, timestamp: datetime):
         current_app.logger.info(f'Saving job history with job_id={job_id}, event={event}, timestamp={timestamp}')
         try:
-            cursor = self.dbconn.cursor()
-            result = psql_execute_list(cursor, '''INSERT INTO JobHistory (job_id, event, time, origin)
-                                                    VALUES (%s, %s, %s, %s)''', [
-                job_id, event, timestamp, APP_ROLE
-            ])
+            with time_stage('save_job_history'), get_pooled_db_cursor() as cursor:
+                result = psql_execute_list(cursor, f'''INSERT INTO JobHistory (job_id, event, time, origin)
+                                                        VALUES (%s, %s, %s, %s)
+                                                        {get_job_history_conflict_clause(event)}''', [
+                    job_id, event, timestamp, APP_ROLE
+                ])
             current_app.logger.debug(result)
         except Exception as ex:
             raise ValueError(f'Failed to save job history (job_id={job_id}).') from ex
 
-    def _send_job_to_queue(self, region, message):
+    def _dispatch_job(self, job_id: str, job_request: JobRequest, placement: Placement):
+        errors = g_job_dispatcher.dispatch_jobs({ job_id: job_request }, { job_id: placement })
+        if job_id in errors:
+            # Let a retry with the same idempotency key dispatch the job again.
+            self._save_failure(job_id, 'EnqueueFailed')
+            raise ValueError('Failed to send job to queue') from errors[job_id]
+
+    def _save_failure(self, job_id: str, event: str):
+        """Record why a job could not be dispatched, without hiding the error being handled if that fails."""
         try:
-            g_job_queue.send_message_to_region(region, message)
-        except Exception as ex:
-            raise ValueError('Failed to send job to queue') from ex
+            self._save_job_history(job_id, event, datetime.now(timezone.utc))
+        except Exception:
+            current_app.logger.error(f'Failed to record {event} event', exc_info=True)
+
+
+class JobSchdulerBatch(Resource):
+    """Submit a list of job requests at once, with a per-item result."""
+
+    def post(self):
+        items = request.get_json(force=True)
+        if not isinstance(items, list):
+            raise UnprocessableEntity('Request body must be a list of job requests.')
+        if len(items) > BATCH_MAX_SIZE:
+            raise UnprocessableEntity(f'Batch size must not exceed {BATCH_MAX_SIZE}.')
+        current_app.logger.info(f'{__class__}.post(): {len(items)} job requests')
+
+        results: list[dict] = [None] * len(items)
+        job_requests: dict[str, JobRequest] = {}
+        job_indices: dict[str, int] = {}
+        schema = marshmallow_dataclass.class_schema(JobRequest)()
+        for index, item in enumerate(items):
+            try:
+                job_request: JobRequest = schema.load(item)
+            except ValidationError as ex:
+                results[index] = { 'errors': ex.messages, 'status': 422 }
+                continue
+            job_uuid = uuid.uuid4()
+            job_id = str(job_uuid)
+            job_request.spec.name += f'-{job_uuid.hex[:10]}'
+            job_requests[job_id] = job_request
+            job_indices[job_id] = index
+
+        if job_requests and is_admission_rejected():
+            ADMISSION_REJECTIONS.inc(len(job_requests))
+            for index in job_indices.values():
+                results[index] = { 'error': 'Every region is saturated, retry later.', 'status': 429 }
+            return { 'jobs': results }, 200, get_retry_after_header()
+
+        if job_requests:
+            try:
+                g_job_dispatcher.save_job_requests(job_requests)
+                g_job_dispatcher.save_job_histories(list(job_requests.keys()), 'Created', datetime.now(timezone.utc))
+            except Exception as ex:
+                current_app.logger.error(f'Failed to save batch: {ex}', exc_info=True)
+                for index in job_indices.values():
+                    results[index] = { 'error': str(ex), 'status': 500 }
+                return { 'jobs': results }, 200
+
+            if ASYNC_PLACEMENT:
+                g_placement_worker.submit(job_requests)
+                for job_id, job_request in job_requests.items():
+                    results[job_indices[job_id]] = {
+                        'job_uuid': job_id,
+                        'job_name': job_request.spec.name,
+                        'status': 202,
+                    }
+                return { 'jobs': results }, 200
 
-    def _get_data_size(self, name: str, mountpoints: dict[str, str]) -> float:
-        # NOTE: keep track of historic size, or probe for estimated size.
-        return 0.
+            try:
+                with time_stage('place_jobs'):
+                    placements = g_job_dispatcher.place_jobs(job_requests)
+            except Exception as ex:
+                current_app.logger.error(f'Failed to place batch: {ex}', exc_info=True)
+                try:
+                    g_job_dispatcher.save_job_histories(list(job_requests.keys()), 'PlacementFailed', datetime.now(timezone.utc))
+                except Exception:
+                    current_app.logger.error('Failed to record PlacementFailed events', exc_info=True)
+                for job_id, job_request in job_requests.items():
+                    results[job_indices[job_id]] = {
+                        'job_uuid': job_id,
+                        'job_name': job_request.spec.name,
+                        'error': f'Failed to place job: {ex}',
+                        'status': 500,
+                    }
+                return { 'jobs': results }, 200
+            errors = g_job_dispatcher.dispatch_jobs(job_requests, placements)
+            for job_id, job_request in job_requests.items():
+                if job_id in errors:
+                    result = { 'error': f'Failed to send job to queue: {errors[job_id]}', 'status': 500 }
+                else:
+                    result = { 'status': 201 }
+                results[job_indices[job_id]] = {
+                    'job_uuid': job_id,
+                    'job_name': job_request.spec.name,
+                } | result
+        return { 'jobs': results }, 200
@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 
-from typing import Optional
-from flask import current_app
+import json
+import queue
+import time
+import uuid
+from datetime import datetime
+from typing import Iterable, Optional
+from flask import current_app, Response, stream_with_context
 from flask_restful import Resource
 from webargs.flaskparser import use_args
 from marshmallow import validates_schema, ValidationError
@@ -9,7 +14,16 @@ import marshmallow_dataclass
 from marshmallow_dataclass import dataclass
 
 from api.helpers.postgres import *
+from api.helpers.job_event_listener import JobEventListener
 from api.models.dataclass_extensions import *
+from api.util import CustomJSONEncoder
+from api.config import STATUS_BULK_MAX_SIZE, STATUS_LIST_MAX_LIMIT, STATUS_STREAM_KEEPALIVE_INTERVAL, STATUS_STREAM_MAX_DURATION
+
+# Events after which a job never changes state again. Failures to place or enqueue a job are not final,
+# as a retry of its submission dispatches it again, see `JobSchduler._resume_job()`.
+FINAL_EVENTS = { 'Completed', 'Failed', 'NotFound', 'CreateFailed' }
+
+g_job_event_listener = JobEventListener()
 
 
 @dataclass
@@ -28,49 +42,229 @@ class JobStatusRequest:
             raise ValidationError(errors)
 
 
-class JobStatus(Resource):
-    def __init__(self):
-        super().__init__()
-        self.dbconn = get_db_connection(autocommit=True)
+@dataclass
+class JobStatusBulkRequest:
+    job_ids: Optional[list[uuid.UUID]] = field(default=None)
+    job_names: Optional[list[str]] = field(default=None)
 
-    @use_args(marshmallow_dataclass.class_schema(JobStatusRequest)(), location='query')
-    def get(self, args: JobStatusRequest):
-        if args.job_id:
-            job_status = self._get_job_status(job_id=args.job_id)
-        else:
-            job_status = self._get_job_status(job_name=args.job_name)
-        return job_status
+    @validates_schema
+    def validate_schema(self, data, **kwargs):
+        errors = dict()
+        count = len(data.get('job_ids') or []) + len(data.get('job_names') or [])
+        if count == 0:
+            error_message_either_ids_or_names_is_required = 'Either job_ids or job_names is required'
+            errors['job_ids'] = error_message_either_ids_or_names_is_required
+            errors['job_names'] = error_message_either_ids_or_names_is_required
+        elif count > STATUS_BULK_MAX_SIZE:
+            errors['job_ids'] = f'At most {STATUS_BULK_MAX_SIZE} jobs can be queried at once'
+        if errors:
+            raise ValidationError(errors)
 
-    def _get_job_status(self, job_id: str = None, job_name: str = None):
-        job_description = f'job_id={job_id}' if job_id else f'job_name={job_name}'
-        if job_id:
-            current_app.logger.info(f'Getting job status with {job_description}')
-        else:
-            current_app.logger.info(f'Getting job status with {job_description}')
-        try:
-            cursor = self.dbconn.cursor()
+
+@dataclass
+class JobStatusListRequest:
+    event: Optional[str] = field(default=None)
+    origin: Optional[str] = field(default=None)
+    name_prefix: Optional[str] = field(default=None)
+    # Keyset of the last job on the previous page.
+    after_time: Optional[datetime] = field(default=None, metadata=dict(validate=validate_is_timezone_aware))
+    after_job_id: Optional[uuid.UUID] = field(default=None)
+    limit: int = field(default=100, metadata=dict(validate=validate.Range(min=1, max=STATUS_LIST_MAX_LIMIT)))
+
+    @validates_schema
+    def validate_schema(self, data, **kwargs):
+        if ('after_time' in data) != ('after_job_id' in data):
+            error_message_keyset_is_incomplete = 'after_time and after_job_id must be given together'
+            raise ValidationError({
+                'after_time': error_message_keyset_is_incomplete,
+                'after_job_id': error_message_keyset_is_incomplete,
+            })
+
+
+def _encode_json(o) -> str:
+    return json.dumps(o, cls=CustomJSONEncoder)
+
+def _get_job_status_from_row(row: tuple) -> dict:
+    return {
+        'job_id': row[0],
+        'job_name': row[1],
+        'event': row[2],
+        'timestamp': row[3],
+    }
+
+def _escape_like_pattern(s: str) -> str:
+    return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _normalize_job_id(job_id: str) -> str | None:
+    try:
+        return str(uuid.UUID(job_id))
+    except ValueError:
+        return None
+
+def get_job_status(job_id: str = None, job_name: str = None) -> dict:
+    """Get the last event of a job, from the job event listener's cache if possible."""
+    job_description = f'job_id={job_id}' if job_id else f'job_name={job_name}'
+    current_app.logger.info(f'Getting job status with {job_description}')
+    if job_id:
+        job_id = _normalize_job_id(job_id) or job_id
+    job_event = g_job_event_listener.get_last_event(job_id=job_id, job_name=job_name)
+    if job_event is not None:
+        return {
+            'job_id': job_event['job_id'],
+            'event': job_event['event'],
+            'timestamp': job_event['timestamp'],
+        }
+    try:
+        with get_pooled_db_cursor() as cursor:
             if job_id:
                 result = psql_execute_list(
                     cursor,
-                    'SELECT job_id, event, time FROM JobHistoryLastEvent WHERE job_id = %s;',
+                    'SELECT job_id, name, event, time FROM JobCurrentState WHERE job_id = %s;',
                     [ job_id ],
                     fetch_result=True)
             else:
                 result = psql_execute_list(
                     cursor,
-                    """SELECT event.job_id, event.event, event.time
-                        FROM JobHistoryLastEvent event INNER JOIN JobRequest jobs
-                            ON event.job_id = jobs.job_id
-                        WHERE jobs.name = %s;""",
+                    'SELECT job_id, name, event, time FROM JobCurrentState WHERE name = %s;',
                     [ job_name ],
                     fetch_result=True)
-            current_app.logger.debug(result)
-            assert len(result) == 1, 'Should not have more than one row'
-            row = result[0]
-            return {
-                'job_id': row[0],
-                'event': row[1],
-                'timestamp': row[2],
-            }
-        except Exception as ex:
-            raise ValueError(f'Failed to get job status ({job_description}).') from ex
+        current_app.logger.debug(result)
+        assert len(result) == 1, 'Should not have more than one row'
+        job_event = _get_job_status_from_row(result[0])
+    except Exception as ex:
+        raise ValueError(f'Failed to get job status ({job_description}).') from ex
+    g_job_event_listener.put_last_event({ **job_event, 'job_id': str(job_event['job_id']) })
+    return {
+        'job_id': job_event['job_id'],
+        'event': job_event['event'],
+        'timestamp': job_event['timestamp'],
+    }
+
+
+class JobStatus(Resource):
+    @use_args(marshmallow_dataclass.class_schema(JobStatusRequest)(), location='query')
+    def get(self, args: JobStatusRequest):
+        if args.job_id:
+            job_status = get_job_status(job_id=args.job_id)
+        else:
+            job_status = get_job_status(job_name=args.job_name)
+        return job_status
+
+
+class JobStatusStream(Resource):
+    """Stream the events of a job as server-sent events, until it reaches a final state.
+
+    The current status is sent first, followed by every new event pushed by the database, so clients
+    no longer need to poll.
+    """
+
+    @use_args(marshmallow_dataclass.class_schema(JobStatusRequest)(), location='query')
+    def get(self, args: JobStatusRequest):
+        job_id = _normalize_job_id(args.job_id) if args.job_id else None
+        if args.job_id and not job_id:
+            raise ValueError(f'Invalid job_id: {args.job_id}')
+        # Subscribe before reading the current status, so no event is missed in between.
+        subscription = g_job_event_listener.subscribe(job_id=job_id, job_name=args.job_name)
+        try:
+            job_status = get_job_status(job_id=job_id, job_name=args.job_name)
+        except Exception:
+            g_job_event_listener.unsubscribe(subscription)
+            raise
+        return Response(stream_with_context(self._generate_response(subscription, job_status)),
+                        mimetype='text/event-stream',
+                        headers={ 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no' })
+
+    def _generate_response(self, subscription, job_status: dict) -> Iterable[str]:
+        try:
+            yield self._format_event(job_status)
+            last_timestamp = job_status['timestamp']
+            event = job_status['event']
+            deadline = time.monotonic() + STATUS_STREAM_MAX_DURATION
+            while event not in FINAL_EVENTS and time.monotonic() < deadline:
+                try:
+                    job_event = subscription.queue.get(timeout=STATUS_STREAM_KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                # Events older than the current state do not change it.
+                if job_event['timestamp'] < last_timestamp:
+                    continue
+                last_timestamp = job_event['timestamp']
+                event = job_event['event']
+                yield self._format_event({
+                    'job_id': job_event['job_id'],
+                    'event': event,
+                    'timestamp': last_timestamp,
+                })
+        finally:
+            g_job_event_listener.unsubscribe(subscription)
+
+    def _format_event(self, job_status: dict) -> str:
+        return f'event: job-status\ndata: {_encode_json(job_status)}\n\n'
+
+
+class JobStatusBulk(Resource):
+    """Get the status of many jobs by id or name in a single query."""
+
+    @use_args(marshmallow_dataclass.class_schema(JobStatusBulkRequest)())
+    def post(self, args: JobStatusBulkRequest):
+        job_ids = args.job_ids or []
+        job_names = args.job_names or []
+        current_app.logger.info(f'Getting job status of {len(job_ids)} job ids and {len(job_names)} job names')
+        return Response(stream_with_context(self._generate_response(job_ids, job_names)), mimetype='application/json')
+
+    def _generate_response(self, job_ids: list[uuid.UUID], job_names: list[str]) -> Iterable[str]:
+        with get_pooled_db_transaction(cursor_name='job_status_bulk') as cursor:
+            psql_execute_list(
+                cursor,
+                """SELECT job_id, name, event, time FROM JobCurrentState
+                    WHERE job_id = ANY(%s::uuid[]) OR name = ANY(%s);""",
+                [ job_ids, job_names ])
+            yield '{"jobs": ['
+            for i, row in enumerate(cursor):
+                yield (',' if i else '') + _encode_json(_get_job_status_from_row(row))
+            yield ']}'
+
+
+class JobStatusList(Resource):
+    """List job statuses page by page, ordered by (time, job_id) of the last event."""
+
+    @use_args(marshmallow_dataclass.class_schema(JobStatusListRequest)(), location='query')
+    def get(self, args: JobStatusListRequest):
+        current_app.logger.info(f'Listing job status with {args}')
+        conditions = []
+        query_args = []
+        if args.event:
+            conditions.append('event = %s')
+            query_args.append(args.event)
+        if args.origin:
+            conditions.append('origin = %s')
+            query_args.append(args.origin)
+        if args.name_prefix:
+            conditions.append('name LIKE %s')
+            query_args.append(_escape_like_pattern(args.name_prefix) + '%')
+        if args.after_time:
+            conditions.append('(time, job_id) > (%s, %s)')
+            query_args += [args.after_time, args.after_job_id]
+        query = f"""SELECT job_id, name, event, time FROM JobCurrentState
+                    {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+                    ORDER BY time, job_id
+                    LIMIT %s;"""
+        query_args.append(args.limit)
+        return Response(stream_with_context(self._generate_response(query, query_args, args.limit)),
+                        mimetype='application/json')
+
+    def _generate_response(self, query: str, query_args: list, limit: int) -> Iterable[str]:
+        with get_pooled_db_transaction(cursor_name='job_status_list') as cursor:
+            psql_execute_list(cursor, query, query_args)
+            yield '{"jobs": ['
+            count = 0
+            last_row = None
+            for row in cursor:
+                yield (',' if count else '') + _encode_json(_get_job_status_from_row(row))
+                count += 1
+                last_row = row
+            # A full page may be followed by more jobs.
+            next_page = { 'after_time': last_row[3], 'after_job_id': last_row[0] } if count == limit else None
+            yield '], "next": ' + _encode_json(next_page) + '}'
@@ -13,6 +13,9 @@ from flask.json import JSONEncoder
 def get_env_var(key):
     return os.environ[key]
 
+def get_env_var_or_default(key, default):
+    return os.environ.get(key, default)
+
 def run_command_and_print_output(cmd, input=None):
     call = subprocess.run(cmd, input=input, stdout=subprocess.PIPE, text=True)
     if call.stdout:
@@ -21,6 +24,12 @@ def run_command_and_print_output(cmd, input=None):
         current_app.logger.info(call.stderr)
     call.check_returncode()
 
+def get_command_output(cmd, timeout=None) -> str:
+    call = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=timeout)
+    if call.returncode != 0:
+        raise ValueError(f'Command {cmd} failed with exit code {call.returncode}: {call.stderr}')
+    return call.stdout
+
 class CustomJSONEncoder(JSONEncoder):
     def default(self, o: object) -> Any:
         """This defines serialization for object types that `json` cannot handle by default."""
@@ -36,6 +45,26 @@ class CustomJSONEncoder(JSONEncoder):
             return str(o)
         raise TypeError(f"Type {type(o)} is not serializable")
 
+MEMORY_SUFFIXES = {
+    'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40, 'Pi': 2 ** 50, 'Ei': 2 ** 60,
+    'k': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12, 'P': 10 ** 15, 'E': 10 ** 18,
+}
+
+def parse_kube_cpu(cpu: str | int) -> float:
+    """Parse a Kubernetes CPU quantity (e.g. "4", "500m") into cores."""
+    if isinstance(cpu, (int, float)):
+        return float(cpu)
+    return float(cpu[:-1]) / 1000 if cpu.endswith('m') else float(cpu)
+
+def parse_kube_memory(memory: str | int) -> float:
+    """Parse a Kubernetes memory quantity (e.g. "256Mi", "1G", "1e9") into bytes."""
+    if isinstance(memory, (int, float)):
+        return float(memory)
+    for suffix in sorted(MEMORY_SUFFIXES, key=len, reverse=True):
+        if memory.endswith(suffix):
+            return float(memory[:-len(suffix)]) * MEMORY_SUFFIXES[suffix]
+    return float(memory)
+
 def get_all_enum_values(enum_type):
     """Get all values of a particular Enum type."""
     return [e.value for e in enum_type]
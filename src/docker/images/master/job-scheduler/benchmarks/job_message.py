@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Measure encoding and decoding of job messages, in the legacy YAML format and in the JSON envelope.
+
+Usage: python benchmarks/job_message.py [--repeat 5] [--number 200]
+
+Messages are encoded by the scheduler's api/helpers/job_message.py and decoded by the agent's
+job_message.py, which is loaded from its file. A typical message and one with a long inline script and
+many mounts are measured, the latter above the compression threshold.
+"""
+
+import argparse
+import importlib.util
+import os
+import sys
+import timeit
+import uuid
+import yaml
+
+JOB_SCHEDULER_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+AGENT_JOB_MESSAGE_PATH = os.path.join(JOB_SCHEDULER_DIR, '..', '..', 'agent', 'executor', 'src', 'job_message.py')
+REGIONS = ['us-west', 'us-central', 'us-east']
+
+def load_modules():
+    # The scheduler's configuration requires these, but the job messages do not use them.
+    for key, value in [('BROKER_URL', 'amqp://localhost'), ('QUEUE_PERFIX', 'benchmark'), ('REGIONS', ':'.join(REGIONS)),
+                       ('CARBON_API_ENDPOINT', 'http://localhost')]:
+        os.environ.setdefault(key, value)
+    sys.path.insert(0, JOB_SCHEDULER_DIR)
+    from api.helpers import job_message as master_job_message
+    spec = importlib.util.spec_from_file_location('agent_job_message', AGENT_JOB_MESSAGE_PATH)
+    agent_job_message = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(agent_job_message)
+    return master_job_message, agent_job_message
+
+def create_job_message(script_lines: int, mounts: int) -> dict:
+    return {
+        'job_id': str(uuid.uuid4()),
+        'name': 'benchmark-job',
+        'image': 'gitlab-registry.nrp-nautilus.io/c3lab/benchmark:latest',
+        'command': ['sh', '-c', '\n'.join(f'python3 /app/step.py --input /data/in/{i} --output /data/out/{i}'
+                                          for i in range(script_lines))],
+        'inputs': { f'/data/in/{i}': f'pvc://benchmark-inputs-{i}' for i in range(mounts) },
+        'outputs': { f'/data/out/{i}': f'pvc://benchmark-outputs-{i}' for i in range(mounts) },
+        'resources.requests.cpu': '1',
+        'resources.requests.memory': '1Gi',
+        'resources.limits.cpu': '2',
+        'resources.limits.memory': '2Gi',
+        'emissions': { region: 123.456 for region in REGIONS },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+    master_job_message, agent_job_message = load_modules()
+
+    messages = {
+        'typical': create_job_message(script_lines=1, mounts=2),
+        'large': create_job_message(script_lines=200, mounts=50),
+    }
+    formats = {
+        'yaml': (lambda message: yaml.safe_dump(message), agent_job_message.decode_job_message),
+        'envelope': (master_job_message.encode_job_message, agent_job_message.decode_job_message),
+    }
+    print(f'best of {args.repeat} x {args.number} runs, compression threshold '
+          f'{master_job_message.JOB_MESSAGE_COMPRESSION_THRESHOLD} bytes\n')
+    print(f'{"message":<10} {"format":<10} {"bytes":>8} {"encode (us)":>12} {"decode (us)":>12}')
+    for message_name, message in messages.items():
+        for format_name, (encode, decode) in formats.items():
+            encoded = encode(message)
+            assert decode(encoded) == message
+            encode_time = min(timeit.repeat(lambda: encode(message), repeat=args.repeat, number=args.number)) / args.number
+            decode_time = min(timeit.repeat(lambda: decode(encoded), repeat=args.repeat, number=args.number)) / args.number
+            print(f'{message_name:<10} {format_name:<10} {len(encoded.encode()):>8} '
+                  f'{encode_time * 1e6:>12.1f} {decode_time * 1e6:>12.1f}')
+
+if __name__ == '__main__':
+    main()
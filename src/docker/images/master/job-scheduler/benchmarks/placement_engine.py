@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Measure placement decisions per second of the placement engine.
+
+Usage: python benchmarks/placement_engine.py [--jobs 10000] [--regions 10] [--slots 96]
+
+Scores and assigns a batch of random jobs under region budgets that fit about half of them in a
+single slot, so that jobs compete for slots. Only numpy is needed; the engine is loaded from its file, so
+that the service configuration is not required.
+"""
+
+import argparse
+import importlib.util
+import os
+import time
+import numpy as np
+
+ENGINE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'api', 'helpers', 'placement_engine.py')
+
+def load_engine():
+    spec = importlib.util.spec_from_file_location('placement_engine', ENGINE_PATH)
+    engine = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(engine)
+    return engine
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=10000)
+    parser.add_argument('--regions', type=int, default=10)
+    parser.add_argument('--slots', type=int, default=96)
+    parser.add_argument('--max-duration', type=int, default=4, help='longest job runtime, in slots')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    engine = load_engine()
+
+    rng = np.random.default_rng(args.seed)
+    carbon = rng.uniform(50, 500, size=(args.regions, args.slots))
+    migration = rng.uniform(0, 50, size=(args.jobs, args.regions))
+    job_cores = rng.choice([0.5, 1, 2, 4], size=args.jobs)
+    job_memory = rng.choice([256, 1024, 4096], size=args.jobs) * 2.**20
+    job_max_slots = rng.integers(0, args.slots, size=args.jobs)
+    job_duration_slots = rng.integers(1, args.max_duration + 1, size=args.jobs)
+    # Half of the batch fits in all regions at once, at every slot.
+    region_cores = np.full(args.regions, job_cores.sum() / 2 / args.regions)
+    region_memory = np.full(args.regions, job_memory.sum() / 2 / args.regions)
+
+    print(f'{args.jobs} jobs x {args.regions} regions x {args.slots} slots, best of {args.repeat}')
+    score_times, assign_times = [], []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        scores = engine.score_jobs(carbon, job_cores, job_max_slots, migration)
+        score_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        regions, _ = engine.assign_jobs(scores, job_cores, job_memory, region_cores, region_memory, job_duration_slots)
+        assign_times.append(time.perf_counter() - start)
+    score_time, assign_time = min(score_times), min(assign_times)
+    assigned = int((regions != engine.UNASSIGNED).sum())
+    print(f'score_jobs:  {score_time:.3f}s')
+    print(f'assign_jobs: {assign_time:.3f}s ({assigned} assigned, {args.jobs - assigned} unassigned)')
+    print(f'decisions/s: {args.jobs / (score_time + assign_time):,.0f}')
+
+if __name__ == '__main__':
+    main()
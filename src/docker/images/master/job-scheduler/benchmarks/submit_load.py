@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""Compare concurrent job submissions sustained by one WSGI and one ASGI process under carbon API latency.
+
+Usage: python benchmarks/submit_load.py [--latency 0.2] [--concurrency 1,8,32,128] [--duration 10]
+
+Starts a stub carbon API that answers after `--latency` seconds, then serves the app with one gunicorn
+worker of GUNICORN_THREADS threads (`api:create_app()`) and with one uvicorn process
+(`api.asgi:create_app`), in turn. Each is loaded by concurrent clients that submit jobs for
+`--duration` seconds, at each level of concurrency.
+
+Both apps use the database of the POSTGRES_HOST, POSTGRES_DB, POSTGRES_USER and POSTGRES_PASSWORD
+environment variables, which must have the schema of the database init job, and keep job messages in
+memory (QUEUE_PUBLISHER=memory), so that no broker is needed. Every submission uses a distinct max delay,
+so that its carbon lookup is neither cached nor shared with a concurrent one, and always waits for
+the stub. gunicorn, uvicorn, aiohttp and httpx are required.
+"""
+
+import argparse
+import asyncio
+import itertools
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+
+JOB_SCHEDULER_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+REGIONS = ['us-west', 'us-central', 'us-east']
+LOCATION_PREFIX = 'Nautilus'
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def run_stub_carbon_api(port: int, latency: float):
+    """Serve carbon API responses that rate every region equally, after `latency` seconds."""
+    from aiohttp import web
+
+    async def handle(request: web.Request) -> web.Response:
+        lookup = await request.json()
+        await asyncio.sleep(latency)
+        location_ids = [location['id'] for location in lookup['candidate_locations']]
+        return web.json_response({
+            'raw-scores': { location_id: {
+                'carbon-emission': 100.0,
+                'carbon-emission-from-compute': 90.0,
+                'carbon-emission-from-migration': 10.0,
+            } for location_id in location_ids },
+            'weighted-scores': { location_id: 1.0 for location_id in location_ids },
+            'details': { location_id: { 'start_delay': [0] } for location_id in location_ids },
+        })
+
+    app = web.Application()
+    app.router.add_get('/carbon-aware-scheduler/', handle)
+    web.run_app(app, host='127.0.0.1', port=port, print=None, access_log=None)
+
+def get_server_command(target: str, port: int, threads: int) -> list[str]:
+    if target == 'wsgi':
+        return ['gunicorn', f'-b=127.0.0.1:{port}', '--config=gunicorn.conf.py', '--workers=1', f'--threads={threads}',
+                '--log-level=warning', 'api:create_app()']
+    return ['uvicorn', '--factory', 'api.asgi:create_app', '--host=127.0.0.1', f'--port={port}', '--log-level=warning']
+
+def start_server(target: str, port: int, threads: int, carbon_api_port: int, log_file) -> subprocess.Popen:
+    env = os.environ | {
+        'BROKER_URL': 'amqp://localhost',
+        'QUEUE_PERFIX': 'load-test',
+        'QUEUE_PUBLISHER': 'memory',
+        'REGIONS': ':'.join(REGIONS),
+        'CARBON_API_ENDPOINT': f'127.0.0.1:{carbon_api_port}',
+        'CARBON_API_LOCATION_PREFIX': LOCATION_PREFIX,
+        'GUNICORN_THREADS': str(threads),
+        'APP_ROLE': 'master.job-scheduler',
+    }
+    env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    return subprocess.Popen(get_server_command(target, port, threads), cwd=JOB_SCHEDULER_DIR, env=env,
+                            stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+
+def stop_process(process: subprocess.Popen):
+    if process.poll() is None:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=20)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+
+async def wait_until_ready(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f'{url} exited with code {process.returncode}')
+            try:
+                if (await client.get(f'{url}/metrics')).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f'{url} is not ready after {timeout}s')
+
+async def submit_jobs(url: str, concurrency: int, duration: float, max_delays: itertools.count) -> dict:
+    latencies, errors = [], 0
+    deadline = time.monotonic() + duration
+
+    async def submit_until_deadline(client: httpx.AsyncClient):
+        nonlocal errors
+        while time.monotonic() < deadline:
+            job_request = {
+                'spec': { 'name': 'load-test', 'image': 'busybox', 'command': ['true'], 'max_delay': next(max_delays) * 300 },
+                'original_location': REGIONS[0],
+                'inputs': {},
+                'outputs': {},
+            }
+            start = time.monotonic()
+            try:
+                response = await client.post(f'{url}/job-scheduler/', json=job_request)
+                if response.status_code == 201:
+                    latencies.append(time.monotonic() - start)
+                else:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+
+    start = time.monotonic()
+    async with httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=concurrency)) as client:
+        await asyncio.gather(*[submit_until_deadline(client) for _ in range(concurrency)])
+    elapsed = time.monotonic() - start
+    latencies.sort()
+    return {
+        'submits_per_second': len(latencies) / elapsed,
+        'p50': statistics.median(latencies) if latencies else float('nan'),
+        'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else float('nan'),
+        'errors': errors,
+    }
+
+async def run(args):
+    carbon_api_port = get_free_port()
+    carbon_api = subprocess.Popen([sys.executable, os.path.realpath(__file__), '--stub-carbon-api', str(carbon_api_port),
+                                   '--latency', str(args.latency)], start_new_session=True)
+    # Distinct max delays for all submissions, see the module docstring.
+    max_delays = itertools.count(1)
+    print(f'carbon API latency {args.latency * 1000:.0f}ms, {args.duration:.0f}s per run, '
+          f'{args.threads} WSGI threads, logs in {args.log_dir}\n')
+    print(f'{"app":<5} {"concurrency":>11} {"submits/s":>10} {"p50 (ms)":>9} {"p99 (ms)":>9} {"errors":>7}')
+    try:
+        for target in args.targets:
+            port = get_free_port()
+            with open(os.path.join(args.log_dir, f'{target}.log'), 'w') as log_file:
+                server = start_server(target, port, args.threads, carbon_api_port, log_file)
+                try:
+                    await wait_until_ready(f'http://127.0.0.1:{port}', server)
+                    for concurrency in args.concurrency:
+                        result = await submit_jobs(f'http://127.0.0.1:{port}', concurrency, args.duration, max_delays)
+                        print(f'{target:<5} {concurrency:>11} {result["submits_per_second"]:>10.1f} '
+                              f'{result["p50"] * 1000:>9.0f} {result["p99"] * 1000:>9.0f} {result["errors"]:>7}')
+                finally:
+                    stop_process(server)
+    finally:
+        stop_process(carbon_api)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.2, help='carbon API latency, in seconds')
+    parser.add_argument('--concurrency', type=lambda s: [int(c) for c in s.split(',')], default=[1, 8, 32, 128])
+    parser.add_argument('--duration', type=float, default=10, help='duration of each run, in seconds')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('GUNICORN_THREADS', 8)))
+    parser.add_argument('--targets', type=lambda s: s.split(','), default=['wsgi', 'asgi'])
+    parser.add_argument('--log-dir', default=tempfile.gettempdir())
+    parser.add_argument('--stub-carbon-api', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.stub_carbon_api:
+        run_stub_carbon_api(args.stub_carbon_api, args.latency)
+    else:
+        asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+from prometheus_client import multiprocess
+
+# The database connection pool of each worker is sized from the same variable, see api/config.py.
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+def on_starting(server):
+    # Metrics of a previous run must not be aggregated with the new ones.
+    multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if multiproc_dir:
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+        os.makedirs(multiproc_dir)
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
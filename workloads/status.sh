@@ -12,6 +12,10 @@ case $1 in
     job_name="$1"
     shift
     ;;
+  --follow)
+    shift
+    follow=1
+    ;;
   *)
     echo >&2 "Ignoring unknown argument \"$1\" ..."
     shift
@@ -20,7 +24,7 @@ esac
 done
 
 if [ -z $job_id ] && [ -z $job_name ]; then
-    echo >&2 "Usage: $0 --job_id <job_id> or $0 --job_name <job_name>"
+    echo >&2 "Usage: $0 --job_id <job_id> or $0 --job_name <job_name> [--follow]"
     exit 1
 fi
 
@@ -31,4 +35,9 @@ JOB_SCHEDULER_URL=https://cas-job-scheduler.nrp-nautilus.io/job-status/
 
 set -x
 
-curl -s "$JOB_SCHEDULER_URL?$args" | jq
+if [ -z $follow ]; then
+    curl -s "$JOB_SCHEDULER_URL?$args" | jq
+else
+    # Print every event until the job finishes.
+    curl -sN "${JOB_SCHEDULER_URL}stream/?$args" | sed -n 's/^data: //p' | jq
+fi
@@ -1,11 +1,12 @@
 #!/bin/sh
 
 if [ $# -lt 1 ]; then
-    echo >&2 "Usage: $0 path/to/body.json"
+    echo >&2 "Usage: $0 path/to/body.json [idempotency-key]"
     exit 1
 fi
 
 json_file="$1"
+idempotency_key="$2"
 
 if ! [ -f "$json_file" ]; then
     echo >&2 "JSON file \"$json_file\" not found."
@@ -16,4 +17,10 @@ JOB_SCHEDULER_URL=https://cas-job-scheduler.nrp-nautilus.io/job-scheduler/
 
 set -x
 
-curl -s -X POST -H "Content-Type: application/json" -d @"$json_file" $JOB_SCHEDULER_URL | jq
+if [ -z "$idempotency_key" ]; then
+    curl -s -X POST -H "Content-Type: application/json" -d @"$json_file" $JOB_SCHEDULER_URL | jq
+else
+    # Retries are safe, as they return the job created by the first attempt.
+    curl -s --retry 3 --retry-all-errors -X POST -H "Content-Type: application/json" -H "Idempotency-Key: $idempotency_key" \
+        -d @"$json_file" $JOB_SCHEDULER_URL | jq
+fi